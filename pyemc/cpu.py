@@ -0,0 +1,1134 @@
+"""NumPy implementations of the CUDA kernels.
+
+Every function here mirrors one of the kernels in the cuda directory and
+writes its output in place, in the same memory layout, so that the wrappers
+in pyemc.py can dispatch to either backend."""
+import os
+import hashlib
+import tempfile
+import numpy
+from concurrent.futures import ThreadPoolExecutor
+
+
+_NUMBER_OF_THREADS = os.cpu_count() or 1
+_executor = None
+
+SINC_WINDOW_RADIUS = 2
+SINC_SCALING = 0.25
+SINC_TABLE_RESOLUTION = 1024
+
+# Number of rotations times pixels that one thread interpolates at once
+_BATCH_SIZE = 2**14
+
+
+def set_number_of_threads(number_of_threads):
+    global _NUMBER_OF_THREADS, _executor
+    _NUMBER_OF_THREADS = max(int(number_of_threads), 1)
+    if _executor is not None:
+        _executor.shutdown()
+        _executor = None
+
+
+def get_number_of_threads():
+    return _NUMBER_OF_THREADS
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=_NUMBER_OF_THREADS)
+    return _executor
+
+
+def _blocks(number_of_items, number_of_blocks):
+    number_of_blocks = max(min(number_of_blocks, number_of_items), 1)
+    edges = numpy.linspace(0, number_of_items, number_of_blocks+1)
+    edges = numpy.int64(numpy.round(edges))
+    return [slice(start, end) for start, end in zip(edges[:-1], edges[1:])]
+
+
+def parallel_blocks(function, number_of_items):
+    """Split range(number_of_items) in blocks and call function(block) on
+    each of them in the thread pool. Returns the list of return values."""
+    blocks = _blocks(number_of_items, _NUMBER_OF_THREADS)
+    if len(blocks) == 1:
+        return [function(blocks[0])]
+    return list(_get_executor().map(function, blocks))
+
+
+def _flat(array, length):
+    return array.reshape((length, -1))
+
+
+def _segment_positions(start_indices, segments):
+    """Positions of the values of the given CSR segments, in order, and
+    the length of each segment"""
+    start_indices = numpy.int64(start_indices)
+    starts = start_indices[segments]
+    lengths = start_indices[segments+1] - starts
+    positions = (numpy.repeat(starts - numpy.cumsum(lengths) + lengths,
+                              lengths) +
+                 numpy.arange(lengths.sum()))
+    return positions, lengths
+
+
+def _pattern_index(start_indices):
+    """For every stored value, the index of the pattern it belongs to"""
+    counts = numpy.diff(numpy.int64(start_indices))
+    return numpy.repeat(numpy.arange(len(counts)), counts)
+
+
+def _safe_log(values):
+    return numpy.log(numpy.where(values > 0, values, 1))
+
+
+# Interpolation. All model lookups use the kernel convention where a model
+# of dimensions (model_x, model_y, model_z) is stored with index
+# model_z*model_y*x + model_z*y + z.
+#
+# Lookups go through a copy of the model padded with -1. The kernels skip
+# neighbours that are outside of the model or negative and with the
+# padding both become the single test value >= 0. Indices are clipped to
+# the padding so that any coordinate can be looked up.
+
+_PAD = 2*SINC_WINDOW_RADIUS + 1
+
+
+def quaternions_to_matrices(rotations):
+    """Rotation matrices, shape (n, 3, 3), of an (n, 4) quaternion array"""
+    q0, q1, q2, q3 = numpy.float32(rotations).T
+    matrices = numpy.empty((len(q0), 3, 3), dtype="float32")
+    matrices[:, 0, 0] = q0*q0 + q1*q1 - q2*q2 - q3*q3
+    matrices[:, 0, 1] = 2*q1*q2 - 2*q0*q3
+    matrices[:, 0, 2] = 2*q1*q3 + 2*q0*q2
+    matrices[:, 1, 0] = 2*q1*q2 + 2*q0*q3
+    matrices[:, 1, 1] = q0*q0 - q1*q1 + q2*q2 - q3*q3
+    matrices[:, 1, 2] = 2*q2*q3 - 2*q0*q1
+    matrices[:, 2, 0] = 2*q1*q3 - 2*q0*q2
+    matrices[:, 2, 1] = 2*q2*q3 + 2*q0*q1
+    matrices[:, 2, 2] = q0*q0 - q1*q1 - q2*q2 + q3*q3
+    return matrices
+
+
+def quaternion_to_matrix(rotation):
+    return quaternions_to_matrices(
+        numpy.asarray(rotation)[numpy.newaxis, :])[0]
+
+
+def _rotated_coordinates(matrices, coordinates, model_dims):
+    """Model coordinates of shape (3, n, pixels) for n rotation matrices"""
+    new_coordinates = numpy.matmul(matrices, coordinates).transpose(1, 0, 2)
+    for axis in range(3):
+        new_coordinates[axis] += numpy.float32(model_dims[axis]/2. - 0.5)
+    return new_coordinates
+
+
+def _batches(block, batch_length):
+    for start in range(block.start, block.stop, batch_length):
+        yield slice(start, min(start + batch_length, block.stop))
+
+
+def pad_model(model_flat, model_dims):
+    padded = numpy.pad(model_flat.reshape(model_dims), _PAD,
+                       constant_values=-1.)
+    return padded.reshape(-1)
+
+
+def _crop_model(padded_flat, model_dims):
+    padded_dims = tuple(side + 2*_PAD for side in model_dims)
+    inner = (slice(_PAD, -_PAD), )*3
+    return padded_flat.reshape(padded_dims)[inner].reshape(-1)
+
+
+def _padded_strides(model_dims):
+    return ((model_dims[1] + 2*_PAD)*(model_dims[2] + 2*_PAD),
+            model_dims[2] + 2*_PAD, 1)
+
+
+def _padded_offset(indices, side, stride):
+    """Offset along one axis into the padded model"""
+    offset = numpy.minimum(numpy.maximum(indices, -_PAD), side + _PAD - 1)
+    offset += _PAD
+    offset *= stride
+    return offset
+
+
+def _neighbours(axes):
+    """Combine the offsets and weights along each axis to the offset and
+    weight of every neighbour"""
+    for offset_x, weight_x in axes[0]:
+        for offset_y, weight_y in axes[1]:
+            offset_xy = offset_x + offset_y
+            weight_xy = weight_x*weight_y
+            for offset_z, weight_z in axes[2]:
+                yield offset_xy + offset_z, weight_xy*weight_z
+
+
+def _interpolate(padded_model, neighbours, shape):
+    interp_sum = numpy.zeros(shape, dtype="float32")
+    interp_weight = numpy.zeros(shape, dtype="float32")
+    for offset, weight in neighbours:
+        value = padded_model[offset]
+        weight = numpy.where(value >= 0., weight, numpy.float32(0.))
+        interp_sum += weight*value
+        interp_weight += weight
+    return _normalize_interpolation(interp_sum, interp_weight)
+
+
+def _normalize_interpolation(interp_sum, interp_weight):
+    result = numpy.full(interp_sum.shape, -1., dtype="float32")
+    numpy.divide(interp_sum, interp_weight, out=result,
+                 where=interp_weight > 0.)
+    return result
+
+
+def _linear_axis(coordinate, side, stride):
+    """Vectorized device_interpolate_get_coordinate_weight. Neighbours
+    the kernel gives zero weight or rejects fall in the padding."""
+    coordinate_ceil = numpy.ceil(coordinate)
+    low = numpy.int64(coordinate_ceil) - 1
+    low_weight = coordinate_ceil - coordinate
+    return ((_padded_offset(low, side, stride), low_weight),
+            (_padded_offset(low + 1, side, stride), 1 - low_weight))
+
+
+def _linear_neighbours(new_coordinates, model_dims):
+    return _neighbours([_linear_axis(coordinate, side, stride)
+                        for coordinate, side, stride
+                        in zip(new_coordinates, model_dims,
+                               _padded_strides(model_dims))])
+
+
+def get_linear(padded_model, model_dims, new_coordinates):
+    return _interpolate(padded_model,
+                        _linear_neighbours(new_coordinates, model_dims),
+                        new_coordinates.shape[1:])
+
+
+def _nn_offset(new_coordinates, model_dims):
+    # The kernels cast with (int)(x + 0.5) which truncates towards zero
+    indices = numpy.int64(numpy.trunc(new_coordinates + 0.5))
+    return sum(_padded_offset(axis_indices, side, stride)
+               for axis_indices, side, stride
+               in zip(indices, model_dims, _padded_strides(model_dims)))
+
+
+def get_nn(padded_model, model_dims, new_coordinates):
+    return padded_model[_nn_offset(new_coordinates, model_dims)]
+
+
+def _sinc_weight(distance):
+    # The continuous limit at 0, the kernels' weight of 1 at exactly 0 is
+    # applied outside the table
+    nonzero_distance = numpy.where(distance == 0, 1., distance)
+    return numpy.where(
+        distance == 0, SINC_SCALING*3.1416,
+        numpy.sin(SINC_SCALING*3.1416*distance) / nonzero_distance)
+
+
+def _make_sinc_table():
+    # The window starts at trunc(coordinate - radius + 0.5) so the distance
+    # from the first window point to the coordinate always lies in
+    # [radius - 1.5, radius + 0.5]. Entry [offset, i] is the weight of
+    # window point offset at distance radius - 1.5 + i/resolution.
+    first_distance = (SINC_WINDOW_RADIUS - 1.5 +
+                      numpy.arange(2*SINC_TABLE_RESOLUTION + 1) /
+                      SINC_TABLE_RESOLUTION)
+    offsets = numpy.arange(2*SINC_WINDOW_RADIUS + 1)
+    return numpy.float32(_sinc_weight(offsets[:, numpy.newaxis] -
+                                      first_distance[numpy.newaxis, :]))
+
+
+_sinc_table = _make_sinc_table()
+_sinc_table_slope = numpy.diff(_sinc_table, axis=1)
+
+
+def _sinc_axis(coordinate, side, stride):
+    """Offset and weight of the sinc window along one axis, with the
+    weights linearly interpolated from the table"""
+    start = numpy.int64(numpy.trunc(coordinate - SINC_WINDOW_RADIUS + 0.5))
+    end = numpy.int64(numpy.trunc(coordinate + SINC_WINDOW_RADIUS + 0.5))
+    position = ((coordinate - start - (SINC_WINDOW_RADIUS - 1.5)) *
+                SINC_TABLE_RESOLUTION)
+    table_index = numpy.clip(numpy.int64(position), 0,
+                             2*SINC_TABLE_RESOLUTION - 1)
+    fraction = numpy.float32(position - table_index)
+    window = []
+    for offset in range(2*SINC_WINDOW_RADIUS+1):
+        weight = (_sinc_table[offset][table_index] +
+                  fraction*_sinc_table_slope[offset][table_index])
+        weight[start + offset == coordinate] = 1.
+        weight[start + offset > end] = 0.
+        window.append((_padded_offset(start + offset, side, stride),
+                       weight))
+    return window
+
+
+def _sinc_neighbours(new_coordinates, model_dims):
+    return _neighbours([_sinc_axis(coordinate, side, stride)
+                        for coordinate, side, stride
+                        in zip(new_coordinates, model_dims,
+                               _padded_strides(model_dims))])
+
+
+def get_sinc(padded_model, model_dims, new_coordinates):
+    return _interpolate(padded_model,
+                        _sinc_neighbours(new_coordinates, model_dims),
+                        new_coordinates.shape[1:])
+
+
+_get_functions = {1: get_nn, 2: get_linear, 3: get_sinc}
+
+
+def _kernel_model_dims(model):
+    # The wrappers pass the model shape reversed to the kernels
+    return (model.shape[2], model.shape[1], model.shape[0])
+
+
+def _pixel_neighbours(new_coordinates, model_dims, interpolation):
+    """Offset into the padded model and weight of every neighbour used to
+    interpolate each pixel"""
+    if interpolation == 1:
+        return [(_nn_offset(new_coordinates, model_dims), numpy.float32(1.))]
+    elif interpolation == 2:
+        return _linear_neighbours(new_coordinates, model_dims)
+    else:
+        return _sinc_neighbours(new_coordinates, model_dims)
+
+
+_NUMBER_OF_NEIGHBOURS = {1: 1, 2: 8, 3: (2*SINC_WINDOW_RADIUS + 1)**3}
+
+
+class InterpolationTables:
+    """Cache of the neighbour offsets and weights of every pixel for a set
+    of rotations, so that expand_model and insert_slices only gather from
+    and scatter-add to the model. expand_model creates tables of the
+    rotations it is asked to keep a table of until max_bytes are used, in
+    memory or in memory mapped files in directory. Rotations that are only
+    used once would fill the budget, so only ask for rotations that come
+    back. insert_slices uses a table when it gets the same rotations as an
+    earlier expand_model. Tables of sinc interpolation are large."""
+    def __init__(self):
+        self._max_bytes = 0
+        self._directory = None
+        self.clear()
+
+    def set_budget(self, max_bytes, directory=None):
+        """A budget of 0 turns the tables off"""
+        self.clear()
+        self._max_bytes = int(max_bytes)
+        self._directory = directory
+
+    def clear(self):
+        self._tables = {}
+        self.used_bytes = 0
+
+    def _key(self, rotations, coordinates_flat, model_dims, interpolation):
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(numpy.ascontiguousarray(rotations).tobytes())
+        digest.update(numpy.ascontiguousarray(coordinates_flat).tobytes())
+        return (digest.digest(), len(rotations), coordinates_flat.shape,
+                tuple(model_dims), interpolation)
+
+    def _allocate(self, shape, dtype):
+        if self._directory is None:
+            return numpy.empty(shape, dtype=dtype)
+        # The file is removed as soon as the array is released
+        backing_file = tempfile.TemporaryFile(dir=self._directory)
+        return numpy.memmap(backing_file, dtype=dtype, mode="w+",
+                            shape=shape)
+
+    def get(self, rotations, coordinates_flat, model_dims, interpolation,
+            create=False):
+        """The (offsets, weights) table, each of shape (neighbours,
+        rotations, pixels), or None"""
+        if self._max_bytes <= 0:
+            return None
+        key = self._key(rotations, coordinates_flat, model_dims,
+                        interpolation)
+        if key not in self._tables and create:
+            shape = (_NUMBER_OF_NEIGHBOURS[interpolation], len(rotations),
+                     coordinates_flat.shape[1])
+            table_bytes = 8*numpy.prod(shape)
+            if self.used_bytes + table_bytes > self._max_bytes:
+                return None
+            self._tables[key] = self._create(shape, rotations,
+                                             coordinates_flat, model_dims,
+                                             interpolation)
+            self.used_bytes += table_bytes
+        return self._tables.get(key)
+
+    def _create(self, shape, rotations, coordinates_flat, model_dims,
+                interpolation):
+        offsets = self._allocate(shape, "int32")
+        weights = self._allocate(shape, "float32")
+        batch_length = max(_BATCH_SIZE // coordinates_flat.shape[1], 1)
+
+        def fill_block(block):
+            for batch in _batches(block, batch_length):
+                new_coordinates = _rotated_coordinates(
+                    quaternions_to_matrices(rotations[batch]),
+                    coordinates_flat, model_dims)
+                for index, (offset, weight) in enumerate(_pixel_neighbours(
+                        new_coordinates, model_dims, interpolation)):
+                    offsets[index, batch] = offset
+                    weights[index, batch] = weight
+
+        parallel_blocks(fill_block, len(rotations))
+        return offsets, weights
+
+
+interpolation_tables = InterpolationTables()
+
+
+def expand_model(model, slices, rotations, coordinates, interpolation,
+                 keep_table=False):
+    model_dims = _kernel_model_dims(model)
+    padded_model = pad_model(model.reshape(-1), model_dims)
+    coordinates_flat = coordinates.reshape((3, -1))
+    get_function = _get_functions[interpolation]
+    batch_length = max(_BATCH_SIZE // coordinates_flat.shape[1], 1)
+    table = interpolation_tables.get(rotations, coordinates_flat, model_dims,
+                                     interpolation, create=keep_table)
+
+    def expand_block(block):
+        for batch in _batches(block, batch_length):
+            if table is None:
+                matrices = quaternions_to_matrices(rotations[batch])
+                new_coordinates = _rotated_coordinates(matrices,
+                                                       coordinates_flat,
+                                                       model_dims)
+                expanded = get_function(padded_model, model_dims,
+                                        new_coordinates)
+            elif interpolation == 1:
+                expanded = padded_model[table[0][0, batch]]
+            else:
+                offsets, weights = table[0][:, batch], table[1][:, batch]
+                expanded = _interpolate(padded_model, zip(offsets, weights),
+                                        offsets.shape[1:])
+            slices[batch] = expanded.reshape((-1, ) + slices.shape[1:])
+
+    parallel_blocks(expand_block, len(rotations))
+
+
+def _insert_neighbours(padded_model, neighbours, interpolation):
+    if interpolation != 3:
+        yield from neighbours
+    else:
+        # The sinc kernel only inserts where the model is not masked
+        for offset, weight in neighbours:
+            yield offset, numpy.where(padded_model[offset] >= 0., weight,
+                                      numpy.float32(0.))
+
+
+def _insert_block(padded_model, slices_flat, slice_weights, block,
+                  batch_length, neighbours_function, interpolation):
+    """Sum of the inserted values and weights of a block of slices, in
+    the padded layout"""
+    block_sum = numpy.zeros(padded_model.size)
+    block_weight = numpy.zeros(padded_model.size)
+    for batch in _batches(block, batch_length):
+        values = slices_flat[batch]
+        # Negative slice values are not inserted
+        batch_weights = numpy.float32(slice_weights[batch])
+        point_weights = numpy.where(values >= 0.,
+                                    batch_weights[:, numpy.newaxis],
+                                    numpy.float32(0.))
+        for offset, weight in _insert_neighbours(
+                padded_model, neighbours_function(batch), interpolation):
+            # numpy.bincount would touch the whole model for every
+            # neighbour, numpy.add.at only the points
+            weight = weight*point_weights
+            offset = offset.ravel()
+            numpy.add.at(block_sum, offset, (weight*values).ravel())
+            numpy.add.at(block_weight, offset, weight.ravel())
+    return block_sum, block_weight
+
+
+def _add_blocks(model, model_weights, model_dims, block_results):
+    for block_sum, block_weight in block_results:
+        model += numpy.float32(
+            _crop_model(block_sum, model_dims)).reshape(model.shape)
+        model_weights += numpy.float32(
+            _crop_model(block_weight, model_dims)).reshape(model.shape)
+
+
+def insert_slices(model, model_weights, slices, slice_weights, rotations,
+                  coordinates, interpolation):
+    model_dims = _kernel_model_dims(model)
+    padded_model = pad_model(model.reshape(-1), model_dims)
+    coordinates_flat = coordinates.reshape((3, -1))
+    slices_flat = _flat(slices, len(slices))
+    batch_length = max(_BATCH_SIZE // coordinates_flat.shape[1], 1)
+    table = interpolation_tables.get(rotations, coordinates_flat, model_dims,
+                                     interpolation)
+
+    def neighbours(batch):
+        if table is not None:
+            return zip(table[0][:, batch], table[1][:, batch])
+        new_coordinates = _rotated_coordinates(
+            quaternions_to_matrices(rotations[batch]), coordinates_flat,
+            model_dims)
+        return _pixel_neighbours(new_coordinates, model_dims, interpolation)
+
+    def insert_block(block):
+        return _insert_block(padded_model, slices_flat, slice_weights, block,
+                             batch_length, neighbours, interpolation)
+
+    _add_blocks(model, model_weights, model_dims,
+                parallel_blocks(insert_block, len(rotations)))
+
+
+def _rotation_2d(rotations, image_shape, model_shape):
+    """Model coordinates of shape (3, n, pixels) for n in-plane angles"""
+    x = numpy.arange(image_shape[0], dtype="float32") - image_shape[0]/2 + 0.5
+    y = numpy.arange(image_shape[1], dtype="float32") - image_shape[1]/2 + 0.5
+    x, y = numpy.meshgrid(x, y, indexing="ij")
+    x = x.reshape(1, -1)
+    y = y.reshape(1, -1)
+    cos = numpy.float32(numpy.cos(rotations)).reshape(-1, 1)
+    sin = numpy.float32(numpy.sin(rotations)).reshape(-1, 1)
+    new_x = cos*x - sin*y + numpy.float32(model_shape[0]/2 - 0.5)
+    new_y = sin*x + cos*y + numpy.float32(model_shape[1]/2 - 0.5)
+    # Use a dummy third axis of length one so that the 3D helpers apply
+    return numpy.array([new_x, new_y, numpy.zeros_like(new_x)])
+
+
+def _model_dims_2d(model):
+    return (model.shape[0], model.shape[1], 1)
+
+
+def expand_model_2d(model, slices, rotations):
+    model_dims = _model_dims_2d(model)
+    padded_model = pad_model(model.reshape(-1), model_dims)
+    batch_length = max(_BATCH_SIZE // (slices.shape[1]*slices.shape[2]), 1)
+
+    def expand_block(block):
+        for batch in _batches(block, batch_length):
+            new_coordinates = _rotation_2d(rotations[batch],
+                                           slices.shape[1:], model.shape)
+            slices[batch] = get_linear(
+                padded_model, model_dims,
+                new_coordinates).reshape((-1, ) + slices.shape[1:])
+
+    parallel_blocks(expand_block, len(rotations))
+
+
+def insert_slices_2d(model, model_weights, slices, slice_weights, rotations,
+                     interpolation):
+    model_dims = _model_dims_2d(model)
+    padded_model = pad_model(model.reshape(-1), model_dims)
+    slices_flat = _flat(slices, len(slices))
+    batch_length = max(_BATCH_SIZE // slices_flat.shape[1], 1)
+    # The 2D kernel only has nearest and linear interpolation
+    if interpolation != 1:
+        interpolation = 2
+
+    def neighbours(batch):
+        new_coordinates = _rotation_2d(rotations[batch], slices.shape[1:],
+                                       model.shape)
+        return _pixel_neighbours(new_coordinates, model_dims, interpolation)
+
+    def insert_block(block):
+        return _insert_block(padded_model, slices_flat, slice_weights, block,
+                             batch_length, neighbours, interpolation)
+
+    _add_blocks(model, model_weights, model_dims,
+                parallel_blocks(insert_block, len(rotations)))
+
+
+def rotate_model(model, rotated_model, rotation):
+    # kernel_rotate_model uses the model shape in its natural order
+    model_dims = model.shape
+    axes = [numpy.arange(side, dtype="float32") - side/2 + 0.5
+            for side in model_dims]
+    start = numpy.array([a.ravel() for a in numpy.meshgrid(*axes,
+                                                           indexing="ij")])
+    new_coordinates = quaternion_to_matrix(rotation) @ start
+    for axis in range(3):
+        new_coordinates[axis] += model_dims[axis]/2 - 0.5
+    rotated_model[...] = get_linear(pad_model(model.reshape(-1), model_dims),
+                                    model_dims,
+                                    new_coordinates).reshape(model.shape)
+
+
+def blur_model(model, sigma, cutoff):
+    padded = numpy.pad(model, cutoff, constant_values=-1.)
+    valid = padded >= 0.
+    padded = numpy.where(valid, padded, 0.)
+    blur_sum = numpy.zeros(model.shape, dtype="float32")
+    blur_weight = numpy.zeros(model.shape, dtype="float32")
+    for offsets in numpy.ndindex((2*cutoff+1, )*3):
+        distance_squared = sum((o - cutoff)**2 for o in offsets)
+        weight = numpy.float32(numpy.exp(-distance_squared / (2*sigma**2)))
+        window = tuple(slice(o, o+s) for o, s in zip(offsets, model.shape))
+        blur_sum += weight*padded[window]
+        blur_weight += weight*valid[window]
+    blurred = _normalize_interpolation(blur_sum, blur_weight)
+    blurred[model < 0] = -1.
+    return blurred
+
+
+# Responsabilities
+
+def sum_slices(slices):
+    slices_flat = _flat(slices, len(slices))
+    return numpy.where(slices_flat > 0., slices_flat, 0.).sum(axis=1)
+
+
+def _shared_rows(matrix):
+    """True if all rows of matrix are the same"""
+    return bool((matrix == matrix[:1]).all())
+
+
+def pattern_terms(patterns, log_factorial_table):
+    """Per pixel terms of a pattern set that the functions here use. They
+    are made once with the pattern set by pyemc.pattern_constants. For
+    dense patterns these are the photon counts and their log factorials
+    as float32 matrices, zero at masked out pixels, and the validity of
+    the pixels, None when all pixels are valid. For sparse patterns
+    these are the stored values and their log factorials as float32 and
+    the order of the stored values by pixel, for update_slices_sparse."""
+    if isinstance(patterns, dict):
+        number_of_pixels = int(numpy.prod(patterns["shape"]))
+        return {"values": numpy.float32(patterns["values"]),
+                "log_factorials": numpy.float32(
+                    log_factorial_table[patterns["values"]]),
+                "pixel_order": _sparse_pixel_order(patterns,
+                                                   number_of_pixels)}
+    patterns_flat = _flat(patterns, len(patterns))
+    pattern_valid = patterns_flat >= 0
+    counts = numpy.where(pattern_valid, patterns_flat, 0)
+    return {"counts": numpy.float32(counts),
+            "log_factorials": (None if log_factorial_table is None
+                               else numpy.float32(
+                                   log_factorial_table[counts])),
+            "valid": (None if pattern_valid.all()
+                      else numpy.float32(pattern_valid))}
+
+
+def select_pattern_terms(terms, patterns, indices):
+    """The terms of the patterns with the given indices. Subsets have no
+    pixel order."""
+    if "counts" not in terms:
+        positions, _ = _segment_positions(patterns["start_indices"],
+                                          indices)
+        return {"values": terms["values"][positions],
+                "log_factorials": terms["log_factorials"][positions],
+                "pixel_order": None}
+    return {key: None if value is None else value[indices]
+            for key, value in terms.items()}
+
+
+# Elements of pattern terms cast to float64 at once
+_FLOAT64_BATCH_SIZE = 2**22
+
+
+def _product_float64(left, right):
+    """left @ right.T accumulated in float64. right is cast in batches of
+    rows, so that only a batch of it is held as float64."""
+    left = numpy.float64(left)
+    product = numpy.empty((len(left), len(right)))
+    batch_length = max(_FLOAT64_BATCH_SIZE // max(right.shape[1], 1), 1)
+    for batch in _batches(slice(0, len(right)), batch_length):
+        product[:, batch] = left @ numpy.float64(right[batch]).T
+    return product
+
+
+def calculate_responsabilities_poisson_dense(patterns, slices,
+                                             responsabilities,
+                                             log_factorial_table,
+                                             constants, scalings=None):
+    """The sum over pixels of -s/c + k log(s/c) - log k! splits into
+    matrix products of slice terms and pattern terms, which run in BLAS.
+    Pixels count where the pattern is >= 0 and the slice > 0. The log
+    factorial and photon sums are the pattern constants, less the pixels
+    where the slices are not valid, which are only looked up at the
+    pixels that are invalid in any of the slices. The sums are large
+    and nearly cancel, so they are accumulated in float64."""
+    terms = constants["terms"]
+    slices_flat = _flat(slices, len(slices))
+    slice_valid = slices_flat > 0.
+    slice_values = numpy.where(slice_valid, slices_flat, 0.)
+    log_slices = _safe_log(numpy.float64(slices_flat))
+
+    count_log_slice = _product_float64(log_slices, terms["counts"])
+    if terms["valid"] is None:
+        slice_sum = slice_values.sum(axis=1, dtype="float64")[:,
+                                                             numpy.newaxis]
+    else:
+        slice_sum = _product_float64(slice_values, terms["valid"])
+
+    log_factorial_sum = constants["log_factorial_sums"][numpy.newaxis]
+    photons = constants["photons"][numpy.newaxis]
+    # Usually only the mask and the edges of the model make slices invalid
+    invalid = numpy.flatnonzero(~slice_valid.all(axis=0))
+    if len(invalid) > 0:
+        slice_invalid = ~slice_valid[:, invalid]
+        log_factorial_sum = log_factorial_sum - _product_float64(
+            slice_invalid, terms["log_factorials"][:, invalid])
+        if scalings is not None:
+            photons = photons - _product_float64(
+                slice_invalid, terms["counts"][:, invalid])
+
+    if scalings is None:
+        responsabilities[...] = (count_log_slice - slice_sum -
+                                 log_factorial_sum)
+    else:
+        # Per pattern scalings broadcast over the slices
+        responsabilities[...] = (count_log_slice - slice_sum / scalings -
+                                 numpy.log(scalings) * photons -
+                                 log_factorial_sum)
+
+
+def _segment_sums(values, start_indices):
+    """Sums over the last axis of values in the segments given by CSR
+    start_indices. Empty segments sum to zero."""
+    counts = numpy.diff(numpy.int64(start_indices))
+    sums = numpy.zeros(values.shape[:-1] + (len(counts), ),
+                       dtype=values.dtype)
+    nonempty = numpy.flatnonzero(counts)
+    if len(nonempty) > 0:
+        # Consecutive nonempty segments are contiguous in values
+        sums[..., nonempty] = numpy.add.reduceat(
+            values, numpy.int64(start_indices)[nonempty], axis=-1)
+    return sums
+
+
+# Number of slices times stored values gathered at once
+_SPARSE_BATCH_SIZE = 2**22
+
+
+def _sparse_entries(patterns, terms):
+    """The stored values of sparse patterns as (start_indices, indices,
+    values, log factorials), with float32 values and log factorials from
+    the pattern terms. Values and log factorials of None are the ones of
+    sparser patterns."""
+    entries = [(patterns["start_indices"], patterns["indices"],
+                terms["values"], terms["log_factorials"])]
+    if "ones_indices" in patterns:
+        entries.append((patterns["ones_start_indices"],
+                        patterns["ones_indices"], None, None))
+    return entries
+
+
+def calculate_responsabilities_poisson_sparse(patterns, slices,
+                                              responsabilities,
+                                              log_factorial_table,
+                                              constants, scalings=None):
+    """Sparse times dense. The log of the slices is taken once per call
+    and the photon term, sum of k log(s), of all patterns is gathered from
+    it for a batch of slices at a time and summed per pattern. The ones of
+    sparser patterns add the same sum without values. The log factorial
+    and photon sums are the pattern constants, less the pixels where the
+    slices are not valid."""
+    entries = _sparse_entries(patterns, constants["terms"])
+    slices_flat = _flat(slices, len(slices))
+    slice_sums = sum_slices(slices)
+    log_slices = numpy.float32(_safe_log(slices_flat))
+    slice_valid = slices_flat > 0.
+    shared_valid = _shared_rows(slice_valid)
+
+    def pattern_sums(pixels):
+        """Photons and log factorials of each pattern at the given
+        pixels"""
+        photons = 0.
+        log_factorial_sum = 0.
+        for start_indices, indices, values, log_factorials in entries:
+            this_pixels = numpy.float32(pixels[..., indices])
+            if values is None:
+                photons = photons + _segment_sums(this_pixels, start_indices)
+            else:
+                photons = photons + _segment_sums(this_pixels*values,
+                                                  start_indices)
+                log_factorial_sum = log_factorial_sum + _segment_sums(
+                    this_pixels*log_factorials, start_indices)
+        return photons, log_factorial_sum
+
+    if shared_valid:
+        # Usually only the mask makes slices invalid
+        log_factorial_sum = constants["log_factorial_sums"]
+        photons = constants["photons"]
+        if not slice_valid[0].all():
+            invalid_photons, invalid_log_factorials = pattern_sums(
+                ~slice_valid[0])
+            log_factorial_sum = log_factorial_sum - invalid_log_factorials
+            photons = photons - invalid_photons
+        shared_sums = (photons[numpy.newaxis],
+                       log_factorial_sum[numpy.newaxis])
+
+    number_of_values = sum(len(entry[1]) for entry in entries)
+    batch_length = max(_SPARSE_BATCH_SIZE // max(number_of_values, 1), 1)
+
+    def responsabilities_block(block):
+        for batch in _batches(block, batch_length):
+            if scalings is None:
+                result = -slice_sums[batch, numpy.newaxis]
+            else:
+                this_scaling = (scalings[batch] if len(scalings.shape) == 2
+                                else scalings[numpy.newaxis])
+                result = -slice_sums[batch, numpy.newaxis] / this_scaling
+            for start_indices, indices, values, _ in entries:
+                gathered = log_slices[batch][:, indices]
+                if values is not None:
+                    gathered *= values
+                result = result + _segment_sums(gathered, start_indices)
+            if shared_valid:
+                photons, log_factorial_sum = shared_sums
+            else:
+                photons, log_factorial_sum = pattern_sums(slice_valid[batch])
+            result = result - log_factorial_sum
+            if scalings is not None:
+                result = result - numpy.log(this_scaling) * photons
+            responsabilities[batch] = result
+
+    parallel_blocks(responsabilities_block, len(slices))
+
+
+def calculate_responsabilities_gaussian_dense(patterns, slices,
+                                              responsabilities):
+    patterns_flat = _flat(patterns, len(patterns))
+    slices_flat = _flat(slices, len(slices))
+    pattern_valid = patterns_flat >= 0
+
+    def responsabilities_block(block):
+        for index in range(block.start, block.stop):
+            this_slice = slices_flat[index][numpy.newaxis, :]
+            valid = pattern_valid & (this_slice > 0.)
+            safe_slice = numpy.where(this_slice > 0., this_slice, 1.)
+            responsabilities[index] = -numpy.where(
+                valid, (patterns_flat - this_slice)**2 / (2*safe_slice),
+                0.).sum(axis=1)
+
+    parallel_blocks(responsabilities_block, len(slices))
+
+
+# Scaling
+
+def _dense_scaling_sums(slices, constants):
+    """Sums of the slice values and of the photons at the pixels where
+    both the pattern and the slice are valid, for all slice and pattern
+    pairs. The pattern sums are the photon totals of the constants when no
+    slice pixel is masked out, and computed once for all slices when they
+    share the masked out pixels. The results broadcast to (slices,
+    patterns)."""
+    terms = constants["terms"]
+    slices_flat = _flat(slices, len(slices))
+    slice_valid = slices_flat >= 0.
+    slice_values = numpy.where(slice_valid, slices_flat, numpy.float32(0.))
+    if terms["valid"] is None:
+        sum_slice = slice_values.sum(axis=1, dtype="float64")
+        sum_slice = sum_slice[:, numpy.newaxis]
+    else:
+        sum_slice = slice_values @ terms["valid"].T
+    if _shared_rows(slice_valid) and slice_valid[0].all():
+        sum_pattern = constants["photons"][numpy.newaxis]
+    elif _shared_rows(slice_valid):
+        sum_pattern = terms["counts"] @ numpy.float32(slice_valid[0])
+        sum_pattern = sum_pattern[numpy.newaxis]
+    else:
+        sum_pattern = numpy.float32(slice_valid) @ terms["counts"].T
+    return sum_slice, sum_pattern
+
+
+def calculate_scaling_poisson_dense(patterns, slices, scaling, constants):
+    sum_slice, sum_pattern = _dense_scaling_sums(slices, constants)
+    scaling[...] = _scaling_quotient(sum_slice, sum_pattern)
+
+
+def _scaling_quotient(sum_slice, sum_pattern):
+    shape = numpy.broadcast_shapes(numpy.shape(sum_slice),
+                                   numpy.shape(sum_pattern))
+    result = numpy.ones(shape, dtype="float32")
+    numpy.divide(sum_slice, sum_pattern, out=result,
+                 where=numpy.broadcast_to(sum_pattern > 0, shape))
+    return result
+
+
+def _sparse_scaling_sums(patterns, slices, slice_valid, constants):
+    """Sums of the slice values where the slice is >= 0 and of the photons
+    where slice_valid is true, for all slice and pattern pairs. The pattern
+    sums are the photon totals of the constants when all pixels are valid,
+    and computed once for all slices when they share the invalid pixels.
+    The results broadcast to (slices, patterns)."""
+    entries = _sparse_entries(patterns, constants["terms"])
+    slices_flat = _flat(slices, len(slices))
+    sum_slice = numpy.where(slices_flat >= 0., slices_flat,
+                            numpy.float32(0.)).sum(axis=1, dtype="float64")
+    sum_slice = sum_slice[:, numpy.newaxis]
+
+    def valid_photons(valid):
+        photons = 0.
+        for start_indices, indices, values, _ in entries:
+            this_valid = numpy.float32(valid[..., indices])
+            photons = photons + _segment_sums(
+                this_valid if values is None else this_valid*values,
+                start_indices)
+        return photons
+
+    if _shared_rows(slice_valid):
+        if slice_valid[0].all():
+            return sum_slice, constants["photons"][numpy.newaxis]
+        return sum_slice, valid_photons(slice_valid[0])[numpy.newaxis]
+
+    number_of_values = sum(len(entry[1]) for entry in entries)
+    batch_length = max(_SPARSE_BATCH_SIZE // max(number_of_values, 1), 1)
+    sum_pattern = numpy.zeros((len(slices), len(constants["photons"])),
+                              dtype="float32")
+
+    def sums_block(block):
+        for batch in _batches(block, batch_length):
+            sum_pattern[batch] = valid_photons(slice_valid[batch])
+
+    parallel_blocks(sums_block, len(slices))
+    return sum_slice, sum_pattern
+
+
+def calculate_scaling_poisson_sparse(patterns, slices, scaling, constants):
+    # The kernels test the slice value for being nonzero here
+    slices_flat = _flat(slices, len(slices))
+    sum_slice, sum_pattern = _sparse_scaling_sums(
+        patterns, slices, slices_flat != 0., constants)
+    scaling[...] = _scaling_quotient(sum_slice, sum_pattern)
+
+
+def _scaling_per_pattern(responsabilities, sum_slice, sum_pattern):
+    """Scaling of each pattern from the responsability weighted sums over
+    all slices"""
+    sum_nominator = (responsabilities * sum_slice).sum(axis=0,
+                                                       dtype="float64")
+    sum_denominator = (responsabilities * sum_pattern).sum(axis=0,
+                                                           dtype="float64")
+    return _scaling_quotient(sum_nominator, sum_denominator)
+
+
+def calculate_scaling_per_pattern_poisson_dense(patterns, slices,
+                                                responsabilities, scaling,
+                                                constants):
+    sum_slice, sum_pattern = _dense_scaling_sums(slices, constants)
+    scaling[...] = _scaling_per_pattern(responsabilities, sum_slice,
+                                        sum_pattern)
+
+
+def calculate_scaling_per_pattern_poisson_sparse(patterns, slices,
+                                                 responsabilities, scaling,
+                                                 constants):
+    slices_flat = _flat(slices, len(slices))
+    sum_slice, sum_pattern = _sparse_scaling_sums(
+        patterns, slices, slices_flat >= 0., constants)
+    scaling[...] = _scaling_per_pattern(responsabilities, sum_slice,
+                                        sum_pattern)
+
+
+# Update slices
+
+def _nonzero_rows(responsabilities):
+    """Rotations with any nonzero responsability. The others get no
+    contribution from any pattern."""
+    return numpy.flatnonzero((responsabilities != 0.).any(axis=1))
+
+
+def update_slices_dense(slices, patterns, responsabilities, constants,
+                        scalings=None):
+    """The weighted sums of all slices are one matrix product of the
+    responsabilities and the patterns, and the weights one of the
+    responsabilities and the pattern validity."""
+    terms = constants["terms"]
+    rows = _nonzero_rows(responsabilities)
+    slices[...] = -1.
+    if len(rows) == 0:
+        return
+    this_resp = numpy.float32(responsabilities[rows])
+    if scalings is None:
+        weighted_resp = this_resp
+    elif len(scalings.shape) == 2:
+        weighted_resp = this_resp * scalings[rows]
+    else:
+        weighted_resp = this_resp * scalings
+    slice_sum = weighted_resp @ terms["counts"]
+    if terms["valid"] is None:
+        slice_weight = numpy.broadcast_to(
+            this_resp.sum(axis=1)[:, numpy.newaxis], slice_sum.shape)
+    else:
+        slice_weight = this_resp @ terms["valid"]
+    slices[rows] = _normalize_interpolation(
+        slice_sum, slice_weight).reshape((len(rows), ) + slices.shape[1:])
+
+
+def _sparse_pixel_order(patterns, number_of_pixels):
+    """The stored values of sparse patterns reordered by pixel, as
+    (pixel start indices, pattern index, values), with values of None for
+    the ones of sparser patterns."""
+    keys = [("start_indices", "indices", "values")]
+    if "ones_indices" in patterns:
+        keys.append(("ones_start_indices", "ones_indices", None))
+    entries = []
+    for start_key, indices_key, values_key in keys:
+        indices = patterns[indices_key]
+        order = numpy.argsort(indices, kind="stable")
+        pixel_start_indices = numpy.zeros(number_of_pixels + 1,
+                                          dtype="int64")
+        numpy.cumsum(numpy.bincount(indices, minlength=number_of_pixels),
+                     out=pixel_start_indices[1:])
+        values = (None if values_key is None
+                  else numpy.float32(patterns[values_key][order]))
+        entries.append((pixel_start_indices,
+                        _pattern_index(patterns[start_key])[order],
+                        values))
+    return entries
+
+
+def update_slices_sparse(slices, patterns, responsabilities, constants,
+                         scalings=None, resp_threshold=0.):
+    """Responsabilities times patterns, with the patterns ordered by pixel
+    so that the product is a gather of the responsabilities followed by
+    sums per pixel, for a batch of rotations at a time. The pixel order
+    comes with the pattern terms, except for subsets of patterns."""
+    entries = constants["terms"].get("pixel_order")
+    if entries is None:
+        entries = _sparse_pixel_order(patterns,
+                                      slices.shape[1]*slices.shape[2])
+    sparser = len(entries) > 1
+    per_pattern_scaling = scalings is not None and len(scalings.shape) == 1
+    rows = _nonzero_rows(responsabilities)
+    slices_flat = _flat(slices, len(slices))
+    slices_flat[...] = 0.
+
+    number_of_values = sum(len(entry[1]) for entry in entries)
+    batch_length = max(_SPARSE_BATCH_SIZE // max(number_of_values, 1), 1)
+
+    def update_block(block):
+        for batch in _batches(block, batch_length):
+            batch_rows = rows[batch]
+            this_resp = responsabilities[batch_rows]
+            if per_pattern_scaling:
+                # The per pattern kernel does not use the threshold
+                weighted_resp = this_resp * scalings
+            else:
+                weighted_resp = numpy.where(this_resp > resp_threshold,
+                                            this_resp, numpy.float32(0.))
+                if scalings is not None:
+                    weighted_resp = weighted_resp * scalings[batch_rows]
+            pixel_start_indices, pattern_index, values = entries[0]
+            result = _segment_sums(weighted_resp[:, pattern_index] * values,
+                                   pixel_start_indices)
+            if sparser:
+                # Only the scaled sparser kernel thresholds the ones
+                ones_resp = this_resp if scalings is None else weighted_resp
+                pixel_start_indices, pattern_index, _ = entries[1]
+                result += _segment_sums(ones_resp[:, pattern_index],
+                                        pixel_start_indices)
+            # Summed in double precision so that rotations whose
+            # responsabilities all underflow give zero slices instead of
+            # 0*inf.
+            normalization = this_resp.sum(axis=1, dtype="float64")
+            normalization = numpy.divide(
+                1., normalization, out=numpy.zeros_like(normalization),
+                where=normalization > 0.)
+            slices_flat[batch_rows] = result * normalization[:, numpy.newaxis]
+
+    parallel_blocks(update_block, len(rows))
+
+
+def _row_sums(values, indptr):
+    """Sums of the rows of values in the segments given by CSR indptr.
+    Empty segments sum to zero."""
+    counts = numpy.diff(indptr)
+    sums = numpy.zeros((len(counts), ) + values.shape[1:],
+                       dtype=values.dtype)
+    nonempty = numpy.flatnonzero(counts)
+    if len(nonempty) > 0:
+        sums[nonempty] = numpy.add.reduceat(values, indptr[nonempty],
+                                            axis=0)
+    return sums
+
+
+def _row_batches(block, row_costs, batch_cost):
+    """Batches of the rows of block with a summed cost of about
+    batch_cost, with at least one row each"""
+    cumulative = numpy.cumsum(row_costs[block])
+    start = 0
+    while start < len(cumulative):
+        done = cumulative[start-1] if start > 0 else 0
+        end = max(int(numpy.searchsorted(cumulative, done + batch_cost,
+                                         side="right")), start + 1)
+        yield slice(block.start + start, block.start + end)
+        start = end
+
+
+def update_slices_csr(slices, patterns, indptr, pattern_indices, values,
+                      constants, scalings=None):
+    """update_slices with the responsabilities as CSR arrays: row r has
+    values[indptr[r]:indptr[r+1]] for the patterns
+    pattern_indices[indptr[r]:indptr[r+1]], and scalings, if any, are per
+    stored responsability. Each stored responsability adds its pattern to
+    its slice, so the work is in proportion to the stored ones. Rows
+    without responsabilities get -1 for dense patterns and 0 for sparse
+    ones, as in update_slices."""
+    indptr = numpy.int64(indptr)
+    pattern_indices = numpy.int64(pattern_indices)
+    values = numpy.float32(values)
+    weighted = values if scalings is None else values * scalings
+    slices_flat = _flat(slices, len(slices))
+    number_of_pixels = slices_flat.shape[1]
+    terms = constants["terms"]
+    if isinstance(patterns, dict):
+        pixel_sets = _sparse_entries(patterns, terms)
+        entry_costs = sum(numpy.diff(numpy.int64(start_indices))[
+            pattern_indices] for start_indices, *_ in pixel_sets)
+    else:
+        entry_costs = numpy.full(len(values), number_of_pixels)
+    row_costs = _row_sums(entry_costs, indptr)
+
+    def update_dense(batch, entries, batch_indptr):
+        this_patterns = pattern_indices[entries]
+        contributions = terms["counts"][this_patterns]
+        contributions *= weighted[entries, numpy.newaxis]
+        slice_sum = _row_sums(contributions, batch_indptr)
+        if terms["valid"] is None:
+            slice_weight = numpy.broadcast_to(
+                _row_sums(values[entries], batch_indptr)[:, numpy.newaxis],
+                slice_sum.shape)
+        else:
+            contributions = terms["valid"][this_patterns]
+            contributions *= values[entries, numpy.newaxis]
+            slice_weight = _row_sums(contributions, batch_indptr)
+        slices_flat[batch] = _normalize_interpolation(slice_sum,
+                                                      slice_weight)
+
+    def update_sparse(batch, entries, batch_indptr):
+        number_of_rows = batch.stop - batch.start
+        rows = numpy.repeat(numpy.arange(number_of_rows),
+                            numpy.diff(batch_indptr))
+        result = 0.
+        for start_indices, indices, pattern_values, _ in pixel_sets:
+            positions, lengths = _segment_positions(
+                start_indices, pattern_indices[entries])
+            contributions = numpy.repeat(weighted[entries], lengths)
+            if pattern_values is not None:
+                contributions *= pattern_values[positions]
+            result = result + numpy.bincount(
+                numpy.repeat(rows, lengths)*number_of_pixels +
+                indices[positions], weights=contributions,
+                minlength=number_of_rows*number_of_pixels)
+        # Summed in double precision, see update_slices_sparse
+        normalization = _row_sums(numpy.float64(values[entries]),
+                                  batch_indptr)
+        normalization = numpy.divide(
+            1., normalization, out=numpy.zeros_like(normalization),
+            where=normalization > 0.)
+        slices_flat[batch] = (
+            numpy.reshape(result, (number_of_rows, number_of_pixels)) *
+            normalization[:, numpy.newaxis])
+
+    update_batch = (update_sparse if isinstance(patterns, dict)
+                    else update_dense)
+
+    def update_block(block):
+        for batch in _row_batches(block, row_costs, _SPARSE_BATCH_SIZE):
+            entries = slice(indptr[batch.start], indptr[batch.stop])
+            update_batch(batch, entries,
+                         indptr[batch.start:batch.stop+1] -
+                         indptr[batch.start])
+
+    parallel_blocks(update_block, len(slices))
@@ -3,7 +3,8 @@ __global__ void kernel_calculate_responsabilities_poisson(const int* const patte
 							  const float *const slices,
 							  const int number_of_pixels,
 							  float *const responsabilities,
-							  const float *const log_factorial_table)
+							  const double *const log_factorial_remainders,
+							  const float *const remainder_corrections)
 {
   __shared__ float sum_cache[NTHREADS];
   
@@ -17,19 +18,19 @@ __global__ void kernel_calculate_responsabilities_poisson(const int* const patte
   float sum = 0.;
   for (int index = threadIdx.x; index < number_of_pixels; index += blockDim.x) {
     if (pattern[index] >= 0 && slice[index] > 0.) {
-      sum += ((-slice[index]) +
-      	      pattern[index] * logf(slice[index]) -
-      	      log_factorial_table[pattern[index]]);
-      /* if (pattern[index] > 58) { */
-      /* 	printf("pattern[%i] = %i\n", index, pattern[index]); */
-      /* } */
+      /* k log(s/k) - s + k, the rest of log k! is subtracted per pattern.
+	 The terms stay small, so the sum keeps its precision. */
+      sum -= slice[index];
+      if (pattern[index] > 0) {
+	sum += pattern[index] * (logf(slice[index]/pattern[index]) + 1.f);
+      }
     }
   }
   sum_cache[threadIdx.x] = sum;
 
   inblock_reduce(sum_cache);
   if (threadIdx.x == 0) {
-    responsabilities[index_slice*number_of_patterns + index_pattern] = sum_cache[0];
+    responsabilities[index_slice*number_of_patterns + index_pattern] = sum_cache[0] - (log_factorial_remainders[index_pattern] - remainder_corrections[index_slice*number_of_patterns + index_pattern]);
   }
 }
 
@@ -38,7 +39,8 @@ __global__ void kernel_calculate_responsabilities_poisson_scaling(const int *con
 								  const int number_of_pixels,
 								  const float *const scalings,
 								  float *const responsabilities,
-								  const float *const log_factorial_table)
+								  const double *const log_factorial_remainders,
+								  const float *const remainder_corrections)
 {
   __shared__ float sum_cache[NTHREADS];
 
@@ -53,16 +55,17 @@ __global__ void kernel_calculate_responsabilities_poisson_scaling(const int *con
   float sum = 0.;
   for (int index = threadIdx.x; index < number_of_pixels; index += blockDim.x) {
     if (pattern[index] >= 0. && slice[index] > 0.) {
-      sum += ((-slice[index]/scaling) +
-	      pattern[index] * logf(slice[index]/scaling) -
-	      log_factorial_table[pattern[index]]);
+      sum -= slice[index]/scaling;
+      if (pattern[index] > 0) {
+	sum += pattern[index] * (logf(slice[index]/(scaling*pattern[index])) + 1.f);
+      }
     }
   }
   sum_cache[threadIdx.x] = sum;
 
   inblock_reduce(sum_cache);
   if (threadIdx.x == 0) {
-    responsabilities[index_slice*number_of_patterns + index_pattern] = sum_cache[0];
+    responsabilities[index_slice*number_of_patterns + index_pattern] = sum_cache[0] - (log_factorial_remainders[index_pattern] - remainder_corrections[index_slice*number_of_patterns + index_pattern]);
   }
 }
 
@@ -94,7 +97,8 @@ __global__ void kernel_calculate_responsabilities_poisson_per_pattern_scaling(co
 									      const int number_of_pixels,
 									      const float *const scalings,
 									      float *const responsabilities,
-									      const float *const log_factorial_table)
+									      const double *const log_factorial_remainders,
+									      const float *const remainder_corrections)
 {
   __shared__ float sum_cache[NTHREADS];
 
@@ -109,16 +113,17 @@ __global__ void kernel_calculate_responsabilities_poisson_per_pattern_scaling(co
   float sum = 0.;
   for (int index = threadIdx.x; index < number_of_pixels; index += blockDim.x) {
     if (pattern[index] >= 0. && slice[index] > 0.) {
-      sum += ((-slice[index]/scaling) +
-	      pattern[index] * logf(slice[index]/scaling) -
-	      log_factorial_table[pattern[index]]);
+      sum -= slice[index]/scaling;
+      if (pattern[index] > 0) {
+	sum += pattern[index] * (logf(slice[index]/(scaling*pattern[index])) + 1.f);
+      }
     }
   }
   sum_cache[threadIdx.x] = sum;
 
   inblock_reduce(sum_cache);
   if (threadIdx.x == 0) {
-    responsabilities[index_slice*number_of_patterns + index_pattern] = sum_cache[0];
+    responsabilities[index_slice*number_of_patterns + index_pattern] = sum_cache[0] - (log_factorial_remainders[index_pattern] - remainder_corrections[index_slice*number_of_patterns + index_pattern]);
   }
 }
 
@@ -129,7 +134,8 @@ __global__ void kernel_calculate_responsabilities_poisson_sparse(const int *cons
 								 const int number_of_pixels,
 								 float *const responsabilities,
 								 const float *const slice_sums,
-								 const float *const log_factorial_table)
+								 const double *const log_factorial_remainders,
+								 const float *const remainder_corrections)
 {
   __shared__ float sum_cache[NTHREADS];
 
@@ -145,15 +151,13 @@ __global__ void kernel_calculate_responsabilities_poisson_sparse(const int *cons
        index += blockDim.x) {
     index_pixel = pattern_indices[index];
     if (slice[index_pixel] > 0.) {
-      sum += (pattern_values[index] *
-      	      logf(slice[index_pixel]) -
-      	      log_factorial_table[pattern_values[index]]);
+      sum += pattern_values[index] * (logf(slice[index_pixel]/pattern_values[index]) + 1.f);
     }
   }
   sum_cache[threadIdx.x] = sum;
   inblock_reduce(sum_cache);
   if (threadIdx.x == 0) {
-    responsabilities[index_slice*number_of_patterns + index_pattern] = -slice_sums[index_slice] + sum_cache[0];
+    responsabilities[index_slice*number_of_patterns + index_pattern] = -slice_sums[index_slice] + sum_cache[0] - (log_factorial_remainders[index_pattern] - remainder_corrections[index_slice*number_of_patterns + index_pattern]);
   }
 }
 
@@ -166,7 +170,8 @@ __global__ void kernel_calculate_responsabilities_poisson_sparse_scaling(const i
 									 const float *const scaling,
 									 float *const responsabilities,
 									 const float *const slice_sums,
-									 const float *const log_factorial_table)
+									 const double *const log_factorial_remainders,
+									 const float *const remainder_corrections)
 {
   __shared__ float sum_cache[NTHREADS];
 
@@ -186,13 +191,13 @@ __global__ void kernel_calculate_responsabilities_poisson_sparse_scaling(const i
        index += blockDim.x) {
     index_pixel = pattern_indices[index];
     if (slice[index_pixel] > 0.) {
-      sum += pattern_values[index] * logf(slice[index_pixel]/this_scaling) - log_factorial_table[pattern_values[index]];
+      sum += pattern_values[index] * (logf(slice[index_pixel]/(this_scaling*pattern_values[index])) + 1.f);
     }
   }
   sum_cache[threadIdx.x] = sum;
   inblock_reduce(sum_cache);
   if (threadIdx.x == 0) {
-    responsabilities[index_slice*number_of_patterns + index_pattern] = -slice_sums[index_slice]/this_scaling + sum_cache[0];
+    responsabilities[index_slice*number_of_patterns + index_pattern] = -slice_sums[index_slice]/this_scaling + sum_cache[0] - (log_factorial_remainders[index_pattern] - remainder_corrections[index_slice*number_of_patterns + index_pattern]);
   }
 }
 
@@ -205,7 +210,8 @@ __global__ void kernel_calculate_responsabilities_poisson_sparse_per_pattern_sca
 										     const float *const scaling,
 										     float *const responsabilities,
 										     const float *const slice_sums,
-										     const float *const log_factorial_table)
+										     const double *const log_factorial_remainders,
+										     const float *const remainder_corrections)
 {
   __shared__ float sum_cache[NTHREADS];
 
@@ -221,13 +227,13 @@ __global__ void kernel_calculate_responsabilities_poisson_sparse_per_pattern_sca
   for (int index = pattern_start_indices[index_pattern]+threadIdx.x; index < pattern_start_indices[index_pattern+1]; index += blockDim.x) {
     index_pixel = pattern_indices[index];
     if (slice[index_pixel] > 0.) {
-      sum += pattern_values[index] * logf(slice[index_pixel]/this_scaling) - log_factorial_table[pattern_values[index]];
+      sum += pattern_values[index] * (logf(slice[index_pixel]/(this_scaling*pattern_values[index])) + 1.f);
     }
   }
   sum_cache[threadIdx.x] = sum;
   inblock_reduce(sum_cache);
   if (threadIdx.x == 0) {
-    responsabilities[index_slice*number_of_patterns + index_pattern] = -slice_sums[index_slice]/this_scaling + sum_cache[0];
+    responsabilities[index_slice*number_of_patterns + index_pattern] = -slice_sums[index_slice]/this_scaling + sum_cache[0] - (log_factorial_remainders[index_pattern] - remainder_corrections[index_slice*number_of_patterns + index_pattern]);
   }
 }
 
@@ -241,7 +247,8 @@ __global__ void kernel_calculate_responsabilities_poisson_sparser(const int *con
 								  const int number_of_pixels,
 								  float *const responsabilities,
 								  const float *const slice_sums,
-								  const float *const log_factorial_table)
+								  const double *const log_factorial_remainders,
+								  const float *const remainder_corrections)
 {
   __shared__ float sum_cache[NTHREADS];
 
@@ -257,9 +264,7 @@ __global__ void kernel_calculate_responsabilities_poisson_sparser(const int *con
        index += blockDim.x) {
     index_pixel = pattern_indices[index];
     if (slice[index_pixel] > 0.) {
-      sum += (pattern_values[index] *
-      	      logf(slice[index_pixel]) -
-      	      log_factorial_table[pattern_values[index]]);
+      sum += pattern_values[index] * (logf(slice[index_pixel]/pattern_values[index]) + 1.f);
     }
   }
 
@@ -268,7 +273,7 @@ __global__ void kernel_calculate_responsabilities_poisson_sparser(const int *con
        index += blockDim.x) {
     index_pixel = pattern_ones_indices[index];
     if (slice[index_pixel] > 0.) {
-      sum += logf(slice[index_pixel]);
+      sum += logf(slice[index_pixel]) + 1.f;
     }
   }
 
@@ -276,7 +281,7 @@ __global__ void kernel_calculate_responsabilities_poisson_sparser(const int *con
   sum_cache[threadIdx.x] = sum;
   inblock_reduce(sum_cache);
   if (threadIdx.x == 0) {
-    responsabilities[index_slice*number_of_patterns + index_pattern] = -slice_sums[index_slice] + sum_cache[0];
+    responsabilities[index_slice*number_of_patterns + index_pattern] = -slice_sums[index_slice] + sum_cache[0] - (log_factorial_remainders[index_pattern] - remainder_corrections[index_slice*number_of_patterns + index_pattern]);
   }
 }
 
@@ -291,7 +296,8 @@ __global__ void kernel_calculate_responsabilities_poisson_sparser_scaling(const
 									  const float *const scaling,
 									  float *const responsabilities,
 									  const float *const slice_sums,
-									  const float *const log_factorial_table)
+									  const double *const log_factorial_remainders,
+									  const float *const remainder_corrections)
 {
   __shared__ float sum_cache[NTHREADS];
 
@@ -311,7 +317,7 @@ __global__ void kernel_calculate_responsabilities_poisson_sparser_scaling(const
        index += blockDim.x) {
     index_pixel = pattern_indices[index];
     if (slice[index_pixel] > 0.) {
-      sum += pattern_values[index] * logf(slice[index_pixel]/this_scaling) - log_factorial_table[pattern_values[index]];
+      sum += pattern_values[index] * (logf(slice[index_pixel]/(this_scaling*pattern_values[index])) + 1.f);
     }
   }
 
@@ -322,14 +328,14 @@ __global__ void kernel_calculate_responsabilities_poisson_sparser_scaling(const
        index += blockDim.x) {
     index_pixel = pattern_ones_indices[index];
     if (slice[index_pixel] > 0.) {
-      sum += logf(slice[index_pixel]/this_scaling);
+      sum += logf(slice[index_pixel]/this_scaling) + 1.f;
     }
   }
   
   sum_cache[threadIdx.x] = sum;
   inblock_reduce(sum_cache);
   if (threadIdx.x == 0) {
-    responsabilities[index_slice*number_of_patterns + index_pattern] = -slice_sums[index_slice]/this_scaling + sum_cache[0];
+    responsabilities[index_slice*number_of_patterns + index_pattern] = -slice_sums[index_slice]/this_scaling + sum_cache[0] - (log_factorial_remainders[index_pattern] - remainder_corrections[index_slice*number_of_patterns + index_pattern]);
   }
 }
 
@@ -343,3 +343,136 @@ __global__ void kernel_update_slices_sparser_scaling(float *const slices,
     }
   }
 }
+
+
+/* Responsabilities in CSR format: the slice of row r (one block each) is
+   updated from the patterns pattern_list[row_start[r]:row_start[r+1]]
+   only. weighted_resp is the responsability times the scaling, or just the
+   responsability without scaling.
+ */
+template<typename T> __global__ void kernel_update_slices_csr(float *const slices,
+							      const T *const patterns,
+							      const int number_of_pixels,
+							      const int *const row_start,
+							      const int *const pattern_list,
+							      const float *const resp,
+							      const float *const weighted_resp)
+{
+  const int index_row = blockIdx.x;
+  float sum;
+  float weight;
+  for (int pixel_index = threadIdx.x;
+       pixel_index < number_of_pixels;
+       pixel_index += blockDim.x) {
+    sum = 0.;
+    weight = 0.;
+    for (int entry = row_start[index_row];
+	 entry < row_start[index_row+1];
+	 entry++) {
+      const int pattern_index = pattern_list[entry];
+      if (patterns[pattern_index*number_of_pixels + pixel_index] >= 0.) {
+	sum += (patterns[pattern_index*number_of_pixels + pixel_index] *
+		weighted_resp[entry]);
+	weight += resp[entry];
+      }
+    }
+    if (weight > 0.) {
+      slices[index_row*number_of_pixels + pixel_index] = sum / weight;
+    } else {
+      slices[index_row*number_of_pixels + pixel_index] = -1.;
+    }
+  }
+}
+
+
+__device__ void normalize_slice_csr(float *const slice,
+				    const int number_of_pixels,
+				    const int *const row_start,
+				    const float *const resp)
+{
+  __shared__ double normalization_factor_cache[NTHREADS];
+  const int index_row = blockIdx.x;
+  normalization_factor_cache[threadIdx.x] = 0.;
+  for (int entry = row_start[index_row] + threadIdx.x;
+       entry < row_start[index_row+1];
+       entry += blockDim.x) {
+    normalization_factor_cache[threadIdx.x] += resp[entry];
+  }
+  inblock_reduce(normalization_factor_cache);
+  float normalization_factor = 0.;
+  if (normalization_factor_cache[0] > 0.) {
+    normalization_factor = 1./normalization_factor_cache[0];
+  }
+  for (int index_pixel = threadIdx.x; index_pixel < number_of_pixels; index_pixel += blockDim.x) {
+    slice[index_pixel] *= normalization_factor;
+  }
+}
+
+
+__global__ void kernel_update_slices_sparse_csr(float *const slices,
+						const int number_of_pixels,
+						const int *const pattern_start_indices,
+						const int *const pattern_indices,
+						const int *const pattern_values,
+						const int *const row_start,
+						const int *const pattern_list,
+						const float *const resp,
+						const float *const weighted_resp)
+{
+  const int index_row = blockIdx.x;
+  float *const slice = &slices[index_row*number_of_pixels];
+
+  for (int index_pixel = threadIdx.x; index_pixel < number_of_pixels; index_pixel += blockDim.x) {
+    slice[index_pixel] = 0.;
+  }
+  __syncthreads();
+  for (int entry = row_start[index_row]; entry < row_start[index_row+1]; entry++) {
+    const int index_pattern = pattern_list[entry];
+    const float this_resp = weighted_resp[entry];
+    for (int value_index = pattern_start_indices[index_pattern] + threadIdx.x;
+	 value_index < pattern_start_indices[index_pattern+1];
+	 value_index += blockDim.x) {
+      atomicAdd(&slice[pattern_indices[value_index]],
+		pattern_values[value_index] * this_resp);
+    }
+  }
+  normalize_slice_csr(slice, number_of_pixels, row_start, resp);
+}
+
+
+__global__ void kernel_update_slices_sparser_csr(float *const slices,
+						 const int number_of_pixels,
+						 const int *const pattern_start_indices,
+						 const int *const pattern_indices,
+						 const int *const pattern_values,
+						 const int *const pattern_ones_start_indices,
+						 const int *const pattern_ones_indices,
+						 const int *const row_start,
+						 const int *const pattern_list,
+						 const float *const resp,
+						 const float *const weighted_resp)
+{
+  const int index_row = blockIdx.x;
+  float *const slice = &slices[index_row*number_of_pixels];
+
+  for (int index_pixel = threadIdx.x; index_pixel < number_of_pixels; index_pixel += blockDim.x) {
+    slice[index_pixel] = 0.;
+  }
+  __syncthreads();
+  for (int entry = row_start[index_row]; entry < row_start[index_row+1]; entry++) {
+    const int index_pattern = pattern_list[entry];
+    const float this_resp = weighted_resp[entry];
+    for (int value_index = pattern_start_indices[index_pattern] + threadIdx.x;
+	 value_index < pattern_start_indices[index_pattern+1];
+	 value_index += blockDim.x) {
+      atomicAdd(&slice[pattern_indices[value_index]],
+		pattern_values[value_index] * this_resp);
+    }
+    for (int ones_index = pattern_ones_start_indices[index_pattern] + threadIdx.x;
+	 ones_index < pattern_ones_start_indices[index_pattern+1];
+	 ones_index += blockDim.x) {
+      atomicAdd(&slice[pattern_ones_indices[ones_index]], this_resp);
+    }
+  }
+  normalize_slice_csr(slice, number_of_pixels, row_start, resp);
+}
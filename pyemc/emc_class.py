@@ -1,7 +1,8 @@
+import collections
+import concurrent.futures
+import itertools
+import tempfile
 import numpy
-import h5py
-import rotsampling
-import cupy
 from . import pyemc
 from . import mpi as mpi_module
 from . import utils
@@ -19,6 +20,7 @@ class DataReader:
             self._mpi.set_number_of_patterns(number_of_patterns)
 
     def dataset_format(self, file_location):
+        import h5py
         if isinstance(file_location, h5py.Dataset):
             if numpy.issubdtype(file_location.dtype, numpy.integer):
                 return pyemc.PatternType.DENSE
@@ -35,12 +37,14 @@ class DataReader:
                 raise ValueError("Unsupported dataset")
 
     def dataset_npatterns(self, file_location):
+        import h5py
         if isinstance(file_location, h5py.Dataset):
             return file_location.shape[0]
         else:
             return file_location["start_indices"].shape[0]-1
 
     def read_patterns(self, file_name, file_loc):
+        import h5py
         with h5py.File(file_name, "r") as file_handle:
             file_location = file_handle[file_loc]
             # data_type = pyemc.pattern_type(file_location)
@@ -60,14 +64,17 @@ class DataReader:
 
 
 class Saver:
-    def __init__(self, file_name, emc, mpi=None):
+    def __init__(self, file_name, emc, mpi=None, append=False):
+        """With append the file is kept, e.g. to resume from its
+        checkpoint."""
         self.file_name = file_name
         self._mpi = mpi
         self.emc = emc
         self._is_master = True if mpi is None else mpi.is_master()
 
         if self._is_master:
-            with h5py.File(self.file_name, "w") as file_handle:
+            import h5py
+            with h5py.File(self.file_name, "a" if append else "w"):
                 pass
 
     def set_emc(self, emc):
@@ -77,6 +84,7 @@ class Saver:
         """Return the group, create if it doesn't exist"""
         iteration = self.emc.current_iteration
         group_name = f"it{iteration:04}"
+        import h5py
         if group_name in file_handle:
             return file_handle[group_name]
         else:
@@ -90,6 +98,7 @@ class Saver:
         average_best_resp = self.emc.get_average_best_resp()
         best_rotations = self.emc.get_best_rotations()
         if self._is_master:
+            import h5py
             with h5py.File(self.file_name, "a") as file_handle:
                 group = self.get_group(file_handle)
                 group["model"] = model
@@ -98,10 +107,106 @@ class Saver:
 
     def save_value(self, name, value):
         if self._is_master:
+            import h5py
             with h5py.File(self.file_name, "a") as file_handle:
                 group = self.get_group(file_handle)
                 group[name] = value
 
+    def save_checkpoint(self):
+        """Save what load_checkpoint needs to continue the run. Only the
+        latest checkpoint is kept. Must be called on all MPI ranks."""
+        checkpoint = self.emc.get_checkpoint()
+        if self._is_master:
+            import h5py
+            with h5py.File(self.file_name, "a") as file_handle:
+                # The old checkpoint is kept until the new one is written
+                if "checkpoint_new" in file_handle:
+                    del file_handle["checkpoint_new"]
+                group = file_handle.create_group("checkpoint_new")
+                for key, value in checkpoint.items():
+                    if isinstance(value, numpy.ndarray):
+                        group[key] = value
+                    else:
+                        group.attrs[key] = value
+                if "checkpoint" in file_handle:
+                    del file_handle["checkpoint"]
+                file_handle.move("checkpoint_new", "checkpoint")
+
+    def load_checkpoint(self):
+        """Continue the run of the checkpoint in the file. The EMC must be
+        set up as in the run that saved it. Call on all MPI ranks."""
+        import h5py
+        with h5py.File(self.file_name, "r") as file_handle:
+            group = file_handle["checkpoint"]
+            checkpoint = dict(group.attrs)
+            checkpoint.update({key: group[key][...] for key in group})
+        self.emc.set_checkpoint(checkpoint)
+
+
+class ChunkPipeline:
+    """Overlaps the host side work of each chunk with the computation of
+    the following chunks. The work runs in order in one background
+    thread. Every chunk is computed into the next of number_of_buffers
+    buffers, which is handed out again only when the work reading it is
+    done. With one buffer everything runs in the calling thread."""
+    def __init__(self, number_of_buffers=1):
+        if number_of_buffers < 1:
+            raise ValueError("Need at least one buffer")
+        self.number_of_buffers = int(number_of_buffers)
+        self._executor = None
+        self._pending = collections.deque()
+        self._next_buffer = 0
+
+    def _submit(self, function, *args):
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1)
+        return self._executor.submit(function, *args)
+
+    def next_buffer(self):
+        """Index of the buffer to compute the next chunk into"""
+        while len(self._pending) >= self.number_of_buffers:
+            self._pending.popleft().result()
+        buffer_index = self._next_buffer
+        self._next_buffer = (self._next_buffer + 1) % self.number_of_buffers
+        return buffer_index
+
+    def submit(self, function, *args):
+        """Run function(*args) after all previously submitted work"""
+        if self.number_of_buffers == 1:
+            function(*args)
+        else:
+            self._pending.append(self._submit(function, *args))
+
+    def wait(self):
+        """Wait for all submitted work and raise its exceptions"""
+        while self._pending:
+            self._pending.popleft().result()
+
+    def close(self):
+        """Wait for all submitted work and stop the background thread"""
+        try:
+            self.wait()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def prefetch(self, function, arguments):
+        """Yield function(*args) for each args in arguments, running up to
+        number_of_buffers-1 calls ahead in the background."""
+        if self.number_of_buffers == 1:
+            for args in arguments:
+                yield function(*args)
+            return
+        ahead = collections.deque()
+        for args in arguments:
+            ahead.append(self._submit(function, *args))
+            if len(ahead) >= self.number_of_buffers:
+                yield ahead.popleft().result()
+        while ahead:
+            yield ahead.popleft().result()
+
 
 class EMC:
     def __init__(self, patterns, mask, start_model, coordinates, n,
@@ -128,8 +233,21 @@ class EMC:
 
         self._chunk_size = 1000
 
+        self._pipeline = ChunkPipeline(1)
+
         self._interpolation = pyemc.Interpolation.LINEAR
 
+        # Patterns, mask and coordinates as given, before binning
+        self._full_resolution = {}
+        self._binning = 1
+        self._resolution_schedule = []
+
+        self._symmetry_group = None
+        self._friedel = False
+        self._coarse_to_fine = None
+        self._search_window = None
+        self._prescreening = None
+
         if self._two_dimensional:
             self.set_rotsampling_2d(n)
         else:
@@ -142,9 +260,10 @@ class EMC:
         self.set_patterns(patterns)
         self.set_mask(mask)
         self.set_alpha("static", 1)
+        self.set_resp_storage("dense")
         self._slices = None
-        self._resp_cpu = None
         self._resp = None
+        self._resp_buffers = []
         self._best_resp_rot_index = None
 
         self.current_iteration = 0
@@ -152,26 +271,213 @@ class EMC:
     def set_n(self, n):
         # Update rotations, weights, number_of_rotations,
         # resp_cpu, scaling_cpu
+        import rotsampling
+        self._n = n
         all_rotations, all_rotation_weights = rotsampling.rotsampling(
             n, return_weights=True)
+        if self._symmetry_group is not None or self._friedel:
+            all_rotations, all_rotation_weights = (
+                utils.symmetry_reduce_rotations(
+                    all_rotations, all_rotation_weights,
+                    self._symmetry_group, self._friedel))
         self._all_rotations = numpy.float32(all_rotations)
         self._mpi.set_number_of_rotations(len(self._all_rotations))
         my_rotations = self._all_rotations[self._mpi.rotation_slice()]
         my_weights = all_rotation_weights[self._mpi.rotation_slice()]
-        self._rotations = cupy.asarray(my_rotations, dtype="float32")
+        self._rotations = pyemc.asarray(my_rotations, dtype="float32")
         self._rotation_weights_cpu = numpy.float32(my_weights)
         self._number_of_rotations = len(self._rotations)
+        if self._coarse_to_fine is not None:
+            self._build_coarse_to_fine()
+        if self._search_window is not None:
+            self._build_search_window()
 
     def set_rotsampling_2d(self, number_of_rotations):
+        self._n = number_of_rotations
         self._all_rotations = numpy.linspace(0, 2*numpy.pi,
                                              number_of_rotations)
         self._mpi.set_number_of_rotations(len(self._all_rotations))
         my_rotations = self._all_rotations[self._mpi.rotation_slice()]
         my_weights = len(self._all_rotations)
-        self._rotations = cupy.asarray(my_rotations, dtype="float32")
+        self._rotations = pyemc.asarray(my_rotations, dtype="float32")
         self._rotation_weights_cpu = numpy.ones(my_weights, dtype="float32")
         self._number_of_rotations = len(self._rotations)
 
+    def set_symmetry(self, point_group=None, friedel=False):
+        """Only sample the asymmetric unit of the rotations and symmetrize
+        the model after each insertion. point_group is a name accepted by
+        utils.point_group, e.g. "D2" or "I"."""
+        if self._two_dimensional:
+            raise NotImplementedError("Symmetry is not implemented for 2D")
+        if point_group is None:
+            self._symmetry_group = None
+        else:
+            self._symmetry_group = utils.point_group(point_group)
+        self._friedel = bool(friedel)
+        self.set_n(self._n)
+        self._best_resp_rot_index = None
+
+    def set_coarse_to_fine(self, coarse_n=None, number_of_candidates=4):
+        """Compare all patterns to the rotsampling grid of coarse_n first
+        and then each pattern only to the rotations of the fine grid
+        around its number_of_candidates best coarse rotations. The
+        responsabilities are then always kept as sparse storage, and the
+        maximization step only visits the fine rotations and patterns of
+        the stored pairs. None turns this off."""
+        if coarse_n is None:
+            self._coarse_to_fine = None
+            return
+        if self._two_dimensional:
+            raise NotImplementedError("Coarse to fine refinement is not "
+                                      "implemented for 2D")
+        if number_of_candidates < 1:
+            raise ValueError("number_of_candidates must be at least 1")
+        self._coarse_to_fine = {
+            "n": coarse_n,
+            "number_of_candidates": int(number_of_candidates)}
+        self._build_coarse_to_fine()
+
+    def set_search_window(self, max_angle=None, full_sweep_interval=5):
+        """Compare each pattern only to the rotations within max_angle
+        (in radians) of the rotations where it had responsability in the
+        previous iteration. Every full_sweep_interval iterations all
+        rotations are compared again, to keep patterns from getting stuck.
+        Windows don't reach across the rotations of different MPI ranks.
+        The responsabilities are then always kept as sparse storage, and
+        the maximization step only visits the rotations and patterns of
+        the stored pairs. None turns this off."""
+        if max_angle is None:
+            self._search_window = None
+            return
+        if self._two_dimensional:
+            raise NotImplementedError("Search windows are not implemented "
+                                      "for 2D")
+        if full_sweep_interval < 1:
+            raise ValueError("full_sweep_interval must be at least 1")
+        self._search_window = {
+            "max_angle": float(max_angle),
+            "full_sweep_interval": int(full_sweep_interval),
+            "iterations_since_full_sweep": None}
+        self._build_search_window()
+
+    def _build_search_window(self):
+        indptr, indices = utils.rotation_neighbours(
+            pyemc.asnumpy(self._rotations), self._search_window["max_angle"],
+            self._symmetry_group, self._friedel)
+        self._search_window["neighbour_indptr"] = indptr
+        self._search_window["neighbours"] = indices
+        # The stored responsabilities might be of other rotations
+        self._search_window["iterations_since_full_sweep"] = None
+
+    def _use_search_window(self):
+        """Whether this iteration is restricted to the search windows
+        rather than being a full sweep"""
+        if self._search_window is None:
+            return False
+        since_full_sweep = self._search_window["iterations_since_full_sweep"]
+        return (since_full_sweep is not None and
+                since_full_sweep + 1 <
+                self._search_window["full_sweep_interval"] and
+                self._resp_sparse is not None)
+
+    def set_prescreening(self, margin=None, binning=4):
+        """Compare all rotations and patterns binned by binning first
+        (on top of set_binning) and calculate the full resolution
+        responsabilities only of the pairs whose binned log likelihood is
+        within margin of the best one of their pattern. Other pairs get no
+        responsability, which is kept as sparse storage. None turns this
+        off."""
+        if margin is None:
+            self._prescreening = None
+            return
+        if self._two_dimensional:
+            raise NotImplementedError("Prescreening is not implemented "
+                                      "for 2D")
+        if margin < 0:
+            raise ValueError("margin can not be negative")
+        self._prescreening = {"margin": float(margin),
+                              "binning": int(binning),
+                              "source": None}
+
+    def _resp_method(self):
+        """How the responsabilities of this iteration are stored"""
+        if (
+                self._coarse_to_fine is not None or
+                self._search_window is not None or
+                self._prescreening is not None
+        ):
+            return "sparse"
+        return self._resp_storage["method"]
+
+    def _symmetrize(self, array):
+        """Sum over symmetry equivalent orientations of a model sum or
+        weight"""
+        xp = pyemc.array_module()
+        symmetric = array.copy()
+        if self._symmetry_group is not None:
+            for rotation in self._symmetry_group[1:]:
+                rotated = pyemc.rotate_model(
+                    array, pyemc.asarray(rotation, dtype="float32"))
+                symmetric += xp.maximum(rotated, 0)
+        if self._friedel:
+            symmetric += symmetric[::-1, ::-1, ::-1]
+        array[...] = symmetric
+
+    def _binned(self, data, bin_function, factor=None):
+        """data binned on the host by factor, by default the current
+        binning factor"""
+        if factor is None:
+            factor = self._binning
+        if factor == 1:
+            return data
+        if isinstance(data, dict):
+            data = {key: value if key == "shape" else pyemc.asnumpy(value)
+                    for key, value in data.items()}
+        else:
+            data = pyemc.asnumpy(data)
+        return bin_function(data, factor)
+
+    def set_binning(self, factor, n=None):
+        """Work on patterns, mask and coordinates binned by factor (in
+        each direction) and a model downsampled by factor. The current
+        model is resampled, so that the resolution can be increased as the
+        reconstruction converges. Binned pixels hold the photons of
+        factor**2 pixels, so the intensities of the model are scaled by
+        the change of pixel area. set_model and get_model use the binned
+        model. n optionally sets a new rotation sampling."""
+        factor = int(factor)
+        if factor < 1:
+            raise ValueError("Binning factor must be at least 1")
+        if self._two_dimensional:
+            raise NotImplementedError("Binning is not implemented for 2D")
+        if factor != self._binning:
+            models = [utils.bin_model(utils.upsample_model(
+                pyemc.asnumpy(m), self._binning), factor)
+                for m in self._model]
+            for m in models:
+                m[m >= 0] *= (factor / self._binning)**2
+            self._binning = factor
+            self.set_patterns(self._full_resolution["patterns"])
+            self.set_mask(self._full_resolution["mask"])
+            self.set_coordinates(self._full_resolution["coordinates"])
+            self.set_model(models)
+            self._best_resp_rot_index = None
+        if n is not None and n != self._n:
+            self.set_n(n)
+
+    def set_resolution_schedule(self, schedule):
+        """schedule is a list of (first_iteration, factor, n). Each
+        iteration starts by applying set_binning(factor, n) from the last
+        entry that has started."""
+        self._resolution_schedule = sorted(schedule)
+
+    def _apply_resolution_schedule(self):
+        started = [stage for stage in self._resolution_schedule
+                   if stage[0] <= self.current_iteration]
+        if started:
+            _, factor, n = started[-1]
+            self.set_binning(factor, n)
+
     def set_interpolation(self, interpolation):
         try:
             self._interpolation = pyemc.Interpolation(interpolation)
@@ -187,18 +493,22 @@ class EMC:
                                  "interpolation")
         
     def set_model(self, model):
+        """The model is in photons per pixel of the current binning (see
+        set_binning), on a grid downsampled by the binning factor."""
         # Update model, number_of_models, model_send/recv
         # Interpret starting model
+        # Always copy, the models are updated in place.
+        xp = pyemc.array_module()
         if hasattr(model, "shape"):
             # This is probably a numpy array
-            self._model = [cupy.asarray(model, dtype="float32")]
+            self._model = [xp.array(model, dtype="float32")]
         else:
             # This should be a list of arrays
             for m in model[1:]:
                 if m.shape != model[0].shape:
                     raise ValueError("Models are not all the same shape")
-            self._model = [cupy.asarray(m, dtype="float32") for m in model]
-        self._model_weight = [cupy.zeros_like(m, dtype="float32")
+            self._model = [xp.array(m, dtype="float32") for m in model]
+        self._model_weight = [xp.zeros_like(m, dtype="float32")
                               for m in self._model]
         self._number_of_models = len(self._model)
         if self._mpi.mpi_on:
@@ -210,7 +520,9 @@ class EMC:
     def set_coordinates(self, coordinates):
         # Update coordinates, slices
         # Convert coordinates
-        self._coordinates = cupy.asarray(coordinates, dtype="float32")
+        self._full_resolution["coordinates"] = coordinates
+        coordinates = self._binned(coordinates, utils.bin_coordinates)
+        self._coordinates = pyemc.asarray(coordinates, dtype="float32")
 
     def set_patterns(self, patterns):
         # Update patterns, number of patterns, number_of_patterns,
@@ -218,44 +530,47 @@ class EMC:
         # Interpret patterns
         # Is it sparse or not
         # data_type = dataset_format(patterns)
+        self._full_resolution["patterns"] = patterns
+        patterns = self._binned(patterns, utils.bin_patterns)
         data_type = pyemc.pattern_type(patterns)
         # Convert types
         if data_type is pyemc.PatternType.SPARSE:
             self._patterns = {
-                "indices": cupy.asarray(patterns["indices"],
+                "indices": pyemc.asarray(patterns["indices"],
                                         dtype="int32"),
-                "values": cupy.asarray(patterns["values"],
+                "values": pyemc.asarray(patterns["values"],
                                        dtype="int32"),
-                "start_indices": cupy.asarray(patterns["start_indices"],
+                "start_indices": pyemc.asarray(patterns["start_indices"],
                                               dtype="int32"),
                 "shape": patterns["shape"]}
             self._pattern_shape = patterns["shape"]
             self._number_of_patterns = len(self._patterns["start_indices"])-1
         elif data_type is pyemc.PatternType.SPARSER:
             self._patterns = {
-                "indices": cupy.asarray(patterns["indices"],
+                "indices": pyemc.asarray(patterns["indices"],
                                         dtype="int32"),
-                "values": cupy.asarray(patterns["values"],
+                "values": pyemc.asarray(patterns["values"],
                                        dtype="int32"),
-                "start_indices": cupy.asarray(patterns["start_indices"],
+                "start_indices": pyemc.asarray(patterns["start_indices"],
                                               dtype="int32"),
-                "ones_indices": cupy.asarray(patterns["ones_indices"],
+                "ones_indices": pyemc.asarray(patterns["ones_indices"],
                                              dtype="int32"),
-                "ones_start_indices": cupy.asarray(
+                "ones_start_indices": pyemc.asarray(
                     patterns["ones_start_indices"], dtype="int32"),
                 "shape": patterns["shape"]}
             self._pattern_shape = patterns["shape"]
             self._number_of_patterns = len(self._patterns["start_indices"])-1
         elif data_type is pyemc.PatternType.DENSE:
-            self._patterns = cupy.asarray(patterns, dtype="int32")
+            self._patterns = pyemc.asarray(patterns, dtype="int32")
             self._pattern_shape = patterns.shape[1:]
             self._number_of_patterns = len(self._patterns)
         elif data_type is pyemc.PatternType.DENSEFLOAT:
-            self._patterns = cupy.asarray(patterns, dtype="float32")
+            self._patterns = pyemc.asarray(patterns, dtype="float32")
             self._pattern_shape = patterns.shape[1:]
             self._number_of_patterns = len(self._patterns)
         else:
             raise ValueError("Unsupported pattern format")
+        self._pattern_constants = pyemc.pattern_constants(self._patterns)
         # Figure out how many
 
         if self._mpi.mpi_on:
@@ -292,7 +607,9 @@ class EMC:
 
     def set_mask(self, mask):
         # Convert mask
-        self._mask = cupy.asarray(mask, dtype="bool8")
+        self._full_resolution["mask"] = mask
+        mask = self._binned(mask, utils.bin_mask)
+        self._mask = pyemc.asarray(mask, dtype="bool")
         self._mask_inv = ~self._mask
 
     def set_alpha(self, method, *params):
@@ -305,22 +622,60 @@ class EMC:
         else:
             raise ValueError("Alpha method must be 'adaptive' or 'static'")
 
-    def _alpha_adaptive(self, target_resp_diff):
+    def set_resp_storage(self, method, cutoff=1e-6, top_k=None,
+                         directory=None):
+        """How responsabilities are kept between the expectation and
+        the maximization step. "dense" keeps all of them on the host,
+        "recompute" only keeps a few values per pattern and calculates
+        the responsabilities a second time in the maximization step.
+        "sparse" keeps, for each pattern, the responsabilities larger
+        than cutoff times its largest one, or only the top_k largest
+        if top_k is given. "memmap" is like "dense" but keeps them in
+        a temporary file in directory, for when they don't fit in
+        memory."""
+        if method not in ("dense", "recompute", "sparse", "memmap"):
+            raise ValueError("Resp storage must be 'dense', 'recompute', "
+                             "'sparse' or 'memmap'")
+        if method == "sparse" and top_k is None and not 0 < cutoff < 1:
+            raise ValueError("Cutoff must be between 0 and 1")
+        if method == "sparse" and top_k is not None and top_k < 1:
+            raise ValueError("top_k must be at least 1")
+        self._resp_storage = {"method": method,
+                              "cutoff": cutoff,
+                              "top_k": top_k,
+                              "directory": directory}
+        self._resp_cpu = None
+        self._scaling_cpu = None
+        self._resp_sparse = None
+
+    def set_number_of_buffers(self, number_of_buffers):
+        """With more than one buffer, the host side work of each chunk
+        (copying and normalizing responsabilities, reading them back)
+        runs in the background while the next chunks are computed. Each
+        buffer holds one chunk of responsabilities on the device."""
+        self._pipeline.close()
+        self._pipeline = ChunkPipeline(number_of_buffers)
+
+    def close(self):
+        """Stop the background thread used with more than one buffer"""
+        self._pipeline.close()
+
+    def _alpha_adaptive(self, target_resp_diff, resp_max, resp_sum):
         epsilon = 1e-6
         if self._mpi.mpi_on:
             resp_global_max = numpy.empty(self._number_of_patterns,
                                           dtype="float32")
             resp_global_sum = numpy.empty(self._number_of_patterns,
                                           dtype="float32")
-            self._mpi.comm_rot.Reduce(self._resp_cpu.max(axis=0),
+            self._mpi.comm_rot.Reduce(numpy.float32(resp_max),
                                       resp_global_max,
                                       op=self._mpi_flags["MAX"], root=0)
-            self._mpi.comm_rot.Reduce(self._resp_cpu.sum(axis=0),
+            self._mpi.comm_rot.Reduce(numpy.float32(resp_sum),
                                       resp_global_sum,
                                       op=self._mpi_flags["SUM"], root=0)
         else:
-            resp_global_max = self._resp_cpu.max(axis=0)
-            resp_global_sum = self._resp_cpu.sum(axis=0)
+            resp_global_max = resp_max
+            resp_global_sum = resp_sum
 
         if self._mpi.is_rot_master():
             number_of_states = (self._mpi.total_number_of_rotations *
@@ -347,34 +702,731 @@ class EMC:
             self._patterns,
             self._slices[slice_small],
             self._resp[slice_small],
-            scalings=scalings)
+            scalings=scalings,
+            constants=self._pattern_constants)
 
     def update_slices(self, slice_big, slice_small):
         scalings = self._scaling[slice_small] if self._rescale else None
         pyemc.update_slices(self._slices[slice_small],
                             self._patterns,
                             self._resp[slice_small],
-                            scalings=scalings)
+                            scalings=scalings,
+                            constants=self._pattern_constants)
 
-    def apply_alpha(self):
+    def _alpha(self, resp_statistics):
+        """resp_statistics is a function returning the local per pattern
+        max and sum of the log responsabilities. It is only called for
+        adaptive alpha."""
         if self._alpha_method["method"] == "adaptive":
             alpha_strength = (self._alpha_method["speed"] *
                               (self.current_iteration+1))
-            alpha = self._alpha_adaptive(alpha_strength)
+            alpha = self._alpha_adaptive(alpha_strength, *resp_statistics())
             if self._mpi.is_master() and not self._quiet:
                 print(f"alpha mean = {alpha.mean()}, std = {alpha.std()}",
                       flush=True)
         elif self._alpha_method["method"] == "static":
             alpha = self._alpha_method["value"]
-        self._resp_cpu *= alpha
+        return alpha
+
+    def _resp_cpu_blocks(self):
+        """Row blocks of _resp_cpu in order, so that memory mapped
+        storage is accessed sequentially."""
+        for model_index in range(self._number_of_models):
+            for slice_big, _ in self._chunks():
+                yield self._model_slice(model_index, slice_big), slice_big
+
+    def _resp_cpu_max_and_sum(self):
+        resp_max = numpy.full(self._number_of_patterns, -numpy.inf,
+                              dtype="float32")
+        resp_sum = numpy.zeros(self._number_of_patterns, dtype="float64")
+        for rows, _ in self._resp_cpu_blocks():
+            block = self._resp_cpu[rows]
+            numpy.maximum(resp_max, block.max(axis=0), out=resp_max)
+            resp_sum += block.sum(axis=0, dtype="float64")
+        return resp_max, numpy.float32(resp_sum)
+
+    def apply_alpha(self):
+        alpha = self._alpha(self._resp_cpu_max_and_sum)
+        for rows, _ in self._resp_cpu_blocks():
+            self._resp_cpu[rows] *= alpha
 
     def model_postprocessing(self):
         pass
 
+    def _model_slice(self, model_index, slice_big):
+        return slice(model_index*self._number_of_rotations + slice_big.start,
+                     model_index*self._number_of_rotations + slice_big.stop)
+
+    def _expand_slices(self, this_model, rotations, slice_small,
+                       keep_table=False):
+        """keep_table is for the rotations of every iteration, not for
+        subsets that change"""
+        if self._two_dimensional:
+            pyemc.expand_model_2d(this_model,
+                                  self._slices[slice_small],
+                                  rotations,
+                                  interpolation=self._interpolation)
+        else:
+            pyemc.expand_model(this_model,
+                               self._slices[slice_small],
+                               rotations,
+                               self._coordinates,
+                               interpolation=self._interpolation,
+                               keep_table=keep_table)
+        self._slices[:, self._mask_inv] = -1
+
+    def _calculate_chunk_resp(self, this_model, slice_big, slice_small):
+        """Expand a chunk of slices and calculate their (unnormalized)
+        log responsabilities into self._resp."""
+        self._expand_slices(this_model, self._rotations[slice_big],
+                            slice_small, keep_table=True)
+        if self._rescale:
+            pyemc.calculate_scaling_poisson(
+                self._patterns,
+                self._slices[slice_small],
+                self._scaling[slice_small],
+                constants=self._pattern_constants)
+        self.calculate_resp(slice_big, slice_small)
+
+    def _expectation_dense(self):
+        resp_cpu_shape = (self._number_of_rotations * self._number_of_models,
+                          self._number_of_patterns)
+        if (
+                self._resp_cpu is None or
+                self._resp_cpu.shape != resp_cpu_shape
+        ):
+            self._resp_cpu = self._allocate_resp_cpu(resp_cpu_shape)
+            if self._rescale:
+                self._scaling_cpu = self._allocate_resp_cpu(resp_cpu_shape)
+
+        self._pipelined_chunks("Loop 1", self._store_chunk)
+
+        # The normalization runs block by block, each pass reading the
+        # rows in order.
+        alpha = self._alpha(self._resp_cpu_max_and_sum)
+        resp_max = numpy.full(self._number_of_patterns, -numpy.inf,
+                              dtype="float32")
+        for rows, _ in self._resp_cpu_blocks():
+            self._resp_cpu[rows] *= alpha
+            numpy.maximum(resp_max, self._resp_cpu[rows].max(axis=0),
+                          out=resp_max)
+
+        # if self._mpi.is_master(): print("Share max")
+        if self._mpi.mpi_on:
+            self._mpi_buffers["resp_1"][...] = resp_max
+            self._mpi.comm_rot.Allreduce(self._mpi_buffers["resp_1"],
+                                         self._mpi_buffers["resp_2"],
+                                         op=self._mpi_flags["MAX"])
+            resp_max = self._mpi_buffers["resp_2"].copy()
+
+        # Subtract max, exp and multiply by the rotation weights
+        resp_sum = numpy.zeros(self._number_of_patterns, dtype="float64")
+        for rows, slice_big in self._resp_cpu_blocks():
+            block = self._resp_cpu[rows]
+            block -= resp_max[numpy.newaxis, :]
+            numpy.exp(block, out=block)
+            block *= self._rotation_weights_cpu[slice_big, numpy.newaxis]
+            resp_sum += block.sum(axis=0, dtype="float64")
+
+        # if self._mpi.is_master(): print("Share sum")
+        if self._mpi.mpi_on:
+            self._mpi_buffers["resp_1"][...] = resp_sum
+            self._mpi.comm_rot.Allreduce(self._mpi_buffers["resp_1"],
+                                         self._mpi_buffers["resp_2"],
+                                         op=self._mpi_flags["SUM"])
+            resp_sum = self._mpi_buffers["resp_2"]
+        else:
+            resp_sum = numpy.float32(resp_sum)
+
+        # if self._mpi.is_master(): print("Normalize")
+        for rows, _ in self._resp_cpu_blocks():
+            self._resp_cpu[rows] /= resp_sum[numpy.newaxis, :]
+
+    def _allocate_resp_cpu(self, shape):
+        if self._resp_storage["method"] == "memmap":
+            # The file is removed as soon as the array is released
+            backing_file = tempfile.TemporaryFile(
+                dir=self._resp_storage["directory"])
+            return numpy.memmap(backing_file, dtype="float32", mode="w+",
+                                shape=shape)
+        return numpy.zeros(shape, dtype="float32")
+
+    def _use_buffer(self, buffer_index):
+        self._resp = self._resp_buffers[buffer_index]
+        if self._rescale:
+            self._scaling = self._scaling_buffers[buffer_index]
+
+    def _pipelined_chunks(self, loop_name, host_work):
+        """Calculate the log responsabilities of every chunk and run
+        host_work(model_index, slice_big, resp, scaling) on each of them
+        through the pipeline."""
+        for model_index, this_model in enumerate(self._model):
+            if self._mpi.is_master() and not self._quiet:
+                print(f"{loop_name}, model {model_index}", flush=True)
+            for slice_big, slice_small in self._chunks():
+                self._use_buffer(self._pipeline.next_buffer())
+                self._calculate_chunk_resp(this_model, slice_big, slice_small)
+                scaling = self._scaling[slice_small] if self._rescale else None
+                self._pipeline.submit(host_work, model_index, slice_big,
+                                      self._resp[slice_small], scaling)
+        self._pipeline.wait()
+
+    def _store_chunk(self, model_index, slice_big, resp, scaling):
+        model_slice = self._model_slice(model_index, slice_big)
+        self._resp_cpu[model_slice, :] = pyemc.asnumpy(resp)
+        if self._rescale:
+            self._scaling_cpu[model_slice, :] = pyemc.asnumpy(scaling)
+
+    def _weighted_log_resp(self, slice_big, resp):
+        """Log responsabilities of a chunk on the host, with alpha and the
+        rotation weights applied."""
+        resp = pyemc.asnumpy(resp) * self._resp_alpha
+        resp += numpy.log(self._rotation_weights_cpu[slice_big,
+                                                     numpy.newaxis])
+        return resp
+
+    def _accumulate_resp_statistics(self, chunk_work=None):
+        """Go through all chunks keeping only the statistics needed to
+        normalize the responsabilities. chunk_work(model_index, slice_big,
+        resp, scaling) is also called with the weighted log
+        responsabilities of each chunk on the host. Adaptive alpha
+        depends on all responsabilities and needs one extra pass."""
+        if self._alpha_method["method"] == "adaptive":
+            raw_max = numpy.full(self._number_of_patterns, -numpy.inf,
+                                 dtype="float32")
+            raw_sum = numpy.zeros(self._number_of_patterns, dtype="float64")
+
+            def add_raw_statistics(model_index, slice_big, resp, scaling):
+                resp = pyemc.asnumpy(resp)
+                numpy.maximum(raw_max, resp.max(axis=0), out=raw_max)
+                numpy.add(raw_sum, resp.sum(axis=0), out=raw_sum)
+            self._pipelined_chunks("Loop 1, alpha", add_raw_statistics)
+            self._resp_alpha = self._alpha(lambda: (raw_max, raw_sum))
+        else:
+            self._resp_alpha = self._alpha(None)
+
+        self._reset_resp_statistics()
+
+        def add_statistics(model_index, slice_big, resp, scaling):
+            resp = self._weighted_log_resp(slice_big, resp)
+            if scaling is not None:
+                scaling = pyemc.asnumpy(scaling)
+            self._add_resp_statistics(resp, model_index, slice_big, scaling)
+            if chunk_work is not None:
+                chunk_work(model_index, slice_big, resp, scaling)
+        self._pipelined_chunks("Loop 1", add_statistics)
+        self._share_resp_statistics()
+
+    def _reset_resp_statistics(self):
+        self._resp_log_max = numpy.full(self._number_of_patterns, -numpy.inf,
+                                        dtype="float32")
+        self._resp_log_sum = numpy.zeros(self._number_of_patterns,
+                                         dtype="float64")
+        self._best_resp_local_index = numpy.zeros(self._number_of_patterns,
+                                                  dtype="int64")
+        if self._rescale:
+            self._best_scaling_cpu = numpy.ones(self._number_of_patterns,
+                                                dtype="float32")
+
+    def _add_resp_statistics(self, resp, model_index, slice_big, scaling):
+        """Running per pattern max and sum of the exponentiated weighted
+        log responsabilities, and the best local state."""
+        chunk_index = resp.argmax(axis=0)
+        chunk_max = resp[chunk_index, numpy.arange(self._number_of_patterns)]
+        better = numpy.flatnonzero(chunk_max > self._resp_log_max)
+        self._best_resp_local_index[better] = (
+            self._model_slice(model_index, slice_big).start +
+            chunk_index[better])
+        if self._rescale:
+            self._best_scaling_cpu[better] = scaling[chunk_index[better],
+                                                     better]
+
+        new_max = numpy.maximum(self._resp_log_max, chunk_max)
+        self._resp_log_sum *= numpy.exp(self._resp_log_max - new_max)
+        self._resp_log_sum += numpy.exp(
+            resp - new_max[numpy.newaxis, :]).sum(axis=0, dtype="float64")
+        self._resp_log_max = new_max
+
+    def _share_resp_statistics(self):
+        local_max = self._resp_log_max
+        if self._mpi.mpi_on:
+            self._mpi.comm_rot.Allreduce(local_max,
+                                         self._mpi_buffers["resp_2"],
+                                         op=self._mpi_flags["MAX"])
+            self._resp_log_max = self._mpi_buffers["resp_2"].copy()
+            self._resp_log_sum *= numpy.exp(local_max - self._resp_log_max)
+            global_sum = numpy.empty_like(self._resp_log_sum)
+            self._mpi.comm_rot.Allreduce(self._resp_log_sum, global_sum,
+                                         op=self._mpi_flags["SUM"])
+            self._resp_log_sum = global_sum
+        self._best_resp_cpu = numpy.float32(
+            numpy.exp(local_max - self._resp_log_max) / self._resp_log_sum)
+
+    def _normalize_log_resp(self, log_resp, patterns=slice(None)):
+        resp = numpy.exp(log_resp - self._resp_log_max[patterns])
+        resp /= self._resp_log_sum[patterns]
+        return numpy.float32(resp)
+
+    def _expectation_recompute(self):
+        """Only the statistics needed to normalize the responsabilities
+        are kept."""
+        self._accumulate_resp_statistics()
+
+    def _recompute_chunk(self, this_model, slice_big, slice_small):
+        self._calculate_chunk_resp(this_model, slice_big, slice_small)
+        resp = self._weighted_log_resp(slice_big, self._resp[slice_small])
+        self._resp[slice_small] = pyemc.asarray(
+            self._normalize_log_resp(resp), dtype="float32")
+
+    def _keep_significant_resp(self, kept):
+        """kept holds the states, patterns and log responsabilities of
+        the entries (and their scalings). Drop entries below the cutoff
+        relative to the current max of their pattern, or outside the
+        top_k of their pattern."""
+        patterns, resp = kept[1], kept[2]
+        if self._resp_storage["top_k"] is not None:
+            # Within each pattern, sort by decreasing resp
+            order = numpy.lexsort((-resp, patterns))
+            sorted_patterns = patterns[order]
+            starts = numpy.searchsorted(sorted_patterns, sorted_patterns)
+            keep = order[numpy.arange(len(order)) - starts <
+                         self._resp_storage["top_k"]]
+        else:
+            threshold = (self._resp_log_max[patterns] +
+                         numpy.log(self._resp_storage["cutoff"]))
+            keep = numpy.flatnonzero(resp >= threshold)
+        return [k[keep] for k in kept]
+
+    def _expectation_sparse(self):
+        """Keep the significant responsabilities as a CSR matrix with one
+        row per state. Entries are selected against the running max and
+        selected again against the final max."""
+        kept = [numpy.zeros(0, dtype="int64"), numpy.zeros(0, dtype="int32"),
+                numpy.zeros(0, dtype="float32")]
+        if self._rescale:
+            kept.append(numpy.zeros(0, dtype="float32"))
+        number_at_last_selection = self._number_of_patterns
+
+        def select_entries(model_index, slice_big, resp, scaling):
+            nonlocal kept, number_at_last_selection
+            if self._resp_storage["top_k"] is None:
+                # Cheap first selection of this chunk
+                threshold = (self._resp_log_max +
+                             numpy.log(self._resp_storage["cutoff"]))
+                rows, patterns = numpy.nonzero(resp >= threshold)
+            else:
+                top_k = min(self._resp_storage["top_k"], len(resp))
+                rows = numpy.argpartition(-resp, top_k-1,
+                                          axis=0)[:top_k].ravel()
+                patterns = numpy.tile(
+                    numpy.arange(self._number_of_patterns), top_k)
+            chunk = [self._model_slice(model_index, slice_big).start + rows,
+                     numpy.int32(patterns), resp[rows, patterns]]
+            if self._rescale:
+                chunk.append(scaling[rows, patterns])
+            kept = [numpy.concatenate(k) for k in zip(kept, chunk)]
+            if len(kept[0]) > 2*number_at_last_selection:
+                kept = self._keep_significant_resp(kept)
+                number_at_last_selection = len(kept[0])
+
+        self._accumulate_resp_statistics(select_entries)
+        self._store_sparse_resp(self._keep_significant_resp(kept))
+
+    def _store_sparse_resp(self, kept):
+        """Normalize the kept entries (see _keep_significant_resp) and
+        store them as a CSR matrix with one row per state."""
+        kept[2] = self._normalize_log_resp(kept[2], kept[1])
+        kept = [k[kept[2] > 0] for k in kept]
+        states, patterns, values = kept[:3]
+
+        order = numpy.lexsort((patterns, states))
+        number_of_states = self._number_of_rotations * self._number_of_models
+        indptr = numpy.zeros(number_of_states+1, dtype="int64")
+        numpy.cumsum(numpy.bincount(states, minlength=number_of_states),
+                     out=indptr[1:])
+        self._resp_sparse = {
+            "indptr": indptr,
+            "patterns": patterns[order],
+            "values": values[order],
+            "scaling": kept[3][order] if self._rescale else None}
+
+    def _evaluate_pairs(self, states, patterns):
+        """Log likelihoods (and scalings) of (state, pattern) pairs. Pairs
+        of the same state must be adjacent. Each chunk of states is only
+        compared to the patterns it is paired with, but as a dense block
+        of all those states and patterns of which only the pairs are
+        kept."""
+        xp = pyemc.array_module()
+        log_likelihoods = numpy.zeros(len(states), dtype="float32")
+        scalings = (numpy.ones(len(states), dtype="float32")
+                    if self._rescale else None)
+        run_starts = numpy.append(
+            numpy.flatnonzero(numpy.diff(states, prepend=-1)), len(states))
+        run_states = states[run_starts[:-1]]
+        run_models = run_states // self._number_of_rotations
+        run_index = 0
+        while run_index < len(run_states):
+            # At most chunk_size states, all of the same model
+            end = min(run_index + self._chunk_size, len(run_states))
+            model_change = numpy.flatnonzero(
+                run_models[run_index:end] != run_models[run_index])
+            if len(model_change) > 0:
+                end = run_index + model_change[0]
+            pairs = slice(run_starts[run_index], run_starts[end])
+            model_index = run_models[run_index]
+            slice_small = slice(0, end - run_index)
+
+            rotation_indices = (run_states[run_index:end] -
+                                model_index*self._number_of_rotations)
+            self._expand_slices(
+                self._model[model_index],
+                self._rotations[pyemc.asarray(rotation_indices,
+                                              dtype="int64")],
+                slice_small)
+            chunk_patterns, columns = numpy.unique(patterns[pairs],
+                                                   return_inverse=True)
+            selected = pyemc.select_patterns(self._patterns, chunk_patterns)
+            constants = pyemc.select_pattern_constants(
+                self._pattern_constants, self._patterns, chunk_patterns)
+            resp = xp.zeros((end - run_index, len(chunk_patterns)),
+                            dtype="float32")
+            scaling = None
+            if self._rescale:
+                scaling = xp.ones_like(resp)
+                pyemc.calculate_scaling_poisson(
+                    selected, self._slices[slice_small], scaling,
+                    constants=constants)
+            pyemc.calculate_responsabilities_poisson(
+                selected, self._slices[slice_small], resp, scalings=scaling,
+                constants=constants)
+
+            rows = pyemc.asarray(
+                numpy.repeat(numpy.arange(end - run_index),
+                             numpy.diff(run_starts[run_index:end+1])),
+                dtype="int64")
+            columns = pyemc.asarray(columns, dtype="int64")
+            log_likelihoods[pairs] = pyemc.asnumpy(resp[rows, columns])
+            if self._rescale:
+                scalings[pairs] = pyemc.asnumpy(scaling[rows, columns])
+            run_index = end
+        return log_likelihoods, scalings
+
+    def _expectation_pairs(self, states, patterns):
+        """Only the given (state, pattern) pairs get responsabilities,
+        which are kept as sparse storage."""
+        log_likelihoods, scalings = self._evaluate_pairs(states, patterns)
+        if self._alpha_method["method"] == "adaptive":
+            # The sum over all states is extrapolated from the pairs
+            raw_max = numpy.full(self._number_of_patterns, -numpy.inf,
+                                 dtype="float32")
+            numpy.maximum.at(raw_max, patterns, log_likelihoods)
+            number_of_pairs = numpy.bincount(
+                patterns, minlength=self._number_of_patterns)
+            raw_sum = (numpy.bincount(patterns, weights=log_likelihoods,
+                                      minlength=self._number_of_patterns) /
+                       numpy.maximum(number_of_pairs, 1) *
+                       self._number_of_rotations * self._number_of_models)
+            self._resp_alpha = self._alpha(lambda: (raw_max, raw_sum))
+        else:
+            self._resp_alpha = self._alpha(None)
+
+        alpha = (self._resp_alpha[patterns]
+                 if numpy.ndim(self._resp_alpha) > 0 else self._resp_alpha)
+        values = numpy.float32(
+            log_likelihoods * alpha +
+            numpy.log(self._rotation_weights_cpu[
+                states % self._number_of_rotations]))
+
+        self._reset_resp_statistics()
+        numpy.maximum.at(self._resp_log_max, patterns, values)
+        self._resp_log_sum += numpy.bincount(
+            patterns, weights=numpy.exp(values -
+                                        self._resp_log_max[patterns]),
+            minlength=self._number_of_patterns)
+        best = numpy.flatnonzero(values == self._resp_log_max[patterns])
+        self._best_resp_local_index[patterns[best]] = states[best]
+        if self._rescale:
+            self._best_scaling_cpu[patterns[best]] = scalings[best]
+        self._share_resp_statistics()
+
+        kept = [states, patterns, values]
+        if self._rescale:
+            kept.append(scalings)
+        self._store_sparse_resp(self._keep_significant_resp(kept))
+
+    def _build_coarse_to_fine(self):
+        """The coarse rotations and, for each of them, the local fine
+        rotations that are closer to it than to any other coarse
+        rotation."""
+        import rotsampling
+        coarse_rotations, coarse_weights = rotsampling.rotsampling(
+            self._coarse_to_fine["n"], return_weights=True)
+        if self._symmetry_group is not None or self._friedel:
+            coarse_rotations, _ = utils.symmetry_reduce_rotations(
+                coarse_rotations, coarse_weights, self._symmetry_group,
+                self._friedel)
+        nearest = utils.nearest_rotations(pyemc.asnumpy(self._rotations),
+                                          coarse_rotations,
+                                          self._symmetry_group, self._friedel)
+        cell_indptr = numpy.zeros(len(coarse_rotations)+1, dtype="int64")
+        numpy.cumsum(numpy.bincount(nearest,
+                                    minlength=len(coarse_rotations)),
+                     out=cell_indptr[1:])
+        self._coarse_to_fine["rotations"] = pyemc.asarray(coarse_rotations,
+                                                          dtype="float32")
+        self._coarse_to_fine["cell_indptr"] = cell_indptr
+        self._coarse_to_fine["cell_members"] = numpy.argsort(nearest,
+                                                             kind="stable")
+
+    def _coarse_to_fine_pairs(self):
+        """(state, pattern) pairs of the fine rotations around the best
+        coarse rotations of each pattern, with the states of a coarse
+        rotation kept together."""
+        coarse_rotations = self._coarse_to_fine["rotations"]
+        number_of_candidates = self._coarse_to_fine["number_of_candidates"]
+        cell_indptr = self._coarse_to_fine["cell_indptr"]
+        cell_sizes = numpy.diff(cell_indptr)
+        # Coarse rotations without local fine rotations are never picked
+        empty_cell = numpy.where(cell_sizes > 0, 0, -numpy.inf)
+
+        best_values = numpy.zeros((0, self._number_of_patterns),
+                                  dtype="float32")
+        best_coarse = numpy.zeros((0, self._number_of_patterns),
+                                  dtype="int64")
+        self._use_buffer(0)
+        for model_index, this_model in enumerate(self._model):
+            if self._mpi.is_master() and not self._quiet:
+                print(f"Coarse loop, model {model_index}", flush=True)
+            for slice_big, slice_small in utils.chunks(len(coarse_rotations),
+                                                       self._chunk_size):
+                self._expand_slices(this_model, coarse_rotations[slice_big],
+                                    slice_small, keep_table=True)
+                if self._rescale:
+                    pyemc.calculate_scaling_poisson(
+                        self._patterns,
+                        self._slices[slice_small],
+                        self._scaling[slice_small],
+                        constants=self._pattern_constants)
+                self.calculate_resp(slice_big, slice_small)
+                values = (pyemc.asnumpy(self._resp[slice_small]) +
+                          empty_cell[slice_big, numpy.newaxis])
+                coarse = (model_index*len(coarse_rotations) +
+                          numpy.arange(slice_big.start, slice_big.stop))
+                best_values = numpy.concatenate([best_values, values])
+                best_coarse = numpy.concatenate([
+                    best_coarse,
+                    numpy.broadcast_to(coarse[:, numpy.newaxis],
+                                       values.shape)])
+                if len(best_values) > number_of_candidates:
+                    top = numpy.argpartition(-best_values,
+                                             number_of_candidates-1,
+                                             axis=0)[:number_of_candidates]
+                    best_values = numpy.take_along_axis(best_values, top, 0)
+                    best_coarse = numpy.take_along_axis(best_coarse, top, 0)
+
+        patterns = numpy.tile(numpy.arange(self._number_of_patterns,
+                                           dtype="int32"), len(best_coarse))
+        valid = numpy.isfinite(best_values.ravel())
+        patterns, best_coarse = patterns[valid], best_coarse.ravel()[valid]
+        model_index, coarse_index = numpy.divmod(best_coarse,
+                                                 len(coarse_rotations))
+
+        # Replace every coarse rotation by the fine ones of its cell
+        counts = cell_sizes[coarse_index]
+        offsets = (numpy.arange(counts.sum()) -
+                   numpy.repeat(numpy.cumsum(counts) - counts, counts))
+        fine = self._coarse_to_fine["cell_members"][
+            numpy.repeat(cell_indptr[coarse_index], counts) + offsets]
+        states = (numpy.repeat(model_index, counts) *
+                  self._number_of_rotations + fine)
+        patterns = numpy.repeat(patterns, counts)
+        order = numpy.lexsort((patterns, states,
+                               numpy.repeat(best_coarse, counts)))
+        return states[order], patterns[order]
+
+    def _prescreening_data(self):
+        """Binned patterns, mask and coordinates, made again when any of
+        them changed."""
+        data = self._prescreening
+        source = (self._patterns, self._mask, self._coordinates)
+        if (
+                data["source"] is None or
+                any(a is not b for a, b in zip(data["source"], source))
+        ):
+            factor = data["binning"]
+            patterns = self._binned(self._patterns, utils.bin_patterns,
+                                    factor)
+            if isinstance(patterns, dict):
+                data["patterns"] = {
+                    key: value if key == "shape"
+                    else pyemc.asarray(value, dtype="int32")
+                    for key, value in patterns.items()}
+            else:
+                data["patterns"] = pyemc.asarray(patterns)
+            data["constants"] = pyemc.pattern_constants(data["patterns"])
+            data["mask_inv"] = ~pyemc.asarray(
+                self._binned(self._mask, utils.bin_mask, factor),
+                dtype="bool")
+            data["coordinates"] = pyemc.asarray(
+                self._binned(self._coordinates, utils.bin_coordinates,
+                             factor), dtype="float32")
+            data["source"] = source
+        slices_shape = (self._chunk_size, ) + data["mask_inv"].shape
+        if data.get("slices") is None or data["slices"].shape != slices_shape:
+            data["slices"] = pyemc.array_module().zeros(slices_shape,
+                                                        dtype="float32")
+        return data
+
+    def _prescreened_pairs(self):
+        """(state, pattern) pairs whose binned log likelihood is within
+        the margin of the best one of their pattern, ordered by state."""
+        data = self._prescreening_data()
+        margin = data["margin"]
+        best = numpy.full(self._number_of_patterns, -numpy.inf,
+                          dtype="float32")
+        kept = [numpy.zeros(0, dtype="int64"), numpy.zeros(0, dtype="int32"),
+                numpy.zeros(0, dtype="float32")]
+        self._use_buffer(0)
+        for model_index, this_model in enumerate(self._model):
+            if self._mpi.is_master() and not self._quiet:
+                print(f"Prescreening, model {model_index}", flush=True)
+            # Binned patterns are sums of binning**2 pixels, the binned
+            # model is an average
+            binned_model = utils.bin_model(pyemc.asnumpy(this_model),
+                                           data["binning"])
+            binned_model[binned_model >= 0] *= data["binning"]**2
+            binned_model = pyemc.asarray(binned_model, dtype="float32")
+            for slice_big, slice_small in self._chunks():
+                slices = data["slices"][slice_small]
+                pyemc.expand_model(binned_model, slices,
+                                   self._rotations[slice_big],
+                                   data["coordinates"],
+                                   interpolation=self._interpolation)
+                slices[:, data["mask_inv"]] = -1
+                scaling = None
+                if self._rescale:
+                    scaling = self._scaling[slice_small]
+                    pyemc.calculate_scaling_poisson(
+                        data["patterns"], slices, scaling,
+                        constants=data["constants"])
+                pyemc.calculate_responsabilities_poisson(
+                    data["patterns"], slices, self._resp[slice_small],
+                    scalings=scaling, constants=data["constants"])
+                resp = pyemc.asnumpy(self._resp[slice_small])
+                numpy.maximum(best, resp.max(axis=0), out=best)
+                rows, patterns = numpy.nonzero(resp >= best - margin)
+                chunk = [self._model_slice(model_index, slice_big).start +
+                         rows, numpy.int32(patterns), resp[rows, patterns]]
+                kept = [numpy.concatenate(k) for k in zip(kept, chunk)]
+
+        if self._mpi.mpi_on:
+            global_best = numpy.empty_like(best)
+            self._mpi.comm_rot.Allreduce(best, global_best,
+                                         op=self._mpi_flags["MAX"])
+            best = global_best
+        states, patterns, values = kept
+        keep = values >= best[patterns] - margin
+        return states[keep], patterns[keep]
+
+    def _reset_search_window(self):
+        """Called after a full sweep"""
+        if self._search_window is not None:
+            self._search_window["iterations_since_full_sweep"] = 0
+
+    def _search_window_pairs(self):
+        """(state, pattern) pairs of the states around the stored
+        responsabilities of the previous iteration, ordered by state."""
+        indptr = self._resp_sparse["indptr"]
+        states = numpy.repeat(numpy.arange(len(indptr)-1), numpy.diff(indptr))
+        patterns = numpy.int64(self._resp_sparse["patterns"])
+        model_index, rotation_index = numpy.divmod(states,
+                                                   self._number_of_rotations)
+
+        neighbour_indptr = self._search_window["neighbour_indptr"]
+        counts = numpy.diff(neighbour_indptr)[rotation_index]
+        offsets = (numpy.arange(counts.sum()) -
+                   numpy.repeat(numpy.cumsum(counts) - counts, counts))
+        neighbours = self._search_window["neighbours"][
+            numpy.repeat(neighbour_indptr[rotation_index], counts) + offsets]
+        states = (numpy.repeat(model_index, counts) *
+                  self._number_of_rotations + neighbours)
+        # Windows of nearby rotations overlap
+        pairs = numpy.unique(states * self._number_of_patterns +
+                             numpy.repeat(patterns, counts))
+        states, patterns = numpy.divmod(pairs, self._number_of_patterns)
+        return states, numpy.int32(patterns)
+
+    def _sparse_chunks(self, model_index):
+        """Chunks of only the rotations of a model with stored
+        responsabilities, as (rotation indices, slice_small), so that the
+        maximization step of pair lists is in proportion to the pairs and
+        not to all rotations."""
+        model_slice = self._model_slice(
+            model_index, slice(0, self._number_of_rotations))
+        counts = numpy.diff(self._resp_sparse["indptr"][model_slice.start:
+                                                        model_slice.stop+1])
+        active = numpy.flatnonzero(counts)
+        return [(active[start:start+self._chunk_size],
+                 slice(0, min(self._chunk_size, len(active)-start)))
+                for start in range(0, len(active), self._chunk_size)]
+
+    def _read_sparse_chunk(self, model_index, active):
+        """Host side part of loading the stored responsabilities of a
+        chunk from _sparse_chunks"""
+        indptr = self._resp_sparse["indptr"]
+        states = model_index*self._number_of_rotations + active
+        counts = indptr[states+1] - indptr[states]
+        # The states in between have no entries
+        entries = slice(indptr[states[0]], indptr[states[-1]+1])
+        values = self._resp_sparse["values"][entries]
+        rows = numpy.repeat(numpy.arange(len(active)), counts)
+        host_chunk = {
+            "active": active,
+            "row_start": numpy.concatenate(([0], numpy.cumsum(counts))),
+            "patterns": self._resp_sparse["patterns"][entries],
+            "values": values,
+            "weights": numpy.bincount(rows, weights=values,
+                                      minlength=len(active))}
+        if self._rescale:
+            host_chunk["scaling"] = self._resp_sparse["scaling"][entries]
+        return host_chunk
+
+    def _update_slices_sparse(self, host_chunk, slice_small):
+        """Update the slices of a chunk from _read_sparse_chunk directly
+        from the stored responsabilities, without a dense chunk of
+        self._resp. Returns the rotations used and the slice weights."""
+        scalings = (pyemc.asarray(host_chunk["scaling"], dtype="float32")
+                    if self._rescale else None)
+        pyemc.update_slices_csr(
+            self._slices[slice_small],
+            self._patterns,
+            pyemc.asarray(host_chunk["row_start"], dtype="int32"),
+            pyemc.asarray(host_chunk["patterns"], dtype="int32"),
+            pyemc.asarray(host_chunk["values"], dtype="float32"),
+            scalings=scalings,
+            constants=self._pattern_constants)
+        rotations = self._rotations[pyemc.asarray(host_chunk["active"],
+                                                  dtype="int64")]
+        slice_weights = pyemc.asarray(host_chunk["weights"], dtype="float32")
+        return rotations, slice_weights
+
+    def _read_dense_chunk(self, model_index, slice_big):
+        """Memory mapped storage is read into memory here, so that it can
+        run ahead in the pipeline."""
+        model_slice = self._model_slice(model_index, slice_big)
+        read = (numpy.array if isinstance(self._resp_cpu, numpy.memmap)
+                else numpy.asarray)
+        resp = read(self._resp_cpu[model_slice])
+        scaling = (read(self._scaling_cpu[model_slice]) if self._rescale
+                   else None)
+        return resp, scaling
+
     def iteration(self):
         if self._mpi.is_master() and not self._quiet:
             print(f"Start iteration {self.current_iteration}", flush=True)
 
+        self._apply_resolution_schedule()
+
         # Check that all the sizes match.
         # Mask, patterns, slices, coordinates
         if self._two_dimensional:
@@ -389,104 +1441,46 @@ class EMC:
                                  "don't match.")
 
         # If slices, resp or scaling is of wrong size, recreate it.
+        xp = pyemc.array_module()
         if (
                 self._slices is None or
                 self._slices.shape[0] != self._chunk_size or
                 self._slices.shape[1:] != self._pattern_shape
         ):
             slices_shape = (self._chunk_size, ) + self._pattern_shape
-            self._slices = cupy.zeros(slices_shape, dtype="float32")
+            self._slices = xp.zeros(slices_shape, dtype="float32")
 
-        resp_cpu_shape = (self._number_of_rotations * self._number_of_models,
-                          self._number_of_patterns)
-        if (
-                self._resp_cpu is None or
-                self._resp_cpu.shape != resp_cpu_shape
-        ):
-            self._resp_cpu = numpy.zeros(resp_cpu_shape,
-                                         dtype="float32")
-            if self._rescale:
-                self._scaling_cpu = numpy.ones(resp_cpu_shape, dtype="float32")
         resp_shape = (self._chunk_size, self._number_of_patterns)
         if (
-                self._resp is None or
-                self._resp.shape != resp_shape
+                len(self._resp_buffers) != self._pipeline.number_of_buffers or
+                self._resp_buffers[0].shape != resp_shape
         ):
-            self._resp = cupy.zeros(resp_shape, dtype="float32")
+            self._resp_buffers = [
+                xp.zeros(resp_shape, dtype="float32")
+                for _ in range(self._pipeline.number_of_buffers)]
             if self._rescale:
-                self._scaling = cupy.ones(resp_shape, dtype="float32")
-
-        for model_index, this_model in enumerate(self._model):
-            if self._mpi.is_master() and not self._quiet:
-                print(f"Loop 1, model {model_index}", flush=True)
-            for slice_big, slice_small in self._chunks():
-                if self._two_dimensional:
-                    pyemc.expand_model_2d(this_model,
-                                          self._slices[slice_small],
-                                          self._rotations[slice_big],
-                                          interpolation=self._interpolation)
-                else:
-                    pyemc.expand_model(this_model,
-                                       self._slices[slice_small],
-                                       self._rotations[slice_big],
-                                       self._coordinates,
-                                       interpolation=self._interpolation)
-                self._slices[:, self._mask_inv] = -1
-                if self._rescale:
-                    pyemc.calculate_scaling_poisson(
-                        self._patterns,
-                        self._slices[slice_small],
-                        self._scaling[slice_small])
-                self.calculate_resp(slice_big,
-                                    slice_small)
-
-                model_slice = slice(model_index*self._number_of_rotations +
-                                    slice_big.start,
-                                    model_index*self._number_of_rotations +
-                                    slice_big.stop)
-                resp_cpu = self._resp[slice_small].get()
-                self._resp_cpu[model_slice, :] = resp_cpu
-                if self._rescale:
-                    scaling_cpu = self._scaling[slice_small].get()
-                    self._scaling_cpu[model_slice, :] = scaling_cpu
-
-        self.apply_alpha()
-
-        # if self._mpi.is_master(): print("Share max")
-        if self._mpi.mpi_on:
-            self._mpi_buffers["resp_1"][...] = self._resp_cpu.max(axis=0)
-            self._mpi.comm_rot.Allreduce(self._mpi_buffers["resp_1"],
-                                         self._mpi_buffers["resp_2"],
-                                         op=self._mpi_flags["MAX"])
-            resp_max = self._mpi_buffers["resp_2"]
+                self._scaling_buffers = [
+                    xp.ones(resp_shape, dtype="float32")
+                    for _ in range(self._pipeline.number_of_buffers)]
+
+        if self._use_search_window():
+            self._expectation_pairs(*self._search_window_pairs())
+            self._search_window["iterations_since_full_sweep"] += 1
+        elif self._coarse_to_fine is not None:
+            self._expectation_pairs(*self._coarse_to_fine_pairs())
+            self._reset_search_window()
+        elif self._prescreening is not None:
+            self._expectation_pairs(*self._prescreened_pairs())
+            self._reset_search_window()
+        elif self._resp_method() == "recompute":
+            self._expectation_recompute()
+            # The slices are expanded again in loop 2
+            previous_model = [m.copy() for m in self._model]
+        elif self._resp_method() == "sparse":
+            self._expectation_sparse()
+            self._reset_search_window()
         else:
-            resp_max = self._resp_cpu.max(axis=0)
-
-        # if self._mpi.is_master(): print("Subtract max")
-        self._resp_cpu -= resp_max[numpy.newaxis, :]
-
-        # if self._mpi.is_master(): print("Exp")
-        numpy.exp(self._resp_cpu, out=self._resp_cpu)
-
-        # if self._mpi.is_master(): print("Rot weight multiply")
-        for model_index in range(self._number_of_models):
-            model_slice = slice(model_index*self._number_of_rotations,
-                                (model_index+1)*self._number_of_rotations)
-            self._resp_cpu[model_slice] *= self._rotation_weights_cpu[
-                :, numpy.newaxis]
-
-        # if self._mpi.is_master(): print("Share sum")
-        if self._mpi.mpi_on:
-            self._mpi_buffers["resp_1"][...] = self._resp_cpu.sum(axis=0)
-            self._mpi.comm_rot.Allreduce(self._mpi_buffers["resp_1"],
-                                         self._mpi_buffers["resp_2"],
-                                         op=self._mpi_flags["SUM"])
-            resp_sum = self._mpi_buffers["resp_2"]
-        else:
-            resp_sum = self._resp_cpu.sum(axis=0)
-
-        # if self._mpi.is_master(): print("Normalize")
-        self._resp_cpu /= resp_sum[numpy.newaxis, :]
+            self._expectation_dense()
 
         # if self._mpi.is_master(): print("Zero models")
         for this_model in self._model:
@@ -499,60 +1493,89 @@ class EMC:
             model_index, (this_model, this_model_weight) = loop_values
             if self._mpi.is_master() and not self._quiet:
                 print(f"Loop 2, model {model_index}", flush=True)
-            for slice_big, slice_small in self._chunks():
-                model_slice = slice(model_index * self._number_of_rotations +
-                                    slice_big.start,
-                                    model_index * self._number_of_rotations +
-                                    slice_big.stop)
-
-                self._resp[slice_small] = cupy.asarray(
-                    self._resp_cpu[model_slice], dtype="float32")
-                if self._rescale:
-                    self._scaling[slice_small] = cupy.asarray(
-                        self._scaling_cpu[model_slice], dtype="float32")
-
-                slice_weights = self._resp[slice_small].sum(axis=1)
-                self.update_slices(slice_big, slice_small)
+            # Reading the stored responsabilities runs ahead
+            if self._resp_method() == "sparse":
+                chunks = self._sparse_chunks(model_index)
+            else:
+                chunks = list(self._chunks())
+            chunk_arguments = [(model_index, slice_big)
+                               for slice_big, _ in chunks]
+            if self._resp_method() == "recompute":
+                host_chunks = itertools.repeat(None)
+            elif self._resp_method() == "sparse":
+                host_chunks = self._pipeline.prefetch(
+                    self._read_sparse_chunk, chunk_arguments)
+            else:
+                host_chunks = self._pipeline.prefetch(
+                    self._read_dense_chunk, chunk_arguments)
+
+            self._use_buffer(0)
+            for (slice_big, slice_small), host_chunk in zip(chunks,
+                                                            host_chunks):
+                if self._resp_method() == "sparse":
+                    rotations, slice_weights = self._update_slices_sparse(
+                        host_chunk, slice_small)
+                else:
+                    rotations = self._rotations[slice_big]
+                    if self._resp_method() == "recompute":
+                        self._recompute_chunk(previous_model[model_index],
+                                              slice_big, slice_small)
+                    else:
+                        resp, scaling = host_chunk
+                        self._resp[slice_small] = pyemc.asarray(
+                            resp, dtype="float32")
+                        if self._rescale:
+                            self._scaling[slice_small] = pyemc.asarray(
+                                scaling, dtype="float32")
+                    slice_weights = self._resp[slice_small].sum(axis=1)
+                    self.update_slices(slice_big, slice_small)
                 self._slices[:, self._mask_inv] = -1
                 if self._two_dimensional:
                     pyemc.insert_slices_2d(this_model,
                                            this_model_weight,
                                            self._slices[slice_small],
                                            slice_weights,
-                                           self._rotations[slice_big],
+                                           rotations,
                                            interpolation=self._interpolation)
                 else:
                     pyemc.insert_slices(this_model,
                                         this_model_weight,
                                         self._slices[slice_small],
                                         slice_weights,
-                                        self._rotations[slice_big],
+                                        rotations,
                                         self._coordinates,
                                         interpolation=self._interpolation)
 
             if self._mpi.mpi_on:
-                self._mpi_buffers["model_1"][...] = this_model.get()
+                self._mpi_buffers["model_1"][...] = pyemc.asnumpy(this_model)
                 self._mpi.comm.Allreduce(self._mpi_buffers["model_1"],
                                          self._mpi_buffers["model_2"],
                                          op=self._mpi_flags["SUM"])
-                this_model[...] = cupy.asarray(self._mpi_buffers["model_2"],
+                this_model[...] = pyemc.asarray(self._mpi_buffers["model_2"],
                                                dtype="float32")
 
-                self._mpi_buffers["model_1"][...] = this_model_weight.get()
+                self._mpi_buffers["model_1"][...] = pyemc.asnumpy(
+                    this_model_weight)
                 self._mpi.comm.Allreduce(self._mpi_buffers["model_1"],
                                          self._mpi_buffers["model_2"],
                                          op=self._mpi_flags["SUM"])
-                this_model_weight[...] = cupy.asarray(
+                this_model_weight[...] = pyemc.asarray(
                     self._mpi_buffers["model_2"], dtype="float32")
             else:
                 pass  # No need to average models when MPI is off.
 
+            if self._symmetry_group is not None or self._friedel:
+                self._symmetrize(this_model)
+                self._symmetrize(this_model_weight)
+
             bad_indices = this_model_weight == 0
             this_model /= this_model_weight
             this_model[bad_indices] = -1.
 
-            # Scaling normalization. Should probably be optional
-            if self._rescale:
+            # Scaling normalization. Should probably be optional. A model
+            # without any responsability, which sparse storage allows, is
+            # left all -1.
+            if self._rescale and not bad_indices.all():
                 this_model /= this_model[~bad_indices].mean()
 
         self.model_postprocessing()
@@ -560,18 +1583,75 @@ class EMC:
         self._best_resp_rot_index = None
         self.current_iteration += 1
 
+    def get_checkpoint(self):
+        """Everything needed to continue the run bit for bit with
+        set_checkpoint, given the same setup and no search windows. The
+        responsabilities of the last iteration, which search windows
+        start from, are not included, so a continued run with search
+        windows does a full sweep first and differs from then on. The best
+        scalings are only included for reference. Must be called on all
+        MPI ranks."""
+        alpha_parameter = (self._alpha_method["speed"]
+                           if self._alpha_method["method"] == "adaptive"
+                           else self._alpha_method["value"])
+        checkpoint = {"models": numpy.array(self.get_model(output_list=True)),
+                      "number_of_models": self._number_of_models,
+                      "current_iteration": self.current_iteration,
+                      "alpha_method": self._alpha_method["method"],
+                      "alpha_parameter": alpha_parameter,
+                      "n": self._n,
+                      "binning": self._binning}
+        if self._rescale:
+            checkpoint["best_scaling"] = self.get_best_scaling()
+        return checkpoint
+
+    def set_checkpoint(self, checkpoint):
+        """Continue from a checkpoint of get_checkpoint. Search windows
+        start again with a full sweep, since the checkpoint has no
+        responsabilities to place them around."""
+        if checkpoint["binning"] != self._binning:
+            self.set_binning(checkpoint["binning"])
+        if checkpoint["n"] != self._n:
+            if self._two_dimensional:
+                self.set_rotsampling_2d(int(checkpoint["n"]))
+            else:
+                self.set_n(int(checkpoint["n"]))
+        self.set_model(list(checkpoint["models"]))
+        # A python scalar, so that it doesn't change the precision
+        self.set_alpha(str(checkpoint["alpha_method"]),
+                       numpy.asarray(checkpoint["alpha_parameter"]).item())
+        self.current_iteration = int(checkpoint["current_iteration"])
+        self._best_resp_rot_index = None
+        self._resp_sparse = None
+
     def get_model(self, output_list=False):
+        """The model in photons per pixel of the current binning, see
+        set_model"""
         if len(self._model) == 1 and not output_list:
-            return self._model[0].get()
+            return pyemc.asnumpy(self._model[0])
         else:
-            return [m.get() for m in self._model]
+            return [pyemc.asnumpy(m) for m in self._model]
+
+    def _local_best_resp(self):
+        """The best local responsability of each pattern and the index
+        of its state."""
+        if self._resp_method() in ("recompute", "sparse"):
+            return self._best_resp_cpu, self._best_resp_local_index
+        return self._resp_cpu.max(axis=0), self._resp_cpu.argmax(axis=0)
+
+    def _local_best_scaling(self):
+        if self._resp_method() in ("recompute", "sparse"):
+            return self._best_scaling_cpu
+        return self._scaling_cpu[self._resp_cpu.argmax(axis=0),
+                                 numpy.arange(self._number_of_patterns)]
 
     def _update_best_resp_index(self):
+        best_resp, best_index = self._local_best_resp()
         if self._mpi.mpi_on:
-            self._mpi.comm_rot.Gather(self._resp_cpu.max(axis=0),
+            self._mpi.comm_rot.Gather(best_resp,
                                       self._mpi_buffers["resp_master"],
                                       root=0)
-            self._mpi.comm_rot.Gather(self._resp_cpu.argmax(axis=0),
+            self._mpi.comm_rot.Gather(best_index,
                                       self._mpi_buffers["resp_index_master"],
                                       root=0)
 
@@ -595,7 +1675,7 @@ class EMC:
             else:
                 self._best_resp_rot_index = True
         else:
-            self._best_resp_rot_index = self._resp_cpu.argmax(axis=0)
+            self._best_resp_rot_index = best_index
 
     def get_best_rotations(self):
         if self._best_resp_rot_index is None:
@@ -643,9 +1723,7 @@ class EMC:
             self._update_best_resp_index()
 
         # Get the scaling for the best LOCAL responsability
-        best_scaling_send = numpy.float32([
-            self._scaling_cpu[self._resp_cpu[:, i].argmax(), i]
-            for i in range(self._number_of_patterns)])
+        best_scaling_send = numpy.float32(self._local_best_scaling())
 
         if self._mpi.mpi_on:
             # Gather all the above scalings to rot_master
@@ -670,13 +1748,12 @@ class EMC:
                 if self._mpi.is_master():
                     return all_scaling
         else:
-            return numpy.int32([self._scaling_cpu[:, i]
-                                for i in self._best_resp_rot_index])
+            return best_scaling_send
         return None
 
     def get_average_best_resp(self):
         if self._mpi.mpi_on:
-            self._mpi.comm_rot.Reduce(self._resp_cpu.max(axis=0),
+            self._mpi.comm_rot.Reduce(self._local_best_resp()[0],
                                       self._mpi_buffers["resp_2"],
                                       op=self._mpi_flags["MAX"],
                                       root=0)
@@ -688,4 +1765,4 @@ class EMC:
                     return best_resp_mean / self._mpi.total_number_of_patterns
             return None
         else:
-            return self._resp_cpu.max(axis=0).mean()
+            return self._local_best_resp()[0].mean()
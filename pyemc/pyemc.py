@@ -1,11 +1,12 @@
-import cupy
 import numpy
 import os
 import functools
 import inspect
 import enum
+import sys
 import time
 from collections import defaultdict
+from . import cpu
 
 
 _NTHREADS = 128
@@ -25,6 +26,80 @@ class PatternType(enum.Enum):
     SPARSER = 4
 
 
+class Backend(enum.Enum):
+    CUDA = 1
+    CPU = 2
+
+
+_backend = None
+
+
+def cuda_is_available():
+    try:
+        import cupy
+    except ImportError:
+        return False
+    return cupy.cuda.is_available()
+
+
+def set_backend(backend):
+    """Select the compute backend, either a Backend or "cuda"/"cpu".
+    Arrays passed to the kernel functions must belong to the selected
+    backend: cupy arrays for CUDA and numpy arrays for CPU."""
+    global _backend
+    if isinstance(backend, str):
+        try:
+            backend = Backend[backend.upper()]
+        except KeyError:
+            raise ValueError(f"{backend} is not a valid backend")
+    backend = Backend(backend)
+    if backend is Backend.CUDA and not cuda_is_available():
+        raise RuntimeError("Can't use the CUDA backend, no CUDA device "
+                           "found.")
+    _backend = backend
+
+
+def get_backend():
+    """Return the active backend. Defaults to CUDA if a device is
+    available and to CPU otherwise."""
+    global _backend
+    if _backend is None:
+        _backend = Backend.CUDA if cuda_is_available() else Backend.CPU
+    return _backend
+
+
+def array_module():
+    """The array module (cupy or numpy) of the active backend"""
+    if get_backend() is Backend.CUDA:
+        import cupy
+        return cupy
+    else:
+        return numpy
+
+
+def asarray(array, dtype=None):
+    """Convert to an array of the active backend"""
+    if get_backend() is Backend.CUDA:
+        import cupy
+        return cupy.asarray(array, dtype=dtype)
+    else:
+        return numpy.asarray(asnumpy(array), dtype=dtype)
+
+
+def asnumpy(array):
+    """Convert an array of either backend to numpy"""
+    if isinstance(array, numpy.ndarray):
+        return array
+    import cupy
+    return cupy.asnumpy(array)
+
+
+def synchronize():
+    if get_backend() is Backend.CUDA:
+        import cupy
+        cupy.cuda.stream.get_current_stream().synchronize()
+
+
 def type_checked(*type_args):
     def decorator(func):
         func_signature = inspect.signature(func)
@@ -57,60 +132,61 @@ def type_checked(*type_args):
                 elif (this_type is PatternType.DENSE or
                       this_type is PatternType.DENSEFLOAT):
                     if (
-                            not isinstance(this_arg, cupy.ndarray) or
-                            cupy.int32 != cupy.dtype(this_arg.dtype)
+                            not isinstance(this_arg,
+                                           array_module().ndarray) or
+                            numpy.int32 != numpy.dtype(this_arg.dtype)
                     ):
                         raise TypeError(
                             f"Argument {this_index} to {func.__name__} must "
-                            "be dense patterns (cupy int32)")
+                            "be dense patterns (int32)")
                 elif this_type is PatternType.SPARSE:
-                    start_indices_type = cupy.dtype(
+                    start_indices_type = numpy.dtype(
                         this_arg["start_indices"].dtype)
-                    indices_type = cupy.dtype(this_arg["indices"].dtype)
-                    values_type = cupy.dtype(this_arg["values"].dtype)
+                    indices_type = numpy.dtype(this_arg["indices"].dtype)
+                    values_type = numpy.dtype(this_arg["values"].dtype)
                     if (not isinstance(this_arg, dict) or not
                         ("start_indices" in this_arg and
-                         start_indices_type == cupy.int32 and
+                         start_indices_type == numpy.int32 and
                          "indices" in this_arg and
-                         indices_type == cupy.int32 and
+                         indices_type == numpy.int32 and
                          "values" in this_arg and
-                         values_type == cupy.int32)):
+                         values_type == numpy.int32)):
                         raise TypeError(
                             f"Argument {this_index} to {func.__name__} must "
                             "be sparse patterns")
                 elif this_type is PatternType.SPARSER:
-                    start_indices_type = cupy.dtype(
+                    start_indices_type = numpy.dtype(
                         this_arg["start_indices"].dtype)
-                    indices_type = cupy.dtype(this_arg["indices"].dtype)
-                    values_type = cupy.dtype(this_arg["values"].dtype)
-                    ones_start_indices_type = cupy.dtype(
+                    indices_type = numpy.dtype(this_arg["indices"].dtype)
+                    values_type = numpy.dtype(this_arg["values"].dtype)
+                    ones_start_indices_type = numpy.dtype(
                         this_arg["ones_start_indices"].dtype)
-                    ones_indices_type = cupy.dtype(
+                    ones_indices_type = numpy.dtype(
                         this_arg["ones_indices"].dtype)
                     if (not isinstance(this_arg, dict) or not
                         ("start_indices" in this_arg and
-                         start_indices_type == cupy.int32 and
+                         start_indices_type == numpy.int32 and
                          "indices" in this_arg and
-                         indices_type == cupy.int32 and
+                         indices_type == numpy.int32 and
                          "values" in this_arg and
-                         values_type == cupy.int32 and
+                         values_type == numpy.int32 and
                          "ones_start_indices" in this_arg and
-                         ones_start_indices_type == cupy.int32 and
+                         ones_start_indices_type == numpy.int32 and
                          "ones_indices" in this_arg and
-                         ones_indices_type == cupy.int32)):
+                         ones_indices_type == numpy.int32)):
                         raise TypeError(
                             f"Argument {this_index} to {func.__name__} must "
                             "be sparse patterns")
                 else:
-                    if not isinstance(this_arg, cupy.ndarray):
+                    if not isinstance(this_arg, array_module().ndarray):
                         raise TypeError(
                             f"Argument {this_index} to {func.__name__} must "
-                            "be a cupy array.")
-                    if cupy.dtype(this_type) != cupy.dtype(this_arg.dtype):
+                            f"be a {array_module().__name__} array.")
+                    if numpy.dtype(this_type) != numpy.dtype(this_arg.dtype):
                         raise TypeError(
                             f"Argument {this_index} to {func.__name__} is of "
-                            f"dtype {cupy.dtype(this_arg.dtype)}, should "
-                            f"be {cupy.dtype(this_type)}")
+                            f"dtype {numpy.dtype(this_arg.dtype)}, should "
+                            f"be {numpy.dtype(this_type)}")
             return func(*args)
         return new_func
     return decorator
@@ -174,7 +250,7 @@ def timed(func):
 
         timer.start(func.__name__)
         ret = func(*args)
-        cupy.cuda.stream.get_current_stream().synchronize()
+        synchronize()
         timer.stop(func.__name__)
 
         return ret
@@ -187,17 +263,30 @@ class LogFactorialTable:
         self._table = None
 
     def _create_table(self, maximum):
-        table = numpy.zeros(int(maximum+1), dtype="float32")
-        table[0] = 0.
-        for i in range(1, int(maximum+1)):
-            table[i] = table[i-1] + numpy.log(i)
-        self._table = cupy.asarray(table, dtype="float32")
+        table = numpy.zeros(int(maximum+1), dtype="float64")
+        numpy.cumsum(numpy.log(numpy.arange(1, int(maximum+1))),
+                     out=table[1:])
+        self._table = array_module().asarray(table, dtype="float32")
+        # What is left of log k! after Stirling's k log k - k
+        k = numpy.arange(int(maximum+1), dtype="float64")
+        remainders = table - k*numpy.log(numpy.maximum(k, 1)) + k
+        self._remainder_table = array_module().asarray(remainders,
+                                                       dtype="float32")
 
     def table(self, maximum):
-        if self._table is None or len(self._table) <= maximum:
+        if (
+                self._table is None or
+                len(self._table) <= maximum or
+                not isinstance(self._table, array_module().ndarray)
+        ):
             self._create_table(maximum)
         return self._table
 
+    def remainder_table(self, maximum):
+        """log k! - k log k + k"""
+        self.table(maximum)
+        return self._remainder_table
+
 
 log_factorial = LogFactorialTable()
 
@@ -209,7 +298,7 @@ class SliceSums:
 
     def _allocate_array(self, size):
         # print(f"Allocate slice sums array of size {size}")
-        self._array = cupy.empty(size, dtype="float32")
+        self._array = array_module().empty(size, dtype="float32")
 
     def array(self, size=None):
         if (
@@ -232,7 +321,64 @@ def print_timing(mpi=None):
         timer.print_total(mpi)
 
 
-def import_cuda_file(file_name, kernel_names, absolute_path=False):
+_KERNEL_FILES = {
+    "emc_cuda.cu":
+    ["kernel_expand_model",
+     "kernel_insert_slices",
+     "kernel_expand_model_2d",
+     "kernel_insert_slices_2d",
+     "kernel_rotate_model"],
+    "calculate_responsabilities_cuda.cu":
+    ["kernel_sum_slices",
+     "kernel_calculate_responsabilities_poisson",
+     "kernel_calculate_responsabilities_poisson_scaling",
+     "kernel_calculate_responsabilities_poisson_per_pattern_scaling",
+     "kernel_calculate_responsabilities_poisson_sparse",
+     "kernel_calculate_responsabilities_poisson_sparse_scaling",
+     "kernel_calculate_responsabilities_poisson_sparse_per_pattern_"
+     "scaling",
+     "kernel_calculate_responsabilities_poisson_sparser",
+     "kernel_calculate_responsabilities_poisson_sparser_scaling",
+     "kernel_calculate_responsabilities_gaussian",
+     "kernel_calculate_responsabilities_gaussian_scaling",
+     "kernel_calculate_responsabilities_gaussian_per_pattern_scaling"],
+    "calculate_scaling_cuda.cu":
+    ["kernel_calculate_scaling_poisson",
+     "kernel_calculate_scaling_poisson_sparse",
+     "kernel_calculate_scaling_poisson_sparser",
+     "kernel_calculate_scaling_per_pattern_poisson",
+     "kernel_calculate_scaling_per_pattern_poisson_sparse"],
+    "update_slices_cuda.cu":
+    ["kernel_normalize_slices",
+     "kernel_update_slices<int>",
+     "kernel_update_slices<float>",
+     "kernel_update_slices_scaling<int>",
+     "kernel_update_slices_scaling<float>",
+     "kernel_update_slices_per_pattern_scaling<int>",
+     "kernel_update_slices_per_pattern_scaling<float>",
+     "kernel_update_slices_sparse",
+     "kernel_update_slices_sparse_scaling",
+     "kernel_update_slices_sparse_per_pattern_scaling",
+     "kernel_update_slices_sparser",
+     "kernel_update_slices_sparser_scaling",
+     "kernel_update_slices_csr<int>",
+     "kernel_update_slices_csr<float>",
+     "kernel_update_slices_sparse_csr",
+     "kernel_update_slices_sparser_csr"],
+    "tools.cu":
+    ["kernel_blur_model"]}
+
+_KERNEL_CACHE_DIR = None
+
+
+def set_kernel_cache_dir(cache_dir):
+    """Directory where compiled kernels are stored between runs. Defaults
+    to the CuPy kernel cache (CUPY_CACHE_DIR or ~/.cupy/kernel_cache)."""
+    global _KERNEL_CACHE_DIR
+    _KERNEL_CACHE_DIR = cache_dir
+
+
+def read_cuda_file(file_name, absolute_path=False):
     threads_code = f"const int NTHREADS = {_NTHREADS};"
     cuda_files_dir = os.path.join(os.path.split(__file__)[0], "cuda")
     header_file = "header.cu"
@@ -242,80 +388,84 @@ def import_cuda_file(file_name, kernel_names, absolute_path=False):
         file_name = os.path.join(cuda_files_dir, file_name)
     with open(file_name, "r") as file_handle:
         main_source = file_handle.read()
-    combined_source = "\n".join((header_source, threads_code, main_source))
+    return "\n".join((header_source, threads_code, main_source))
+
+
+def import_cuda_file(file_name, kernel_names, absolute_path=False):
+    import cupy
+    combined_source = read_cuda_file(file_name, absolute_path)
     module = cupy.RawModule(code=combined_source,
                             options=("--std=c++11", ),
                             name_expressions=kernel_names)
-    import sys
-    module.compile(log_stream=sys.stdout)
+    # CuPy caches the compiled module on disk, keyed by a hash of the
+    # source, so other processes only load it.
+    previous_cache_dir = os.environ.get("CUPY_CACHE_DIR")
+    if _KERNEL_CACHE_DIR is not None:
+        os.environ["CUPY_CACHE_DIR"] = _KERNEL_CACHE_DIR
+    try:
+        module.compile(log_stream=sys.stdout)
+    finally:
+        if previous_cache_dir is None:
+            os.environ.pop("CUPY_CACHE_DIR", None)
+        else:
+            os.environ["CUPY_CACHE_DIR"] = previous_cache_dir
     kernels = {}
     for this_name in kernel_names:
         kernels[this_name] = module.get_function(this_name)
     return kernels
 
 
+class KernelCache:
+    """Compiles the CUDA file containing a kernel the first time the kernel
+    is used. Modules are kept per value of NTHREADS."""
+    def __init__(self):
+        self._file_of_kernel = {this_name: this_file
+                                for this_file, these_names
+                                in _KERNEL_FILES.items()
+                                for this_name in these_names}
+        self._modules = {}
+
+    def _module(self, file_name):
+        key = (file_name, _NTHREADS)
+        if key not in self._modules:
+            self._modules[key] = import_cuda_file(file_name,
+                                                  _KERNEL_FILES[file_name])
+        return self._modules[key]
+
+    def __getitem__(self, kernel_name):
+        if kernel_name not in self._file_of_kernel:
+            raise KeyError(f"Unknown kernel {kernel_name}")
+        return self._module(self._file_of_kernel[kernel_name])[kernel_name]
+
+    def __contains__(self, kernel_name):
+        return kernel_name in self._file_of_kernel
+
+    def compile(self, kernel_names=None):
+        """Compile now instead of on first use, for example on one MPI rank
+        to fill the on disk cache before the other ranks start."""
+        if kernel_names is None:
+            file_names = list(_KERNEL_FILES)
+        else:
+            file_names = {self._file_of_kernel[this_name]
+                          for this_name in kernel_names}
+        for this_file in file_names:
+            self._module(this_file)
+
+    def clear(self):
+        self._modules = {}
+
+
+kernels = KernelCache()
+
+
 def import_kernels():
-    emc_kernels = import_cuda_file(
-        "emc_cuda.cu",
-        ["kernel_expand_model",
-         "kernel_insert_slices",
-         "kernel_expand_model_2d",
-         "kernel_insert_slices_2d",
-         "kernel_rotate_model"])
-    respons_kernels = import_cuda_file(
-        "calculate_responsabilities_cuda.cu",
-        ["kernel_sum_slices",
-         "kernel_calculate_responsabilities_poisson",
-         "kernel_calculate_responsabilities_poisson_scaling",
-         "kernel_calculate_responsabilities_poisson_per_pattern_scaling",
-         "kernel_calculate_responsabilities_poisson_sparse",
-         "kernel_calculate_responsabilities_poisson_sparse_scaling",
-         "kernel_calculate_responsabilities_poisson_sparse_per_pattern_"
-         "scaling",
-         "kernel_calculate_responsabilities_poisson_sparser",
-         "kernel_calculate_responsabilities_poisson_sparser_scaling",
-         "kernel_calculate_responsabilities_gaussian",
-         "kernel_calculate_responsabilities_gaussian_scaling",
-         "kernel_calculate_responsabilities_gaussian_per_pattern_scaling"])
-    scaling_kernels = import_cuda_file(
-        "calculate_scaling_cuda.cu",
-        ["kernel_calculate_scaling_poisson",
-         "kernel_calculate_scaling_poisson_sparse",
-         "kernel_calculate_scaling_poisson_sparser",
-         "kernel_calculate_scaling_per_pattern_poisson",
-         "kernel_calculate_scaling_per_pattern_poisson_sparse"])
-    slices_kernels = import_cuda_file(
-        "update_slices_cuda.cu",
-        ["kernel_normalize_slices",
-         "kernel_update_slices<int>",
-         "kernel_update_slices<float>",
-         "kernel_update_slices_scaling<int>",
-         "kernel_update_slices_scaling<float>",
-         "kernel_update_slices_per_pattern_scaling<int>",
-         "kernel_update_slices_per_pattern_scaling<float>",
-         "kernel_update_slices_sparse",
-         "kernel_update_slices_sparse_scaling",
-         "kernel_update_slices_sparse_per_pattern_scaling",
-         "kernel_update_slices_sparser",
-         "kernel_update_slices_sparser_scaling"])
-    tools_kernels = import_cuda_file(
-        "tools.cu",
-        ["kernel_blur_model"])
-    kernels = {**emc_kernels,
-               **respons_kernels,
-               **scaling_kernels,
-               **slices_kernels,
-               **tools_kernels}
+    kernels.compile()
     return kernels
 
 
 def set_nthreads(nthreads):
-    global _NTHREADS, kernels
+    global _NTHREADS
     _NTHREADS = nthreads
-    kernels = import_kernels()
-
-
-kernels = import_kernels()
 
 
 def number_of_patterns(patterns):
@@ -332,14 +482,202 @@ def pattern_type(patterns):
         else:
             return PatternType.SPARSE
     else:
-        if patterns.dtype == cupy.dtype("int32"):
+        if patterns.dtype == numpy.dtype("int32"):
             return PatternType.DENSE
-        elif patterns.dtype == cupy.dtype("float32"):
+        elif patterns.dtype == numpy.dtype("float32"):
             return PatternType.DENSEFLOAT
         else:
             raise ValueError("Not a regognized pattern format")
 
 
+def select_patterns(patterns, indices):
+    """The patterns with the given indices, in the same format and on
+    the current backend."""
+    if not isinstance(patterns, dict):
+        return patterns[asarray(indices, dtype="int64")]
+    xp = array_module()
+    indices = asarray(indices, dtype="int64")
+    selected = {"shape": patterns["shape"]}
+    prefixes = (("", "ones_") if "ones_start_indices" in patterns
+                else ("", ))
+    for prefix in prefixes:
+        start_indices = patterns[prefix + "start_indices"]
+        starts = start_indices[indices]
+        lengths = start_indices[indices+1] - starts
+        new_start_indices = xp.zeros(len(indices)+1, dtype="int32")
+        new_start_indices[1:] = xp.cumsum(lengths)
+        # Position in the original arrays of every selected entry
+        positions = xp.arange(int(new_start_indices[-1]), dtype="int64")
+        owner = xp.searchsorted(new_start_indices[1:], positions,
+                                side="right")
+        positions += starts[owner] - new_start_indices[owner]
+        selected[prefix + "start_indices"] = new_start_indices
+        selected[prefix + "indices"] = patterns[prefix + "indices"][positions]
+        if prefix == "":
+            selected["values"] = patterns["values"][positions]
+    return selected
+
+
+def _segment_sums(values, start_indices):
+    """Sums of values in the segments given by CSR start_indices"""
+    xp = array_module()
+    cumulative = xp.zeros(len(values)+1, dtype=values.dtype)
+    xp.cumsum(values, out=cumulative[1:])
+    return cumulative[start_indices[1:]] - cumulative[start_indices[:-1]]
+
+
+def pattern_constants(patterns):
+    """Constants of each pattern that the log likelihoods need: the total
+    photons and the sum of log k!, both over the pixels that are not masked
+    out, and the maximum value of the pattern set. Calculate them once
+    when patterns are loaded and pass them along with the patterns. Float
+    patterns have no log factorial sums. The CUDA kernels use the sums of
+    log k! - k log k + k instead."""
+    xp = array_module()
+    if isinstance(patterns, dict):
+        values = patterns["values"]
+        start_indices = patterns["start_indices"]
+        maximum = int(values.max()) if len(values) > 0 else 0
+        photons = _segment_sums(values.astype("int64"), start_indices)
+        if "ones_start_indices" in patterns:
+            photons += xp.diff(patterns["ones_start_indices"].astype("int64"))
+            if len(patterns["ones_indices"]) > 0:
+                maximum = max(maximum, 1)
+        log_factorial_sums = _segment_sums(
+            log_factorial.table(maximum)[values].astype("float64"),
+            start_indices)
+    else:
+        patterns_flat = patterns.reshape((len(patterns), -1))
+        clipped = xp.where(patterns_flat >= 0, patterns_flat, 0)
+        maximum = clipped.max().item() if clipped.size > 0 else 0
+        photons = clipped.sum(axis=1, dtype=(
+            "float64" if clipped.dtype.kind == "f" else "int64"))
+        if clipped.dtype.kind == "f":
+            log_factorial_sums = None
+        else:
+            log_factorial_sums = log_factorial.table(maximum)[clipped].sum(
+                axis=1, dtype="float64")
+    constants = {"photons": photons,
+                 "log_factorial_sums": log_factorial_sums,
+                 "maximum": maximum}
+    if get_backend() is Backend.CPU:
+        # The CPU functions also use per pixel terms of the patterns
+        constants["terms"] = cpu.pattern_terms(
+            patterns, None if log_factorial_sums is None
+            else log_factorial.table(maximum))
+    else:
+        constants["log_factorial_remainders"] = (
+            None if log_factorial_sums is None
+            else _pattern_remainder_sums(patterns, maximum))
+    return constants
+
+
+def _sparse_pixel_sets(patterns):
+    """The (start_indices, indices, values) of sparse patterns, with
+    values of None for the ones of sparser patterns"""
+    pixel_sets = [(patterns["start_indices"], patterns["indices"],
+                   patterns["values"])]
+    if "ones_start_indices" in patterns:
+        pixel_sets.append((patterns["ones_start_indices"],
+                           patterns["ones_indices"], None))
+    return pixel_sets
+
+
+def _remainders(table, values):
+    """The remainders of the table at values, or of ones for None"""
+    if values is None:
+        return table[1]
+    return table[values]
+
+
+def _pattern_remainder_sums(patterns, maximum):
+    """The sums of log k! - k log k + k of each pattern, over the pixels
+    that are not masked out"""
+    xp = array_module()
+    table = log_factorial.remainder_table(maximum)
+    if isinstance(patterns, dict):
+        sums = 0.
+        for start_indices, indices, values in _sparse_pixel_sets(patterns):
+            sums = sums + _segment_sums(
+                xp.broadcast_to(_remainders(table, values),
+                                indices.shape).astype("float64"),
+                start_indices)
+        return sums
+    patterns_flat = patterns.reshape((len(patterns), -1))
+    return xp.where(patterns_flat >= 0, table[xp.maximum(patterns_flat, 0)],
+                    0).sum(axis=1, dtype="float64")
+
+
+def _remainder_corrections(patterns, slices, constants):
+    """The sums of log k! - k log k + k at the pixels where the slice is
+    not valid, for all slice and pattern pairs. The CUDA kernels subtract
+    the remainders of the whole patterns and add these back, so that they
+    don't look up log k! per pixel. Only the pixels that are invalid in
+    any of the slices are looked at."""
+    xp = array_module()
+    table = log_factorial.remainder_table(constants["maximum"])
+    slices_flat = slices.reshape((len(slices), -1))
+    slice_invalid = ~(slices_flat > 0)
+    invalid = xp.flatnonzero(slice_invalid.any(axis=0))
+    if not isinstance(patterns, dict):
+        patterns_invalid = patterns.reshape((len(patterns), -1))[:, invalid]
+        remainders = xp.where(patterns_invalid >= 0,
+                              table[xp.maximum(patterns_invalid, 0)], 0)
+        return xp.ascontiguousarray(
+            slice_invalid[:, invalid].astype("float32") @ remainders.T,
+            dtype="float32")
+    corrections = xp.zeros((len(slices), number_of_patterns(patterns)),
+                           dtype="float32")
+    pixel_invalid = xp.zeros(slices_flat.shape[1], dtype="bool")
+    pixel_invalid[invalid] = True
+    for start_indices, indices, values in _sparse_pixel_sets(patterns):
+        # Start indices of the stored values at the invalid pixels
+        entries = xp.flatnonzero(pixel_invalid[indices])
+        if len(entries) == 0:
+            continue
+        entry_starts = xp.searchsorted(entries, start_indices)
+        remainders = (slice_invalid[:, indices[entries]] *
+                      _remainders(table, None if values is None
+                                  else values[entries]))
+        cumulative = xp.zeros((len(slices), len(entries)+1),
+                              dtype="float64")
+        xp.cumsum(remainders, axis=1, out=cumulative[:, 1:])
+        corrections += (cumulative[:, entry_starts[1:]] -
+                        cumulative[:, entry_starts[:-1]])
+    return corrections
+
+
+def select_pattern_constants(constants, patterns, indices):
+    """The constants of the patterns with the given indices, to go with
+    select_patterns(patterns, indices). The maximum is kept from the
+    whole set."""
+    indices = asarray(indices, dtype="int64")
+    selected = {}
+    for key, value in constants.items():
+        if key == "maximum" or value is None:
+            selected[key] = value
+        elif key == "terms":
+            selected[key] = cpu.select_pattern_terms(value, patterns,
+                                                     indices)
+        else:
+            selected[key] = value[indices]
+    return selected
+
+
+def _backend_constants(patterns, constants):
+    """The given pattern constants, or new ones if there are none or they
+    lack the terms that the CPU functions use or the remainders that the
+    CUDA kernels use"""
+    if (
+            constants is None or
+            (get_backend() is Backend.CPU and "terms" not in constants) or
+            (get_backend() is not Backend.CPU and
+             "log_factorial_remainders" not in constants)
+    ):
+        return pattern_constants(patterns)
+    return constants
+
+
 def npatterns_from_resp(responsabilities):
     return responsabilities.shape[1]
 
@@ -415,10 +753,8 @@ def check_responsabilities(responsabilities, npatterns, nrotations):
 def check_scalings(scalings, npatterns, nrotations):
     if (
             scalings is not None and
-            scalings.shape[0] != nrotations and
-            scalings.shape[1] != npatterns and
-            not (len(scalings.shape) == 1 and
-                 len(scalings) == npatterns)
+            tuple(scalings.shape) != (nrotations, npatterns) and
+            tuple(scalings.shape) != (npatterns, )
     ):
         raise ValueError("Scalings must either be None or have the same shape "
                          "as responsabilities or same length as patterns")
@@ -442,7 +778,7 @@ def check_patterns_sparse(patterns, npatterns, shape):
     if (
             "indices" not in patterns or
             len(patterns["indices"].shape) != 1 or
-            len(patterns["indices"]) != patterns["start_indices"][-1]+1
+            len(patterns["indices"]) != patterns["start_indices"][-1]
     ):
         raise ValueError("Sparse patterns must have key indices with length "
                          "start_indices[-1]")
@@ -473,7 +809,7 @@ def check_patterns_sparser(patterns, npatterns, shape):
     if (
             "indices" not in patterns or
             len(patterns["indices"].shape) != 1 or
-            len(patterns["indices"]) != patterns["start_indices"][-1]+1
+            len(patterns["indices"]) != patterns["start_indices"][-1]
     ):
         raise ValueError("Sparser patterns must have key indices with length "
                          "start_indices[-1]")
@@ -494,7 +830,7 @@ def check_patterns_sparser(patterns, npatterns, shape):
             "ones_indices" not in patterns or
             len(patterns["ones_indices"].shape) != 1 or
             (len(patterns["ones_indices"])
-             != patterns["ones_start_indices"][-1]+1)
+             != patterns["ones_start_indices"][-1])
     ):
         raise ValueError("Sparser patterns must have key ones_indices with "
                          "length ones_start_indices[-1]")
@@ -535,18 +871,26 @@ def check_patterns(patterns, npatterns, shape):
 
 
 @timed
-@type_checked(cupy.float32, cupy.float32, cupy.float32, cupy.float32, None)
+@type_checked(numpy.float32, numpy.float32, numpy.float32, numpy.float32, None)
 def expand_model(model,
                  slices,
                  rotations,
                  coordinates,
-                 interpolation=Interpolation.LINEAR):
-
+                 interpolation=Interpolation.LINEAR,
+                 keep_table=False):
+    """keep_table creates an interpolation table of the rotations on the
+    CPU (see cpu.InterpolationTables), for rotations that are expanded
+    again later"""
     check_model(model)
     check_slices(slices, len(rotations))
     check_rotations(rotations, len(slices))
     check_coordinates(coordinates, slices.shape[1:])
 
+    if get_backend() is Backend.CPU:
+        cpu.expand_model(model, slices, rotations, coordinates,
+                         interpolation.value, keep_table)
+        return
+
     number_of_rotations = len(rotations)
     nblocks = (number_of_rotations, )
     nthreads = (_NTHREADS, )
@@ -566,8 +910,8 @@ def expand_model(model,
 
 
 @timed
-@type_checked(cupy.float32, cupy.float32, cupy.float32, cupy.float32,
-              cupy.float32, cupy.float32, None)
+@type_checked(numpy.float32, numpy.float32, numpy.float32, numpy.float32,
+              numpy.float32, numpy.float32, None)
 def insert_slices(model,
                   model_weights,
                   slices,
@@ -583,6 +927,11 @@ def insert_slices(model,
     check_rotations(rotations, len(slices))
     check_coordinates(coordinates, slices.shape[1:])
 
+    if get_backend() is Backend.CPU:
+        cpu.insert_slices(model, model_weights, slices, slice_weights,
+                          rotations, coordinates, interpolation.value)
+        return
+
     number_of_rotations = len(rotations)
     nblocks = (number_of_rotations, )
     nthreads = (_NTHREADS, )
@@ -607,31 +956,39 @@ def insert_slices(model,
 def update_slices(slices,
                   patterns,
                   responsabilities,
-                  scalings=None):
+                  scalings=None,
+                  constants=None):
     arguments = ((slices, patterns, responsabilities)
                  + ((scalings, ) if scalings is not None else ()))
 
     if pattern_type(patterns) == PatternType.DENSE:
-        update_slices_dense(*arguments)
+        update_slices_dense(*arguments, constants=constants)
     elif pattern_type(patterns) == PatternType.DENSEFLOAT:
-        update_slices_dense_float(*arguments)
+        update_slices_dense_float(*arguments, constants=constants)
     elif pattern_type(patterns) == PatternType.SPARSE:
-        update_slices_sparse(*arguments)
+        update_slices_sparse(*arguments, constants=constants)
     else:
-        update_slices_sparser(*arguments)
+        update_slices_sparser(*arguments, constants=constants)
 
 
-@type_checked(cupy.float32, PatternType.DENSE, cupy.float32, cupy.float32)
+@type_checked(numpy.float32, PatternType.DENSE, numpy.float32, numpy.float32)
 def update_slices_dense(slices,
                         patterns,
                         responsabilities,
-                        scalings=None):
+                        scalings=None,
+                        constants=None):
     check_slices(slices, responsabilities.shape[0])
     check_responsabilities(responsabilities, number_of_patterns(patterns),
                            len(slices))
     check_patterns_dense(patterns, responsabilities.shape[1], slices.shape[1:])
     check_scalings(scalings, number_of_patterns(patterns), len(slices))
 
+    if get_backend() is Backend.CPU:
+        cpu.update_slices_dense(slices, patterns, responsabilities,
+                                _backend_constants(patterns, constants),
+                                scalings)
+        return
+
     number_of_rotations = len(slices)
     nblocks = (number_of_rotations, )
     nthreads = (_NTHREADS, )
@@ -668,13 +1025,14 @@ def update_slices_dense(slices,
              scalings))
 
 
-@type_checked(cupy.float32, PatternType.SPARSE, cupy.float32,
-              cupy.float32, None)
+@type_checked(numpy.float32, PatternType.SPARSE, numpy.float32,
+              numpy.float32, None)
 def update_slices_sparse(slices,
                          patterns,
                          responsabilities,
                          scalings=None,
-                         resp_threshold=0.):
+                         resp_threshold=0.,
+                         constants=None):
     check_slices(slices, responsabilities.shape[0])
     check_responsabilities(responsabilities, number_of_patterns(patterns),
                            len(slices))
@@ -682,6 +1040,12 @@ def update_slices_sparse(slices,
                           slices.shape[1:])
     check_scalings(scalings, number_of_patterns(patterns), len(slices))
 
+    if get_backend() is Backend.CPU:
+        cpu.update_slices_sparse(slices, patterns, responsabilities,
+                                 _backend_constants(patterns, constants),
+                                 scalings, resp_threshold)
+        return
+
     number_of_rotations = len(slices)
     number_of_pixels = slices.shape[1]*slices.shape[2]
     nblocks = (number_of_rotations, )
@@ -748,13 +1112,14 @@ def update_slices_sparse(slices,
              number_of_patterns(patterns)))
 
 
-@type_checked(cupy.float32, PatternType.SPARSER, cupy.float32,
-              cupy.float32, None)
+@type_checked(numpy.float32, PatternType.SPARSER, numpy.float32,
+              numpy.float32, None)
 def update_slices_sparser(slices,
                           patterns,
                           responsabilities,
                           scalings=None,
-                          resp_threshold=0.):
+                          resp_threshold=0.,
+                          constants=None):
     check_slices(slices, responsabilities.shape[0])
     check_responsabilities(responsabilities, number_of_patterns(patterns),
                            len(slices))
@@ -762,6 +1127,15 @@ def update_slices_sparser(slices,
                            slices.shape[1:])
     check_scalings(scalings, number_of_patterns(patterns), len(slices))
 
+    if get_backend() is Backend.CPU:
+        if scalings is not None and len(scalings.shape) == 1:
+            raise NotImplementedError("Can't use per pattern scalign with "
+                                      "sparser format.")
+        cpu.update_slices_sparse(slices, patterns, responsabilities,
+                                 _backend_constants(patterns, constants),
+                                 scalings, resp_threshold)
+        return
+
     number_of_rotations = len(slices)
     number_of_pixels = slices.shape[1]*slices.shape[2]
     nblocks = (number_of_rotations, )
@@ -815,17 +1189,24 @@ def update_slices_sparser(slices,
                                   "sparser format.")
 
 
-@type_checked(cupy.float32, cupy.float32, cupy.float32, cupy.float32)
+@type_checked(numpy.float32, numpy.float32, numpy.float32, numpy.float32)
 def update_slices_dense_float(slices,
                               patterns,
                               responsabilities,
-                              scalings=None):
+                              scalings=None,
+                              constants=None):
     check_slices(slices, responsabilities.shape[0])
     check_responsabilities(responsabilities, number_of_patterns(patterns),
                            len(slices))
     check_patterns_dense(patterns, responsabilities.shape[1], slices.shape[1:])
     check_scalings(scalings, number_of_patterns(patterns), len(slices))
 
+    if get_backend() is Backend.CPU:
+        cpu.update_slices_dense(slices, patterns, responsabilities,
+                                _backend_constants(patterns, constants),
+                                scalings)
+        return
+
     number_of_rotations = len(slices)
     nblocks = (number_of_rotations, )
     nthreads = (_NTHREADS, )
@@ -840,7 +1221,7 @@ def update_slices_dense_float(slices,
              responsabilities))
     elif len(scalings.shape) == 2:
         # Scaling per pattern and slice pair
-        kernels["kernel_update_slices_scaling_float"](
+        kernels["kernel_update_slices_scaling<float>"](
             nblocks,
             nthreads,
             (slices,
@@ -851,7 +1232,7 @@ def update_slices_dense_float(slices,
              scalings))
     else:
         # Scaling per pattern
-        kernels["kernel_update_slices_per_pattern_scaling_float"](
+        kernels["kernel_update_slices_per_pattern_scaling<float>"](
             nblocks,
             nthreads,
             (slices,
@@ -862,36 +1243,155 @@ def update_slices_dense_float(slices,
              scalings))
 
 
+def check_responsabilities_csr(row_start, pattern_list, responsabilities,
+                               npatterns, nrows):
+    if len(row_start.shape) != 1 or len(row_start) != nrows+1:
+        raise ValueError("Row_start must have length nrows+1")
+    if (
+            len(pattern_list.shape) != 1 or
+            len(responsabilities.shape) != 1 or
+            len(pattern_list) != len(responsabilities) or
+            len(pattern_list) != int(row_start[-1])
+    ):
+        raise ValueError("Pattern_list and responsabilities must have one "
+                         "entry per stored responsability")
+    if len(pattern_list) > 0 and int(pattern_list.max()) >= npatterns:
+        raise ValueError(f"Pattern_list must be less than {npatterns}")
+
+
+@timed
+@type_checked(numpy.float32, None, numpy.int32, numpy.int32, numpy.float32,
+              None)
+def update_slices_csr(slices,
+                      patterns,
+                      row_start,
+                      pattern_list,
+                      responsabilities,
+                      scalings=None,
+                      constants=None):
+    """update_slices with only the stored responsabilities: slice r is
+    updated from the patterns pattern_list[row_start[r]:row_start[r+1]]
+    with the responsabilities at the same positions, and the scalings, if
+    any, have one value per stored responsability. The work is in
+    proportion to the stored responsabilities, not to all rotation and
+    pattern pairs. Works with all pattern formats."""
+    check_slices(slices, len(row_start)-1)
+    check_patterns(patterns, number_of_patterns(patterns), slices.shape[1:])
+    check_responsabilities_csr(row_start, pattern_list, responsabilities,
+                               number_of_patterns(patterns), len(slices))
+    if scalings is not None and (
+            scalings.shape != responsabilities.shape or
+            numpy.dtype(scalings.dtype) != numpy.float32
+    ):
+        raise ValueError("Scalings must be float32 with the same shape as "
+                         "responsabilities")
+
+    if get_backend() is Backend.CPU:
+        cpu.update_slices_csr(slices, patterns, row_start, pattern_list,
+                              responsabilities,
+                              _backend_constants(patterns, constants),
+                              scalings)
+        return
+
+    weighted_responsabilities = (responsabilities if scalings is None
+                                 else responsabilities*scalings)
+    number_of_pixels = slices.shape[2]*slices.shape[1]
+    nblocks = (len(slices), )
+    nthreads = (_NTHREADS, )
+    if pattern_type(patterns) == PatternType.DENSE:
+        kernels["kernel_update_slices_csr<int>"](
+            nblocks,
+            nthreads,
+            (slices,
+             patterns,
+             number_of_pixels,
+             row_start,
+             pattern_list,
+             responsabilities,
+             weighted_responsabilities))
+    elif pattern_type(patterns) == PatternType.DENSEFLOAT:
+        kernels["kernel_update_slices_csr<float>"](
+            nblocks,
+            nthreads,
+            (slices,
+             patterns,
+             number_of_pixels,
+             row_start,
+             pattern_list,
+             responsabilities,
+             weighted_responsabilities))
+    elif pattern_type(patterns) == PatternType.SPARSE:
+        kernels["kernel_update_slices_sparse_csr"](
+            nblocks,
+            nthreads,
+            (slices,
+             number_of_pixels,
+             patterns["start_indices"],
+             patterns["indices"],
+             patterns["values"],
+             row_start,
+             pattern_list,
+             responsabilities,
+             weighted_responsabilities))
+    else:
+        kernels["kernel_update_slices_sparser_csr"](
+            nblocks,
+            nthreads,
+            (slices,
+             number_of_pixels,
+             patterns["start_indices"],
+             patterns["indices"],
+             patterns["values"],
+             patterns["ones_start_indices"],
+             patterns["ones_indices"],
+             row_start,
+             pattern_list,
+             responsabilities,
+             weighted_responsabilities))
+
+
 @timed
 def calculate_responsabilities_poisson(patterns,
                                        slices,
                                        responsabilities,
-                                       scalings=None):
+                                       scalings=None,
+                                       constants=None):
     arguments = ((patterns, slices, responsabilities)
                  + ((scalings, ) if scalings is not None else ()))
     if isinstance(patterns, dict):
         # sparse data
         if "ones_start_indices" in patterns:
-            calculate_responsabilities_poisson_sparser(*arguments)
+            calculate_responsabilities_poisson_sparser(*arguments,
+                                                       constants=constants)
         else:
-            calculate_responsabilities_poisson_sparse(*arguments)
+            calculate_responsabilities_poisson_sparse(*arguments,
+                                                      constants=constants)
     else:
         # dense data
-        calculate_responsabilities_poisson_dense(*arguments)
+        calculate_responsabilities_poisson_dense(*arguments,
+                                                 constants=constants)
 
 
-@type_checked(PatternType.DENSE, cupy.float32, cupy.float32, cupy.float32)
+@type_checked(PatternType.DENSE, numpy.float32, numpy.float32, numpy.float32)
 def calculate_responsabilities_poisson_dense(patterns,
                                              slices,
                                              responsabilities,
-                                             scalings=None):
+                                             scalings=None,
+                                             constants=None):
     check_responsabilities(responsabilities, number_of_patterns(patterns),
                            len(slices))
     check_patterns_dense(patterns, responsabilities.shape[1], slices.shape[1:])
     check_slices(slices, responsabilities.shape[0])
     check_scalings(scalings, number_of_patterns(patterns), len(slices))
 
-    patterns_max = patterns.max()
+    constants = _backend_constants(patterns, constants)
+    patterns_max = constants["maximum"]
+    if get_backend() is Backend.CPU:
+        cpu.calculate_responsabilities_poisson_dense(
+            patterns, slices, responsabilities,
+            log_factorial.table(patterns_max), constants, scalings)
+        return
+
     number_of_rotations = len(slices)
     nblocks = (number_of_patterns(patterns), number_of_rotations)
     nthreads = (_NTHREADS, )
@@ -903,7 +1403,8 @@ def calculate_responsabilities_poisson_dense(patterns,
              slices,
              slices.shape[2]*slices.shape[1],
              responsabilities,
-             log_factorial.table(patterns_max)))
+             constants["log_factorial_remainders"],
+             _remainder_corrections(patterns, slices, constants)))
     elif len(scalings.shape) == 2:
         # Scaling per pattern and slice pair
         kernels["kernel_calculate_responsabilities_poisson_scaling"](
@@ -914,7 +1415,8 @@ def calculate_responsabilities_poisson_dense(patterns,
              slices.shape[2]*slices.shape[1],
              scalings,
              responsabilities,
-             log_factorial.table(patterns_max)))
+             constants["log_factorial_remainders"],
+             _remainder_corrections(patterns, slices, constants)))
     else:
         # Scaling per pattern
         kernels["kernel_calculate_responsabilities_poisson_per_pattern_"
@@ -926,14 +1428,16 @@ def calculate_responsabilities_poisson_dense(patterns,
                      slices.shape[2]*slices.shape[1],
                      scalings,
                      responsabilities,
-                     log_factorial.table(patterns_max)))
+                     constants["log_factorial_remainders"],
+                     _remainder_corrections(patterns, slices, constants)))
 
 
-@type_checked(PatternType.SPARSE, cupy.float32, cupy.float32, cupy.float32)
+@type_checked(PatternType.SPARSE, numpy.float32, numpy.float32, numpy.float32)
 def calculate_responsabilities_poisson_sparse(patterns,
                                               slices,
                                               responsabilities,
-                                              scalings=None):
+                                              scalings=None,
+                                              constants=None):
     check_responsabilities(responsabilities, number_of_patterns(patterns),
                            len(slices))
     check_patterns_sparse(patterns, responsabilities.shape[1],
@@ -941,7 +1445,14 @@ def calculate_responsabilities_poisson_sparse(patterns,
     check_slices(slices, responsabilities.shape[0])
     check_scalings(scalings, number_of_patterns(patterns), len(slices))
 
-    patterns_max = patterns["values"].max()
+    constants = _backend_constants(patterns, constants)
+    patterns_max = constants["maximum"]
+    if get_backend() is Backend.CPU:
+        cpu.calculate_responsabilities_poisson_sparse(
+            patterns, slices, responsabilities,
+            log_factorial.table(patterns_max), constants, scalings)
+        return
+
     number_of_rotations = len(slices)
     nblocks_sum_slices = (number_of_rotations, )
     nblocks_calculate_responsabilitites = (number_of_patterns(patterns),
@@ -954,7 +1465,7 @@ def calculate_responsabilities_poisson_sparse(patterns,
             (slices,
              slices.shape[1]*slices.shape[2],
              slice_sums.array(len(slices))))
-        kernels["kernel_calculate_responsabilities_sparse"](
+        kernels["kernel_calculate_responsabilities_poisson_sparse"](
             nblocks_calculate_responsabilitites,
             nthreads,
             (patterns["start_indices"],
@@ -964,7 +1475,8 @@ def calculate_responsabilities_poisson_sparse(patterns,
              slices.shape[2]*slices.shape[1],
              responsabilities,
              slice_sums.array(),
-             log_factorial.table(patterns_max)))
+             constants["log_factorial_remainders"],
+             _remainder_corrections(patterns, slices, constants)))
     elif len(scalings.shape) == 2:
         kernels["kernel_sum_slices"](
             nblocks_sum_slices,
@@ -972,7 +1484,7 @@ def calculate_responsabilities_poisson_sparse(patterns,
             (slices,
              slices.shape[1]*slices.shape[2],
              slice_sums.array(len(slices))))
-        kernels["kernel_calculate_responsabilities_sparse_scaling"](
+        kernels["kernel_calculate_responsabilities_poisson_sparse_scaling"](
             nblocks_calculate_responsabilitites,
             nthreads,
             (patterns["start_indices"],
@@ -983,16 +1495,17 @@ def calculate_responsabilities_poisson_sparse(patterns,
              scalings,
              responsabilities,
              slice_sums.array(),
-             log_factorial.table(patterns_max)))
+             constants["log_factorial_remainders"],
+             _remainder_corrections(patterns, slices, constants)))
     else:
         kernels["kernel_sum_slices"](
             nblocks_sum_slices,
             nthreads,
             (slices,
              slices.shape[1]*slices.shape[2],
-             slice_sums.array(len(slice))))
-        kernels["kernel_calculate_responsabilities_sparse_per_pattern_"
-                "scaling"](
+             slice_sums.array(len(slices))))
+        kernels["kernel_calculate_responsabilities_poisson_sparse_"
+                "per_pattern_scaling"](
                     nblocks_calculate_responsabilitites,
                     nthreads,
                     (patterns["start_indices"],
@@ -1003,22 +1516,34 @@ def calculate_responsabilities_poisson_sparse(patterns,
                      scalings,
                      responsabilities,
                      slice_sums.array(),
-                     log_factorial.table(patterns_max)))
+                     constants["log_factorial_remainders"],
+                     _remainder_corrections(patterns, slices, constants)))
 
 
-@type_checked(PatternType.SPARSER, cupy.float32, cupy.float32, cupy.float32)
+@type_checked(PatternType.SPARSER, numpy.float32, numpy.float32, numpy.float32)
 def calculate_responsabilities_poisson_sparser(patterns,
                                                slices,
                                                responsabilities,
-                                               scalings=None):
+                                               scalings=None,
+                                               constants=None):
     check_responsabilities(responsabilities, number_of_patterns(patterns),
                            len(slices))
     check_patterns_sparser(patterns, responsabilities.shape[1],
                            slices.shape[1:])
     check_slices(slices, responsabilities.shape[0])
     check_scalings(scalings, number_of_patterns(patterns), len(slices))
+    if scalings is not None and len(scalings.shape) == 1:
+        raise NotImplementedError("Can't use per pattern scaling together "
+                                  "with sparser format.")
+
+    constants = _backend_constants(patterns, constants)
+    patterns_max = constants["maximum"]
+    if get_backend() is Backend.CPU:
+        cpu.calculate_responsabilities_poisson_sparse(
+            patterns, slices, responsabilities,
+            log_factorial.table(patterns_max), constants, scalings)
+        return
 
-    patterns_max = patterns["values"].max()
     number_of_rotations = len(slices)
     nblocks_sum_slices = (number_of_rotations, )
     nblocks_calculate_responsabilitites = (number_of_patterns(patterns),
@@ -1031,7 +1556,7 @@ def calculate_responsabilities_poisson_sparser(patterns,
             (slices,
              slices.shape[1]*slices.shape[2],
              slice_sums.array(len(slices))))
-        kernels["kernel_calculate_responsabilities_sparser"](
+        kernels["kernel_calculate_responsabilities_poisson_sparser"](
             nblocks_calculate_responsabilitites,
             nthreads,
             (patterns["start_indices"],
@@ -1043,7 +1568,8 @@ def calculate_responsabilities_poisson_sparser(patterns,
              slices.shape[2]*slices.shape[1],
              responsabilities,
              slice_sums.array(),
-             log_factorial.table(patterns_max)))
+             constants["log_factorial_remainders"],
+             _remainder_corrections(patterns, slices, constants)))
     elif len(scalings.shape) == 2:
         kernels["kernel_sum_slices"](
             nblocks_sum_slices,
@@ -1051,7 +1577,7 @@ def calculate_responsabilities_poisson_sparser(patterns,
             (slices,
              slices.shape[1]*slices.shape[2],
              slice_sums.array(len(slices))))
-        kernels["kernel_calculate_responsabilities_sparser_scaling"](
+        kernels["kernel_calculate_responsabilities_poisson_sparser_scaling"](
             nblocks_calculate_responsabilitites,
             nthreads,
             (patterns["start_indices"],
@@ -1064,30 +1590,38 @@ def calculate_responsabilities_poisson_sparser(patterns,
              scalings,
              responsabilities,
              slice_sums.array(),
-             log_factorial.table(patterns_max)))
-    else:
-        raise NotImplementedError("Can't use per pattern scaling together "
-                                  "with sparser format.")
+             constants["log_factorial_remainders"],
+             _remainder_corrections(patterns, slices, constants)))
 
 
 @timed
-def calculate_scaling_poisson(patterns, slices, scaling):
+def calculate_scaling_poisson(patterns, slices, scaling, constants=None):
     if isinstance(patterns, dict):
         # patterns are spares
         if "ones_start_indices" in patterns:
-            calculate_scaling_poisson_sparser(patterns, slices, scaling)
+            calculate_scaling_poisson_sparser(patterns, slices, scaling,
+                                              constants)
         else:
-            calculate_scaling_poisson_sparse(patterns, slices, scaling)
+            calculate_scaling_poisson_sparse(patterns, slices, scaling,
+                                             constants)
     else:
-        calculate_scaling_poisson_dense(patterns, slices, scaling)
+        calculate_scaling_poisson_dense(patterns, slices, scaling,
+                                        constants)
 
 
-@type_checked(PatternType.DENSE, cupy.float32, cupy.float32)
-def calculate_scaling_poisson_dense(patterns, slices, scaling):
+@type_checked(PatternType.DENSE, numpy.float32, numpy.float32)
+def calculate_scaling_poisson_dense(patterns, slices, scaling,
+                                    constants=None):
     check_scalings(scaling, number_of_patterns(patterns), len(slices))
     check_patterns_dense(patterns, scaling.shape[1], slices.shape[1:])
     check_slices(slices, scaling.shape[0])
 
+    if get_backend() is Backend.CPU:
+        cpu.calculate_scaling_poisson_dense(
+            patterns, slices, scaling,
+            _backend_constants(patterns, constants))
+        return
+
     number_of_rotations = len(slices)
     nblocks = (number_of_patterns(patterns), number_of_rotations)
     nthreads = (_NTHREADS, )
@@ -1100,14 +1634,21 @@ def calculate_scaling_poisson_dense(patterns, slices, scaling):
          slices.shape[1]*slices.shape[2]))
 
 
-@type_checked(PatternType.SPARSE, cupy.float32, cupy.float32)
+@type_checked(PatternType.SPARSE, numpy.float32, numpy.float32)
 def calculate_scaling_poisson_sparse(patterns,
                                      slices,
-                                     scaling):
+                                     scaling,
+                                     constants=None):
     check_scalings(scaling, number_of_patterns(patterns), len(slices))
     check_patterns_sparse(patterns, scaling.shape[1], slices.shape[1:])
     check_slices(slices, scaling.shape[0])
 
+    if get_backend() is Backend.CPU:
+        cpu.calculate_scaling_poisson_sparse(
+            patterns, slices, scaling,
+            _backend_constants(patterns, constants))
+        return
+
     number_of_rotations = len(slices)
     nblocks = (number_of_patterns(patterns), number_of_rotations)
     nthreads = (_NTHREADS, )
@@ -1122,14 +1663,21 @@ def calculate_scaling_poisson_sparse(patterns,
          slices.shape[1]*slices.shape[2]))
 
 
-@type_checked(PatternType.SPARSER, cupy.float32, cupy.float32)
+@type_checked(PatternType.SPARSER, numpy.float32, numpy.float32)
 def calculate_scaling_poisson_sparser(patterns,
                                       slices,
-                                      scaling):
+                                      scaling,
+                                      constants=None):
     check_scalings(scaling, number_of_patterns(patterns), len(slices))
     check_patterns_sparser(patterns, scaling.shape[1], slices.shape[1:])
     check_slices(slices, scaling.shape[0])
 
+    if get_backend() is Backend.CPU:
+        cpu.calculate_scaling_poisson_sparse(
+            patterns, slices, scaling,
+            _backend_constants(patterns, constants))
+        return
+
     number_of_rotations = len(slices)
     nblocks = (number_of_patterns(patterns), number_of_rotations)
     nthreads = (_NTHREADS, )
@@ -1148,29 +1696,40 @@ def calculate_scaling_poisson_sparser(patterns,
 
 def calculate_scaling_per_pattern_poisson(patterns,
                                           slices,
-                                          scaling):
+                                          responsabilities,
+                                          scaling,
+                                          constants=None):
     if isinstance(patterns, dict):
         # patterns are spares
         if "ones_start_indices" in patterns:
             raise NotImplementedError("Can't use spraseR format with per "
                                       "pattern scaling.")
         else:
-            calculate_scaling_per_pattern_poisson_sparse(patterns, slices,
-                                                         scaling)
+            calculate_scaling_per_pattern_poisson_sparse(
+                patterns, slices, responsabilities, scaling, constants)
     else:
-        calculate_scaling_per_pattern_poisson_dense(patterns, slices, scaling)
+        calculate_scaling_per_pattern_poisson_dense(
+            patterns, slices, responsabilities, scaling, constants)
 
 
-@type_checked(PatternType.DENSE, cupy.float32, cupy.float32, cupy.float32)
+@type_checked(PatternType.DENSE, numpy.float32, numpy.float32, numpy.float32)
 def calculate_scaling_per_pattern_poisson_dense(patterns,
                                                 slices,
                                                 responsabilities,
-                                                scaling):
+                                                scaling,
+                                                constants=None):
     check_scalings(scaling, number_of_patterns(patterns), len(slices))
     check_responsabilities(responsabilities, number_of_patterns(patterns),
                            len(slices))
-    check_patterns_dense(patterns, scaling.shape[1], slices.shape[1:])
-    check_slices(slices, scaling.shape[0])
+    check_patterns_dense(patterns, responsabilities.shape[1],
+                         slices.shape[1:])
+    check_slices(slices, responsabilities.shape[0])
+
+    if get_backend() is Backend.CPU:
+        cpu.calculate_scaling_per_pattern_poisson_dense(
+            patterns, slices, responsabilities, scaling,
+            _backend_constants(patterns, constants))
+        return
 
     number_of_rotations = len(slices)
     nblocks = (number_of_patterns(patterns), )
@@ -1186,16 +1745,25 @@ def calculate_scaling_per_pattern_poisson_dense(patterns,
          number_of_rotations))
 
 
-@type_checked(PatternType.SPARSE, cupy.float32, cupy.float32)
+@type_checked(PatternType.SPARSE, numpy.float32, numpy.float32,
+              numpy.float32)
 def calculate_scaling_per_pattern_poisson_sparse(patterns,
                                                  slices,
                                                  responsabilities,
-                                                 scaling):
+                                                 scaling,
+                                                 constants=None):
     check_scalings(scaling, number_of_patterns(patterns), len(slices))
     check_responsabilities(responsabilities, number_of_patterns(patterns),
                            len(slices))
-    check_patterns_sparse(patterns, scaling.shape[1], slices.shape[1:])
-    check_slices(slices, scaling.shape[0])
+    check_patterns_sparse(patterns, responsabilities.shape[1],
+                          slices.shape[1:])
+    check_slices(slices, responsabilities.shape[0])
+
+    if get_backend() is Backend.CPU:
+        cpu.calculate_scaling_per_pattern_poisson_sparse(
+            patterns, slices, responsabilities, scaling,
+            _backend_constants(patterns, constants))
+        return
 
     number_of_rotations = len(slices)
     nblocks = (number_of_patterns(patterns), )
@@ -1214,7 +1782,7 @@ def calculate_scaling_per_pattern_poisson_sparse(patterns,
 
 
 @timed
-@type_checked(cupy.float32, cupy.float32, cupy.float32)
+@type_checked(numpy.float32, numpy.float32, numpy.float32)
 def expand_model_2d(model,
                     slices,
                     rotations):
@@ -1222,6 +1790,10 @@ def expand_model_2d(model,
     check_slices(slices, len(rotations))
     check_rotations_2d(rotations, len(slices))
 
+    if get_backend() is Backend.CPU:
+        cpu.expand_model_2d(model, slices, rotations)
+        return
+
     number_of_rotations = len(rotations)
     nblocks = (number_of_rotations, )
     nthreads = (_NTHREADS, )
@@ -1238,8 +1810,8 @@ def expand_model_2d(model,
 
 
 @timed
-@type_checked(cupy.float32, cupy.float32, cupy.float32, cupy.float32,
-              cupy.float32, None)
+@type_checked(numpy.float32, numpy.float32, numpy.float32, numpy.float32,
+              numpy.float32, None)
 def insert_slices_2d(model,
                      model_weights,
                      slices,
@@ -1252,6 +1824,11 @@ def insert_slices_2d(model,
     check_slice_weights(slice_weights, len(rotations))
     check_rotations_2d(rotations, len(slices))
 
+    if get_backend() is Backend.CPU:
+        cpu.insert_slices_2d(model, model_weights, slices, slice_weights,
+                             rotations, interpolation.value)
+        return
+
     number_of_rotations = len(rotations)
     nblocks = (number_of_rotations, )
     nthreads = (_NTHREADS, )
@@ -1271,24 +1848,25 @@ def insert_slices_2d(model,
 
 
 @timed
-@type_checked(None, cupy.float32, cupy.float32, None)
+@type_checked(None, numpy.float32, numpy.float32, None)
 def assemble_model(patterns,
                    rotations,
                    coordinates,
                    shape=None):
-    slice_weights = cupy.ones(len(rotations), dtype="float32")
+    xp = array_module()
+    slice_weights = xp.ones(len(rotations), dtype="float32")
 
     if isinstance(patterns, dict):
         raise NotImplementedError("assemble_model does not support sparse "
                                   "data")
 
-    patterns = cupy.asarray(patterns, dtype="float32")
-    rotations = cupy.asarray(rotations, dtype="float32")
+    patterns = asarray(patterns, dtype="float32")
+    rotations = asarray(rotations, dtype="float32")
 
     if shape is None:
         shape = ((patterns.shape[1] + patterns.shape[2])//2, )*3
-    model = cupy.zeros(shape, dtype="float32")
-    model_weights = cupy.zeros(shape, dtype="float32")
+    model = xp.zeros(shape, dtype="float32")
+    model_weights = xp.zeros(shape, dtype="float32")
 
     insert_slices(model, model_weights, patterns,
                   slice_weights, rotations, coordinates)
@@ -1301,24 +1879,33 @@ def assemble_model(patterns,
 
 
 @timed
-@type_checked(cupy.float32, None, None)
+@type_checked(numpy.float32, None, None)
 def blur_model(model, sigma, cutoff):
-    tmp_model = cupy.zeros_like(model)
+    if get_backend() is Backend.CPU:
+        model[...] = cpu.blur_model(model, sigma, cutoff)
+        return
+
+    tmp_model = array_module().zeros_like(model)
     nblocks = (model.shape[0], model.shape[1])
     nthreads = (model.shape[2], )
     kernels["kernel_blur_model"](
         nblocks, nthreads,
-        (tmp_model, model, cupy.float32(sigma), cutoff))
+        (tmp_model, model, numpy.float32(sigma), cutoff))
     model[:] = tmp_model[:]
     del tmp_model
 
 
 @timed
-@type_checked(cupy.float32, cupy.float32)
+@type_checked(numpy.float32, numpy.float32)
 def rotate_model(model, rotation):
     if rotation.shape != (4, ):
         raise ValueError("Rotation must be a length-4 array (quaternion)")
-    return_model = cupy.zeros_like(model)
+    if get_backend() is Backend.CPU:
+        return_model = numpy.zeros_like(model)
+        cpu.rotate_model(model, return_model, rotation)
+        return return_model
+
+    return_model = array_module().zeros_like(model)
     nblocks = ((model.shape[0] * model.shape[1] * model.shape[2] - 1)
                // _NTHREADS + 1, )
     nthreads = (_NTHREADS, )
@@ -1329,7 +1916,7 @@ def rotate_model(model, rotation):
     return return_model
 
 
-@type_checked(cupy.float32, cupy.float32, cupy.float32)
+@type_checked(numpy.float32, numpy.float32, numpy.float32)
 def calculate_responsabilities_gaussian_dense(patterns,
                                               slices,
                                               responsabilities):
@@ -1339,6 +1926,11 @@ def calculate_responsabilities_gaussian_dense(patterns,
     check_responsabilities(responsabilities, number_of_patterns(patterns),
                            len(slices))
 
+    if get_backend() is Backend.CPU:
+        cpu.calculate_responsabilities_gaussian_dense(patterns, slices,
+                                                      responsabilities)
+        return
+
     number_of_rotations = len(slices)
     nblocks = (number_of_patterns(patterns), number_of_rotations)
     nthreads = (_NTHREADS, )
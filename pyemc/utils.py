@@ -1,8 +1,8 @@
-import cupy
-import h5py
 import numpy
 import warnings
+from . import cpu
 from . import mpi as mpi_module
+from . import pyemc
 
 
 def ewald_coordinates(image_shape, wavelength, detector_distance, pixel_size,
@@ -44,12 +44,13 @@ def ewald_coordinates(image_shape, wavelength, detector_distance, pixel_size,
     if output_type.lower() == "numpy":
         output_module = numpy
     elif output_type.lower() == "cupy":
-        if not cupy.cuda.is_available():
+        if not pyemc.cuda_is_available():
             warnings.warn("in function ewald_coordinates: Trying to use "
                           "output_type cupy with no available CUDA devices. "
                           "Reverting to numpy")
             output_module = numpy
         else:
+            import cupy
             output_module = cupy
 
     return output_module.asarray(output_coordinates, dtype="float32")
@@ -57,23 +58,22 @@ def ewald_coordinates(image_shape, wavelength, detector_distance, pixel_size,
 
 def read_sparse_data(file_name, file_key=None, start_index=0, end_index=-1,
                      output_type="numpy"):
+    import h5py
     with h5py.File(file_name, "r") as file_handle:
         if file_key is None:
             group = file_handle
         else:
             group = file_handle[file_key]
         all_start_indices = group["start_indices"][...]
+        if end_index == -1:
+            end_index = len(all_start_indices)-1
         value_start_index = all_start_indices[start_index]
-        if end_index == len(all_start_indices)-1 or end_index == -1:
-            value_end_index = -1
-        else:
-            value_end_index = all_start_indices[end_index]
-        # if end_index == -1:
-        #     end_index = len(all_start_indices)-1
+        value_end_index = all_start_indices[end_index]
 
         if output_type.lower() == "numpy":
             output_module = numpy
         elif output_type.lower() == "cupy":
+            import cupy
             output_module = cupy
         else:
             raise ValueError(f"Argument output_array must be either numpy "
@@ -97,6 +97,7 @@ def read_sparse_data(file_name, file_key=None, start_index=0, end_index=-1,
 
 def read_sparser_data(file_name, file_key=None, start_index=0, end_index=-1,
                       output_type="numpy"):
+    import h5py
     with h5py.File(file_name, "r") as file_handle:
         if file_key is None:
             group = file_handle
@@ -105,18 +106,17 @@ def read_sparser_data(file_name, file_key=None, start_index=0, end_index=-1,
 
         all_start_indices = group["start_indices"][...]
         all_ones_start_indices = group["ones_start_indices"][...]
+        if end_index == -1:
+            end_index = len(all_start_indices)-1
         value_start_index = all_start_indices[start_index]
         ones_start_index = all_ones_start_indices[start_index]
-        if end_index == len(all_start_indices)-1 or end_index == -1:
-            value_end_index = -1
-            ones_end_index = -1
-        else:
-            value_end_index = all_start_indices[end_index]
-            ones_end_index = all_ones_start_indices[end_index]
+        value_end_index = all_start_indices[end_index]
+        ones_end_index = all_ones_start_indices[end_index]
 
         if output_type.lower() == "numpy":
             output_module = numpy
         elif output_type.lower() == "cupy":
+            import cupy
             output_module = cupy
         else:
             raise ValueError(f"Argument output_array must be either numpy "
@@ -150,12 +150,16 @@ def read_dense_data(file_name, file_key=None, start_index=0, end_index=-1,
     if output_type.lower() == "numpy":
         output_module = numpy
     elif output_type.lower() == "cupy":
+        import cupy
         output_module = cupy
     else:
         raise ValueError(f"Argument output_array must be either numpy or "
                          f"cupy. Can't recognize: {output_type}")
 
+    import h5py
     with h5py.File(file_name, "r") as file_handle:
+        if end_index == -1:
+            end_index = None
         patterns = file_handle[file_key][start_index:end_index, ...]
         if numpy.issubdtype(patterns.dtype, numpy.integer):
             patterns = output_module.asarray(patterns, dtype="int32")
@@ -169,10 +173,11 @@ def read_dense_data(file_name, file_key=None, start_index=0, end_index=-1,
 def radial_average(image, mask=None):
     """Calculates the radial average of an array of any shape,
     the center is assumed to be at the physical center."""
+    image = numpy.asarray(image)
     if mask is None:
-        mask = numpy.ones(image.shape, dtype='bool8')
+        mask = numpy.ones(image.shape, dtype='bool')
     else:
-        mask = numpy.bool8(mask)
+        mask = numpy.bool_(mask)
     axis_values = [numpy.arange(s) - s/2. + 0.5 for s in image.shape]
     radius = numpy.zeros((image.shape[-1]))
     for i in range(len(image.shape)):
@@ -180,16 +185,28 @@ def radial_average(image, mask=None):
                                                (numpy.newaxis, )*i])**2
     radius = numpy.int32(numpy.sqrt(radius))
     number_of_bins = radius[mask].max() + 1
-    radial_sum = numpy.zeros(number_of_bins)
-    weight = numpy.zeros(number_of_bins)
-    for value, this_radius in zip(image[mask], radius[mask]):
-        radial_sum[this_radius] += value
-        weight[this_radius] += 1.
+    radial_sum = numpy.bincount(radius[mask], weights=image[mask],
+                                minlength=number_of_bins)
+    weight = numpy.bincount(radius[mask], minlength=number_of_bins)
     radial_sum[weight > 0] /= weight[weight > 0]
     radial_sum[weight == 0] = numpy.nan
     return radial_sum
 
 
+def sum_patterns(patterns, chunk_size=1000):
+    """Sum of the unmasked (>= 0) values of a stack of patterns and the
+    number of patterns where each pixel is unmasked. Patterns are read
+    chunk_size at a time so this also works on an HDF5 dataset."""
+    pattern_sum = numpy.zeros(patterns.shape[1:], dtype="float64")
+    pattern_weight = numpy.zeros(patterns.shape[1:], dtype="int64")
+    for chunk_start in range(0, len(patterns), chunk_size):
+        chunk = numpy.asarray(patterns[chunk_start:chunk_start+chunk_size])
+        valid = chunk >= 0
+        pattern_sum += numpy.where(valid, chunk, 0).sum(axis=0)
+        pattern_weight += valid.sum(axis=0)
+    return pattern_sum, pattern_weight
+
+
 def init_model_radial_average_old(patterns, randomness=0.):
     """Simple function to create a random start. The new array will have
     a side similar to the second axis of the patterns"""
@@ -210,34 +227,42 @@ def init_model_radial_average_old(patterns, randomness=0.):
     return model
 
 
-def init_model_radial_average(patterns, randomness=0., mpi=None):
-    """Simple function to create a random start. The new array will have
-    a side similar to the second axis of the patterns"""
-
-    patterns = patterns.copy()
-    patterns_weights = patterns >= 0.
-    patterns[~patterns_weights] = 0
-    patterns = patterns.sum(axis=0)
-    patterns_weights = patterns_weights.sum(axis=0)
-
-    pattern_radial_average = radial_average(patterns)
-    weight_radial_average = radial_average(patterns_weights)
+def _radial_average_model(pattern_sum, pattern_weight, randomness):
+    pattern_radial_average = radial_average(pattern_sum)
+    weight_radial_average = radial_average(pattern_weight)
     positive_weights = weight_radial_average[weight_radial_average > 0]
     pattern_radial_average[weight_radial_average > 0] /= positive_weights
     pattern_radial_average[weight_radial_average <= 0] = -1.
 
-    side = patterns.shape[1]
-    x = numpy.arange(side) - side/2 + 0.5
+    # Radii beyond the patterns look up the trailing -1
+    number_of_radii = len(pattern_radial_average)
+    radial_lookup = numpy.append(pattern_radial_average, -1.)
+
+    # Fill one slab at a time to avoid temporary 3D arrays
+    side = pattern_sum.shape[1]
+    x_squared = (numpy.arange(side) - side/2 + 0.5)**2
+    radius_squared_2d = (x_squared[:, numpy.newaxis] +
+                         x_squared[numpy.newaxis, :])
+    model = numpy.empty((side, )*3, dtype="float64")
+    for this_x_squared, model_slab in zip(x_squared, model):
+        r_int = numpy.int32(numpy.sqrt(this_x_squared + radius_squared_2d))
+        numpy.minimum(r_int, number_of_radii, out=r_int)
+        model_slab[...] = radial_lookup[r_int]
+        if randomness != 0.:
+            model_slab *= (1 - randomness + 2*randomness *
+                           numpy.random.random((side, side)))
+        model_slab[r_int == number_of_radii] = -1.
+    return model
 
-    r_int = numpy.int32(numpy.sqrt(x[:, numpy.newaxis, numpy.newaxis]**2 +
-                                   x[numpy.newaxis, :, numpy.newaxis]**2 +
-                                   x[numpy.newaxis, numpy.newaxis, :]**2))
-    r_int_copy = r_int.copy()
-    r_int[r_int >= len(pattern_radial_average)] = 0
 
-    model = pattern_radial_average[numpy.int32(r_int)]
-    model *= 1 - randomness + 2*randomness * numpy.random.random((side, )*3)
-    model[r_int_copy >= len(pattern_radial_average)] = -1.
+def init_model_radial_average(patterns, randomness=0., mpi=None,
+                              chunk_size=1000):
+    """Simple function to create a random start. The new array will have
+    a side similar to the second axis of the patterns. patterns can be an
+    array or an HDF5 dataset and is summed chunk_size patterns at a
+    time."""
+    pattern_sum, pattern_weight = sum_patterns(patterns, chunk_size)
+    model = _radial_average_model(pattern_sum, pattern_weight, randomness)
 
     if mpi is not None and mpi.mpi_on:
         model_recv = numpy.zeros_like(model)
@@ -246,6 +271,280 @@ def init_model_radial_average(patterns, randomness=0., mpi=None):
 
     return model
 
+
+def sum_sparse_patterns(file_name, file_key=None, start_index=0,
+                        end_index=-1, chunk_size=10000):
+    """Sum of the sparse or sparser patterns start_index to end_index in
+    an HDF5 file, as an image. Patterns are read chunk_size at a time."""
+    import h5py
+    with h5py.File(file_name, "r") as file_handle:
+        if file_key is None:
+            group = file_handle
+        else:
+            group = file_handle[file_key]
+        shape = tuple(group["shape"][...])
+        number_of_pixels = int(numpy.prod(shape))
+        all_start_indices = group["start_indices"][...]
+        sparser = "ones_indices" in group
+        if sparser:
+            all_ones_start_indices = group["ones_start_indices"][...]
+        if end_index == -1:
+            end_index = len(all_start_indices)-1
+
+        pattern_sum = numpy.zeros(number_of_pixels, dtype="float64")
+        for chunk_start in range(start_index, end_index, chunk_size):
+            chunk_end = min(chunk_start + chunk_size, end_index)
+            value_slice = slice(all_start_indices[chunk_start],
+                                all_start_indices[chunk_end])
+            pattern_sum += numpy.bincount(
+                group["indices"][value_slice],
+                weights=group["values"][value_slice],
+                minlength=number_of_pixels)
+            if sparser:
+                ones_slice = slice(all_ones_start_indices[chunk_start],
+                                   all_ones_start_indices[chunk_end])
+                pattern_sum += numpy.bincount(
+                    group["ones_indices"][ones_slice],
+                    minlength=number_of_pixels)
+    return pattern_sum.reshape(shape)
+
+
+def init_model_radial_average_sparse(file_name, file_key=None,
+                                     randomness=0., mask=None, mpi=None,
+                                     start_index=0, end_index=-1,
+                                     chunk_size=10000):
+    """Radial average starting model from sparse or sparser patterns in an
+    HDF5 file, accumulated chunk_size patterns at a time. With MPI each
+    rank sums part of the patterns and the sums are merged."""
+    if end_index == -1:
+        import h5py
+        with h5py.File(file_name, "r") as file_handle:
+            group = file_handle if file_key is None else file_handle[file_key]
+            end_index = len(group["start_indices"])-1
+
+    if mpi is not None and mpi.mpi_on:
+        rank_edges = numpy.linspace(start_index, end_index, mpi.size()+1)
+        rank_edges = numpy.int64(numpy.round(rank_edges))
+        my_start, my_end = rank_edges[mpi.rank()], rank_edges[mpi.rank()+1]
+    else:
+        my_start, my_end = start_index, end_index
+
+    pattern_sum = sum_sparse_patterns(file_name, file_key, my_start, my_end,
+                                      chunk_size)
+    # Masked out pixels are not stored, so every pattern weighs the same
+    pattern_weight = numpy.full(pattern_sum.shape, float(my_end - my_start))
+    if mask is not None:
+        mask = numpy.bool_(mask)
+        pattern_sum[~mask] = 0.
+        pattern_weight[~mask] = 0.
+
+    if mpi is not None and mpi.mpi_on:
+        for partial_sum in (pattern_sum, pattern_weight):
+            total_sum = numpy.zeros_like(partial_sum)
+            mpi.comm.Allreduce(partial_sum, total_sum, op=mpi_module.MPI.SUM)
+            partial_sum[...] = total_sum
+
+    model = _radial_average_model(pattern_sum, pattern_weight, randomness)
+
+    if mpi is not None and mpi.mpi_on:
+        # Use the randomness of the master on all ranks
+        mpi.comm.Bcast(model, root=0)
+
+    return model
+
+
+def quaternion_multiply(quaternion_1, quaternion_2):
+    """Hamilton product of quaternions (w, x, y, z). Broadcasts over
+    leading dimensions."""
+    w1, x1, y1, z1 = numpy.moveaxis(numpy.asarray(quaternion_1), -1, 0)
+    w2, x2, y2, z2 = numpy.moveaxis(numpy.asarray(quaternion_2), -1, 0)
+    return numpy.stack([w1*w2 - x1*x2 - y1*y2 - z1*z2,
+                        w1*x2 + x1*w2 + y1*z2 - z1*y2,
+                        w1*y2 - x1*z2 + y1*w2 + z1*x2,
+                        w1*z2 + x1*y2 - y1*x2 + z1*w2], axis=-1)
+
+
+def _canonical_quaternions(quaternions):
+    """Flip signs so that the first non-zero component is positive"""
+    quaternions = numpy.array(quaternions, dtype="float64")
+    rounded = numpy.round(quaternions, 8)
+    first = numpy.argmax(rounded != 0, axis=-1)
+    signs = numpy.sign(numpy.take_along_axis(rounded, first[..., None], -1))
+    return quaternions * signs
+
+
+def point_group(name):
+    """Quaternions of the rotations of a point group. Accepts Cn, Dn
+    (e.g. "C4", "D2"), "T", "O" and "I". The symmetry axes are z for
+    Cn and Dn, with the two-fold axis of Dn along x."""
+    half = numpy.sqrt(0.5)
+    golden = (1 + numpy.sqrt(5)) / 2
+    if name[0] in ("C", "D") and name[1:].isdigit() and int(name[1:]) > 0:
+        order = int(name[1:])
+        generators = [[numpy.cos(numpy.pi/order), 0, 0,
+                       numpy.sin(numpy.pi/order)]]
+        if name[0] == "D":
+            generators.append([0, 1, 0, 0])
+    elif name == "T":
+        generators = [[0.5, 0.5, 0.5, 0.5], [0, 0, 0, 1]]
+    elif name == "O":
+        generators = [[half, 0, 0, half], [0.5, 0.5, 0.5, 0.5]]
+    elif name == "I":
+        generators = [[0.5, 0.5, 0.5, 0.5],
+                      [golden/2, 0.5, 1/(2*golden), 0]]
+    else:
+        raise ValueError(f"Unknown point group {name}")
+
+    generators = _canonical_quaternions(generators)
+    group = numpy.array([[1., 0., 0., 0.]])
+    while True:
+        products = quaternion_multiply(generators[:, numpy.newaxis],
+                                       group[numpy.newaxis]).reshape(-1, 4)
+        candidates = _canonical_quaternions(
+            numpy.concatenate([group, products]))
+        _, unique_indices = numpy.unique(numpy.round(candidates, 6), axis=0,
+                                         return_index=True)
+        new_group = candidates[numpy.sort(unique_indices)]
+        if len(new_group) == len(group):
+            return group
+        group = new_group
+
+
+def _equivalent_rotations(rotations, group=None, friedel=False):
+    """All rotations equivalent to each rotation, with shape
+    (equivalents, rotations, 4). The first equivalent is the rotation
+    itself."""
+    rotations = numpy.asarray(rotations)
+    if group is None:
+        group = numpy.array([[1., 0., 0., 0.]])
+    equivalent = quaternion_multiply(group[:, numpy.newaxis],
+                                     rotations[numpy.newaxis])
+    if friedel:
+        equivalent = numpy.concatenate(
+            [equivalent, quaternion_multiply(equivalent, [0., 0., 0., 1.])])
+    return equivalent
+
+
+def symmetry_reduce_rotations(rotations, weights, group=None,
+                              friedel=False):
+    """Keep only the rotations in the asymmetric unit of SO(3).
+
+    Rotations q and g*q are equivalent for every g in group (see
+    point_group). With friedel, q and q*Rz(pi) are also equivalent, which
+    is exact for a flat Ewald sphere. A rotation is kept if it is the one
+    closest to (nearly) the identity among its equivalents. Ties are split by
+    dividing the weight by the number of distinct tied equivalents."""
+    rotations = numpy.asarray(rotations)
+    equivalent = _equivalent_rotations(rotations, group, friedel)
+    # A reference slightly off the identity is not fixed by any symmetry,
+    # which avoids systematic ties. q and -q are the same rotation.
+    reference = numpy.array([1., 0.013, 0.021, 0.034])
+    reference /= numpy.linalg.norm(reference)
+    closeness = abs((equivalent * reference).sum(axis=-1))
+    tolerance = 1e-5
+    closest = closeness.max(axis=0)
+    keep = closeness[0] >= closest - tolerance
+    number_of_ties = (closeness >= closest - tolerance).sum(axis=0)
+    # Equivalents that are the rotation itself are not distinct ties
+    number_of_copies = (abs((equivalent * rotations).sum(axis=-1)) >
+                        1 - tolerance).sum(axis=0)
+    number_of_ties = number_of_ties / number_of_copies
+    return (rotations[keep],
+            numpy.asarray(weights)[keep] / number_of_ties[keep])
+
+
+def nearest_rotations(rotations, reference_rotations, group=None,
+                      friedel=False, chunk_size=10000):
+    """Index of the closest reference rotation for each rotation, where
+    the distance takes the symmetry (see symmetry_reduce_rotations) into
+    account."""
+    reference_rotations = numpy.asarray(reference_rotations)
+    equivalent = _equivalent_rotations(reference_rotations, group,
+                                       friedel).reshape(-1, 4)
+    nearest = numpy.zeros(len(rotations), dtype="int64")
+    for slice_big, _ in chunks(len(rotations), chunk_size):
+        closeness = abs(numpy.asarray(rotations[slice_big]) @ equivalent.T)
+        nearest[slice_big] = (closeness.argmax(axis=1)
+                              % len(reference_rotations))
+    return nearest
+
+
+def rotation_neighbours(rotations, max_angle, group=None, friedel=False,
+                        chunk_size=100):
+    """The rotations within max_angle (in radians) of each rotation,
+    itself included, as CSR arrays (indptr, indices). The angle takes the
+    symmetry (see symmetry_reduce_rotations) into account.
+
+    All equivalents of the rotations, with both signs, are put in a grid
+    of the quaternion coordinates with a cell size of the largest distance
+    between neighbours, so that only the rotations in the 81 cells around
+    each rotation have to be compared. Blocks of rotations are searched in
+    parallel."""
+    rotations = numpy.asarray(rotations)
+    equivalent = _equivalent_rotations(rotations, group, friedel)
+    equivalent = equivalent.reshape(-1, 4)
+    points = numpy.float32(numpy.concatenate([equivalent, -equivalent]))
+    owners = numpy.tile(numpy.arange(len(rotations)),
+                        len(points) // len(rotations))
+    # The angle between two rotations is 2 arccos(|q1 q2|), which is
+    # within max_angle when |q1 -/+ q2| is within distance.
+    min_closeness = numpy.cos(max_angle / 2)
+    distance = numpy.sqrt(max(2. - 2.*min_closeness, 0.))
+    # The margin covers rounding, the minimum keeps the keys in int64
+    cell_size = max(1.01*distance, 2e-3)
+    side = int(numpy.ceil(2.01 / cell_size)) + 2
+
+    def cell_keys(cells):
+        return ((cells[..., 0]*side + cells[..., 1])*side +
+                cells[..., 2])*side + cells[..., 3]
+
+    def cells_of(quaternions):
+        return numpy.int64(numpy.floor((quaternions + 1.) / cell_size)) + 1
+
+    keys = cell_keys(cells_of(points))
+    order = numpy.argsort(keys, kind="stable")
+    keys, points, owners = keys[order], points[order], owners[order]
+    offsets = numpy.stack(numpy.meshgrid(*[[-1, 0, 1]]*4, indexing="ij"),
+                          axis=-1).reshape(-1, 4)
+    rotations_float = numpy.float32(rotations)
+
+    def neighbours_block(block):
+        counts = []
+        indices = []
+        for slice_big, _ in chunks(block.stop - block.start, chunk_size):
+            slice_big = slice(block.start + slice_big.start,
+                              block.start + slice_big.stop)
+            query = rotations_float[slice_big]
+            neighbour_keys = cell_keys(cells_of(query)[:, numpy.newaxis] +
+                                       offsets).ravel()
+            first = numpy.searchsorted(keys, neighbour_keys, side="left")
+            lengths = (numpy.searchsorted(keys, neighbour_keys,
+                                          side="right") - first)
+            starts = numpy.cumsum(lengths) - lengths
+            candidates = (numpy.repeat(first - starts, lengths) +
+                          numpy.arange(lengths.sum()))
+            rows = numpy.repeat(numpy.arange(len(neighbour_keys)) //
+                                len(offsets), lengths)
+            closeness = (query[rows] * points[candidates]).sum(axis=1)
+            close = closeness >= min_closeness
+            # Several equivalents of a rotation can be close
+            pairs = numpy.unique(rows[close]*len(rotations) +
+                                 owners[candidates[close]])
+            counts.append(numpy.bincount(pairs // len(rotations),
+                                         minlength=len(query)))
+            indices.append(numpy.int32(pairs % len(rotations)))
+        return counts, indices
+
+    results = cpu.parallel_blocks(neighbours_block, len(rotations))
+    counts = numpy.concatenate(
+        [this_counts for result in results for this_counts in result[0]])
+    indices = [this_indices for result in results
+               for this_indices in result[1]]
+    indptr = numpy.zeros(len(rotations)+1, dtype="int64")
+    numpy.cumsum(counts, out=indptr[1:])
+    return indptr, numpy.concatenate(indices)
+
+
 def chunks(number_of_rotations, chunk_size):
     """Generator for slices to chunk up the data"""
     chunk_starts = numpy.arange(0, number_of_rotations, chunk_size)
@@ -261,26 +560,34 @@ def chunks(number_of_rotations, chunk_size):
         yield this_indices_cpu, this_indices_gpu
 
 
+def _select_pixels(patterns, condition):
+    """Start indices, pixel indices and values of the pixels where
+    condition is true, in the layout of the sparse formats. Blocks of
+    patterns are converted in parallel."""
+    patterns = numpy.asarray(patterns)
+    patterns_flat = patterns.reshape((len(patterns),
+                                      int(numpy.prod(patterns.shape[1:]))))
+
+    def select_block(block):
+        block_patterns = patterns_flat[block]
+        selected = condition(block_patterns)
+        pattern_index, pixel_index = numpy.nonzero(selected)
+        return (selected.sum(axis=1),
+                numpy.int32(pixel_index),
+                numpy.int32(block_patterns[pattern_index, pixel_index]))
+
+    results = cpu.parallel_blocks(select_block, len(patterns_flat))
+    counts, indices, values = (numpy.concatenate(this_result)
+                               for this_result in zip(*results))
+    start_indices = numpy.zeros(len(counts)+1, dtype="int32")
+    numpy.cumsum(counts, out=start_indices[1:])
+    return start_indices, indices, values
+
+
 def images_to_sparse(patterns):
     """Convert a stack of diffraction patterns to sparse format"""
-    number_of_patterns = len(patterns)
-    number_of_lit_pixels = (patterns > 0).sum()
-    start_indices = numpy.zeros(number_of_patterns+1, dtype="int32")
-    indices = numpy.zeros(number_of_lit_pixels, dtype="int32")
-    values = numpy.zeros(number_of_lit_pixels, dtype="int32")
-    counter = 0
-
-    for index_pattern, this_pattern in enumerate(patterns):
-        if index_pattern % 100 == 0:
-            print(f"{index_pattern} patterns done")
-        flat_pattern = this_pattern.flatten()
-        start_indices[index_pattern] = counter
-        for index, value in enumerate(flat_pattern):
-            if value > 0:
-                indices[counter] = index
-                values[counter] = value
-                counter += 1
-    start_indices[-1] = counter
+    start_indices, indices, values = _select_pixels(
+        patterns, lambda p: p > 0)
     return {"start_indices": start_indices,
             "indices": indices,
             "values": values,
@@ -289,38 +596,202 @@ def images_to_sparse(patterns):
 
 def images_to_sparser(patterns):
     """Convert a stack of diffraction patterns to sparseR format"""
-    number_of_patterns = len(patterns)
-    # number_of_lit_pixels = (patterns > 0).sum()
-    number_of_ones = (patterns == 1).sum()
-    number_of_largers = (patterns > 1).sum()
-    ones_start_indices = numpy.zeros(number_of_patterns+1, dtype="int32")
-    start_indices = numpy.zeros(number_of_patterns+1, dtype="int32")
-    ones_indices = numpy.zeros(number_of_ones, dtype="int32")
-    indices = numpy.zeros(number_of_largers, dtype="int32")
-    values = numpy.zeros(number_of_largers, dtype="int32")
-
-    ones_counter = 0
-    largers_counter = 0
-    for index_pattern, this_pattern in enumerate(patterns):
-        if index_pattern % 100 == 0:
-            print(f"{index_pattern} patterns done")
-        flat_pattern = this_pattern.flatten()
-        ones_start_indices[index_pattern] = ones_counter
-        start_indices[index_pattern] = largers_counter
-        for index, value in enumerate(flat_pattern):
-            if value == 1:
-                ones_indices[ones_counter] = index
-                ones_counter += 1
-            if value > 1:
-                indices[largers_counter] = index
-                values[largers_counter] = value
-                largers_counter += 1
-    ones_start_indices[-1] = ones_counter
-    start_indices[-1] = largers_counter
-
+    ones_start_indices, ones_indices, _ = _select_pixels(
+        patterns, lambda p: p == 1)
+    start_indices, indices, values = _select_pixels(
+        patterns, lambda p: p > 1)
     return {"ones_start_indices": ones_start_indices,
             "start_indices": start_indices,
             "ones_indices": ones_indices,
             "indices": indices,
             "values": values,
             "shape": patterns.shape[1:]}
+
+
+def _mask_sparse_arrays(start_indices, mask_flat, indices, *arrays):
+    keep = mask_flat[indices]
+    kept_before = numpy.zeros(len(keep)+1, dtype="int64")
+    numpy.cumsum(keep, out=kept_before[1:])
+    new_start_indices = numpy.int32(kept_before[start_indices])
+    return (new_start_indices, ) + tuple(array[keep]
+                                         for array in (indices, ) + arrays)
+
+
+def mask_sparse_patterns(patterns, mask):
+    """Remove the pixels where mask is False from sparse or sparser
+    patterns. Returns a new pattern dict."""
+    mask_flat = numpy.bool_(mask).reshape(-1)
+    if mask_flat.size != numpy.prod(patterns["shape"]):
+        raise ValueError(f"Mask of shape {numpy.shape(mask)} doesn't match "
+                         f"patterns of shape {tuple(patterns['shape'])}")
+    masked_patterns = dict(patterns)
+    (masked_patterns["start_indices"],
+     masked_patterns["indices"],
+     masked_patterns["values"]) = _mask_sparse_arrays(
+         numpy.asarray(patterns["start_indices"]), mask_flat,
+         numpy.asarray(patterns["indices"]),
+         numpy.asarray(patterns["values"]))
+    if "ones_indices" in patterns:
+        (masked_patterns["ones_start_indices"],
+         masked_patterns["ones_indices"]) = _mask_sparse_arrays(
+             numpy.asarray(patterns["ones_start_indices"]), mask_flat,
+             numpy.asarray(patterns["ones_indices"]))
+    return masked_patterns
+
+
+def _binned_shape(shape, factor):
+    if any(side % factor != 0 for side in shape):
+        raise ValueError(f"Shape {tuple(shape)} is not divisible by the "
+                         f"binning factor {factor}")
+    return tuple(side // factor for side in shape)
+
+
+def _blocks(array, factor, number_of_axes):
+    """View the last number_of_axes axes of array as blocks of side
+    factor, on axes -1, -3, ... of the result."""
+    leading = array.shape[:array.ndim - number_of_axes]
+    binned_shape = _binned_shape(array.shape[array.ndim-number_of_axes:],
+                                 factor)
+    return array.reshape(leading + sum(((side, factor)
+                                        for side in binned_shape), ()))
+
+
+def _block_axes(array, number_of_axes):
+    return tuple(range(array.ndim - 2*number_of_axes + 1, array.ndim, 2))
+
+
+def bin_patterns(patterns, factor):
+    """Sum the photons in blocks of factor x factor pixels. In dense
+    patterns blocks with a negative (masked out) pixel get -1. Sparser
+    patterns are returned in the sparse format."""
+    if factor == 1:
+        return patterns
+    if not isinstance(patterns, dict):
+        blocks = _blocks(numpy.asarray(patterns), factor, 2)
+        axes = _block_axes(blocks, 2)
+        binned = blocks.sum(axis=axes, dtype=blocks.dtype)
+        binned[(blocks < 0).any(axis=axes)] = -1
+        return binned
+
+    shape = tuple(patterns["shape"])
+    binned_shape = _binned_shape(shape, factor)
+    number_of_binned_pixels = binned_shape[0] * binned_shape[1]
+    start_indices = numpy.asarray(patterns["start_indices"])
+    number_of_patterns = len(start_indices) - 1
+    pattern_indices = [numpy.repeat(numpy.arange(number_of_patterns),
+                                    numpy.diff(start_indices))]
+    indices = [numpy.asarray(patterns["indices"])]
+    values = [numpy.asarray(patterns["values"])]
+    if "ones_start_indices" in patterns:
+        pattern_indices.append(numpy.repeat(
+            numpy.arange(number_of_patterns),
+            numpy.diff(numpy.asarray(patterns["ones_start_indices"]))))
+        indices.append(numpy.asarray(patterns["ones_indices"]))
+        values.append(numpy.ones(len(indices[-1]), dtype="int32"))
+    row, column = numpy.divmod(numpy.concatenate(indices), shape[1])
+    binned_indices = (row // factor) * binned_shape[1] + column // factor
+    keys, inverse = numpy.unique(
+        numpy.concatenate(pattern_indices) * number_of_binned_pixels +
+        binned_indices, return_inverse=True)
+    binned_values = numpy.bincount(inverse,
+                                   weights=numpy.concatenate(values),
+                                   minlength=len(keys))
+    binned_start_indices = numpy.searchsorted(
+        keys // number_of_binned_pixels, numpy.arange(number_of_patterns+1))
+    return {"start_indices": numpy.int32(binned_start_indices),
+            "indices": numpy.int32(keys % number_of_binned_pixels),
+            "values": numpy.int32(numpy.round(binned_values)),
+            "shape": binned_shape}
+
+
+def bin_mask(mask, factor):
+    """A binned pixel is only used if all of its pixels are"""
+    blocks = _blocks(numpy.bool_(mask), factor, 2)
+    return blocks.all(axis=_block_axes(blocks, 2))
+
+
+def bin_coordinates(coordinates, factor):
+    """Coordinates of binned pixels in units of a model downsampled by the
+    same factor"""
+    blocks = _blocks(numpy.asarray(coordinates, dtype="float64"), factor, 2)
+    return numpy.float32(blocks.mean(axis=_block_axes(blocks, 2)) / factor)
+
+
+def bin_model(model, factor):
+    """Average blocks of factor**3 voxels, ignoring negative (unknown)
+    voxels. Blocks without known voxels get -1."""
+    model = numpy.asarray(model)
+    if factor == 1:
+        return model.copy()
+    known = model >= 0
+    value_blocks = _blocks(numpy.where(known, model, 0.), factor, model.ndim)
+    known_blocks = _blocks(known, factor, model.ndim)
+    axes = _block_axes(value_blocks, model.ndim)
+    number_known = known_blocks.sum(axis=axes)
+    binned = value_blocks.sum(axis=axes) / numpy.maximum(number_known, 1)
+    binned[number_known == 0] = -1.
+    return numpy.float32(binned)
+
+
+def upsample_model(model, factor):
+    """Linear interpolation of the model on a grid factor times finer,
+    ignoring negative (unknown) voxels."""
+    model = numpy.asarray(model)
+    known = numpy.float64(model >= 0)
+    values = numpy.where(model >= 0, model, 0.)
+    for axis, side in enumerate(model.shape):
+        # Voxel centres of the coarse grid in units of coarse voxels
+        position = numpy.clip((numpy.arange(side*factor) + 0.5) / factor
+                              - 0.5, 0, side - 1)
+        low = numpy.minimum(numpy.int64(position), max(side - 2, 0))
+        high = numpy.minimum(low + 1, side - 1)
+        shape = [1] * model.ndim
+        shape[axis] = -1
+        fraction = (position - low).reshape(shape)
+        values, known = [numpy.take(a, low, axis=axis) * (1 - fraction) +
+                         numpy.take(a, high, axis=axis) * fraction
+                         for a in (values, known)]
+    upsampled = numpy.float32(values / numpy.where(known > 0, known, 1))
+    upsampled[known == 0] = -1.
+    return upsampled
+
+
+def _append_to_dataset(dataset, values):
+    start = dataset.shape[0]
+    dataset.resize((start + len(values), ))
+    dataset[start:] = values
+
+
+def write_sparse_patterns(dense_dataset, output_group, sparser=False,
+                          chunk_size=1000):
+    """Convert a dense HDF5 dataset of patterns to sparse (or sparser)
+    format in output_group. Patterns are read, converted and appended
+    chunk_size at a time so memory use does not depend on the size of the
+    dataset."""
+    number_of_patterns = len(dense_dataset)
+    convert_function = images_to_sparser if sparser else images_to_sparse
+    # Start indices and the dataset they index into
+    index_keys = {"start_indices": "indices"}
+    value_keys = ["indices", "values"]
+    if sparser:
+        index_keys["ones_start_indices"] = "ones_indices"
+        value_keys.append("ones_indices")
+
+    for key in index_keys:
+        output_group.create_dataset(key, (number_of_patterns+1, ),
+                                    dtype="int32", fillvalue=0)
+    for key in value_keys:
+        output_group.create_dataset(key, (0, ), maxshape=(None, ),
+                                    dtype="int32", chunks=True)
+    output_group.create_dataset("shape", data=dense_dataset.shape[1:])
+
+    for chunk_start in range(0, number_of_patterns, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, number_of_patterns)
+        sparse_patterns = convert_function(
+            dense_dataset[chunk_start:chunk_end])
+        for key, value_key in index_keys.items():
+            offset = output_group[value_key].shape[0]
+            output_group[key][chunk_start+1:chunk_end+1] = (
+                sparse_patterns[key][1:] + offset)
+        for key in value_keys:
+            _append_to_dataset(output_group[key], sparse_patterns[key])
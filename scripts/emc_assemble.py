@@ -1,6 +1,5 @@
 import numpy
 import h5py
-import cupy
 import pyemc
 import argparse
 import re
@@ -57,17 +56,19 @@ if args.number_of_patterns != 0:
 
 patterns_reader = pyemc.DataReader(number_of_patterns=number_of_patterns)
 patterns = patterns_reader.read_patterns(patterns_file, patterns_key)
-patterns = cupy.asarray(patterns, dtype="float32")
+patterns = pyemc.asarray(patterns, dtype="float32")
 
 with h5py.File(rotations_file, "r") as file_handle:
     rotations = file_handle[rotations_key][:number_of_patterns]
-rotations = cupy.asarray(rotations, dtype="float32")
+rotations = pyemc.asarray(rotations, dtype="float32")
 if args.inverse:
     rotations[:, 1:] = -rotations[:, 1:]
 
 
-coordinates = pyemc.ewald_coordinates(pattern_shape(patterns), wavelength, args.detector_distance, args.pixel_size)
+coordinates = pyemc.ewald_coordinates(pattern_shape(patterns), wavelength, args.detector_distance, args.pixel_size, output_type="numpy")
+coordinates = pyemc.asarray(coordinates, dtype="float32")
 
-assembled = pyemc.assemble_model(patterns, rotations, coordinates).get()
+assembled = pyemc.asnumpy(
+    pyemc.assemble_model(patterns, rotations, coordinates))
 
 sphelper.save_spimage(assembled, args.output_file)
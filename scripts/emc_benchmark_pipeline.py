@@ -0,0 +1,72 @@
+import time
+import argparse
+import numpy
+import pyemc
+
+parser = argparse.ArgumentParser(
+    description="Time EMC iterations on simulated data for different "
+    "numbers of chunk buffers. With more than one buffer the host side "
+    "work of each chunk overlaps the computation of the next one.")
+parser.add_argument("--side", type=int, default=64,
+                    help="Side of the model and the patterns")
+parser.add_argument("--number_of_patterns", type=int, default=2000)
+parser.add_argument("--n", type=int, default=8,
+                    help="Rotation sampling")
+parser.add_argument("--chunk_size", type=int, default=200)
+parser.add_argument("--iterations", type=int, default=2)
+parser.add_argument("--buffers", type=int, nargs="+", default=[1, 2, 3])
+parser.add_argument("--resp_storage", type=str, default="dense",
+                    choices=["dense", "recompute", "sparse", "memmap"])
+parser.add_argument("--sparse", action="store_true", default=False,
+                    help="Use sparse patterns")
+parser.add_argument("--cpu", action="store_true", default=False,
+                    help="Use the CPU backend even if CUDA is available")
+args = parser.parse_args()
+
+if args.cpu:
+    pyemc.set_backend(pyemc.Backend.CPU)
+
+rng = numpy.random.default_rng(0)
+pattern_shape = (args.side, args.side)
+coordinates = pyemc.ewald_coordinates(pattern_shape, 1e-9, 0.5, 5e-3,
+                                      output_type="numpy")
+
+x = numpy.arange(args.side) - args.side/2 + 0.5
+radius = numpy.sqrt(x[:, numpy.newaxis, numpy.newaxis]**2 +
+                    x[numpy.newaxis, :, numpy.newaxis]**2 +
+                    x[numpy.newaxis, numpy.newaxis, :]**2)
+model = numpy.float32(100 * numpy.exp(-radius / (args.side/8)) *
+                      (1 + 0.5 * rng.random((args.side, )*3)))
+
+rotations = numpy.float32(rng.normal(size=(args.number_of_patterns, 4)))
+rotations /= numpy.linalg.norm(rotations, axis=1)[:, numpy.newaxis]
+slices = pyemc.array_module().zeros((args.number_of_patterns, ) +
+                                    pattern_shape, dtype="float32")
+pyemc.expand_model(pyemc.asarray(model), slices, pyemc.asarray(rotations),
+                   pyemc.asarray(coordinates))
+patterns = numpy.int32(rng.poisson(numpy.clip(pyemc.asnumpy(slices), 0,
+                                              None)))
+if args.sparse:
+    patterns = pyemc.images_to_sparse(patterns)
+mask = numpy.ones(pattern_shape, dtype="bool")
+start_model = numpy.float32(rng.uniform(0.5, 1.5, model.shape) *
+                            model.mean())
+
+print(f"Backend: {pyemc.get_backend().name}, "
+      f"resp storage: {args.resp_storage}")
+for number_of_buffers in args.buffers:
+    emc = pyemc.EMC(patterns, mask, start_model, coordinates, args.n)
+    emc._chunk_size = args.chunk_size
+    emc.set_resp_storage(args.resp_storage)
+    emc.set_number_of_buffers(number_of_buffers)
+    # The first iteration also compiles the kernels
+    emc.iteration()
+    pyemc.synchronize()
+    start_time = time.time()
+    for _ in range(args.iterations):
+        emc.iteration()
+    pyemc.synchronize()
+    iteration_time = (time.time() - start_time) / args.iterations
+    emc.close()
+    print(f"{number_of_buffers} buffers: {iteration_time:.3f} s "
+          "per iteration")
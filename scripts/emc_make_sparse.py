@@ -1,4 +1,3 @@
-import numpy
 import h5py
 from eke import tools
 import argparse
@@ -10,16 +9,21 @@ parser.add_argument("output_file", type=str)
 parser.add_argument("--input_key", type=str, default="patterns")
 parser.add_argument("--output_key", type=str, default=None)
 parser.add_argument("--sparser", action="store_true", default=False)
+parser.add_argument("--chunk_size", type=int, default=1000,
+                    help="Number of patterns converted at a time")
+parser.add_argument("--threads", type=int, default=None,
+                    help="Number of threads converting each chunk")
 args = parser.parse_args()
 
+if args.threads is not None:
+    pyemc.cpu.set_number_of_threads(args.threads)
+
 if args.output_key is None:
     args.output_key = args.input_key
 
 parameters = {}
 
 with h5py.File(args.input_file, "r") as file_handle:
-    patterns = file_handle[args.input_key][...]
-    # patterns = file_handle[args.input_key][:300]
     if "parameters" in file_handle.keys():
         parameters_group = file_handle["parameters"]
         for key, value in parameters_group.items():
@@ -43,34 +47,16 @@ with h5py.File(args.input_file, "r") as file_handle:
 #mask = ~tools.circular_mask(patterns.shape[1], 7.) * tools.circular_mask(patterns.shape[1], 32.)
 #patterns[:, ~mask] = -1.
 
-if args.sparser:
-    sparse_patterns = pyemc.images_to_sparser(patterns)
-
-    with h5py.File(args.output_file, "a") as file_handle:
-        output_group = file_handle.create_group(args.output_key)
-        output_group.create_dataset("ones_start_indices", data=numpy.array(sparse_patterns["ones_start_indices"]))
-        output_group.create_dataset("start_indices", data=numpy.array(sparse_patterns["start_indices"]))
-        output_group.create_dataset("ones_indices", data=numpy.array(sparse_patterns["ones_indices"]))
-        output_group.create_dataset("indices", data=numpy.array(sparse_patterns["indices"]))
-        output_group.create_dataset("values", data=numpy.array(sparse_patterns["values"]))
-        output_group.create_dataset("shape", data=sparse_patterns["shape"])
-        if "parameters" not in file_handle.keys() and parameters != None:
-            parameters_group = file_handle.create_group("parameters")
-            for key, value in parameters.items():
-                parameters_group.create_dataset(key, data=value)
-else:
-    sparse_patterns = pyemc.images_to_sparse(patterns)
-
-    with h5py.File(args.output_file, "a") as file_handle:
-        output_group = file_handle.create_group(args.output_key)
-        output_group.create_dataset("start_indices", data=numpy.array(sparse_patterns["start_indices"]))
-        output_group.create_dataset("indices", data=numpy.array(sparse_patterns["indices"]))
-        output_group.create_dataset("values", data=numpy.array(sparse_patterns["values"]))
-        output_group.create_dataset("shape", data=sparse_patterns["shape"])
-        if "parameters" not in file_handle.keys() and parameters != None:
-            parameters_group = file_handle.create_group("parameters")
-            for key, value in parameters.items():
-                parameters_group.create_dataset(key, data=value)
+with h5py.File(args.input_file, "r") as input_handle, \
+        h5py.File(args.output_file, "a") as file_handle:
+    output_group = file_handle.create_group(args.output_key)
+    pyemc.write_sparse_patterns(input_handle[args.input_key], output_group,
+                                sparser=args.sparser,
+                                chunk_size=args.chunk_size)
+    if "parameters" not in file_handle.keys() and parameters != None:
+        parameters_group = file_handle.create_group("parameters")
+        for key, value in parameters.items():
+            parameters_group.create_dataset(key, data=value)
 
 with h5py.File(args.output_file, "a") as file_handle:
     if rotations is not None and "rotations" not in file_handle.keys():
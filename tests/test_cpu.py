@@ -0,0 +1,472 @@
+"""The CPU backend compared with direct Python ports of the CUDA kernels.
+The ports loop over single pixels in double precision, so they are only
+run on small arrays."""
+import math
+import numpy
+import pytest
+import pyemc
+
+
+SINC_SCALING = 0.25
+WINDOW_RADIUS = 2
+
+INTERPOLATIONS = [pyemc.Interpolation.NEAREST,
+                  pyemc.Interpolation.LINEAR,
+                  pyemc.Interpolation.SINC]
+
+
+@pytest.fixture(autouse=True)
+def cpu_backend():
+    pyemc.set_backend("cpu")
+
+
+# Ports of emc_cuda.cu
+
+def _rotation_matrix(rotation):
+    q0, q1, q2, q3 = (float(q) for q in rotation)
+    return numpy.array(
+        [[q0*q0 + q1*q1 - q2*q2 - q3*q3, 2*q1*q2 - 2*q0*q3,
+          2*q1*q3 + 2*q0*q2],
+         [2*q1*q2 + 2*q0*q3, q0*q0 - q1*q1 + q2*q2 - q3*q3,
+          2*q2*q3 - 2*q0*q1],
+         [2*q1*q3 - 2*q0*q2, 2*q2*q3 + 2*q0*q1,
+          q0*q0 - q1*q1 - q2*q2 + q3*q3]])
+
+
+def _model_coordinates(model_side, rotation, coordinates):
+    """x, y and z model coordinates of every pixel, as in
+    device_get_slice and device_insert_slice"""
+    rotated = (_rotation_matrix(rotation) @
+               numpy.float64(coordinates).reshape((3, -1)))
+    return rotated.T + model_side/2. - 0.5
+
+
+def _coordinate_weight(coordinate, side):
+    """device_interpolate_get_coordinate_weight"""
+    low = math.ceil(coordinate) - 1
+    low_weight = math.ceil(coordinate) - coordinate
+    high_weight = 1. - low_weight
+    out_of_range = False
+    if low < -1:
+        out_of_range = True
+    elif low == -1:
+        low_weight = 0.
+    elif low == side-1:
+        high_weight = 0.
+    elif low > side-1:
+        out_of_range = True
+    return low, low_weight, high_weight, out_of_range
+
+
+def _linear_neighbours(side, x, y, z):
+    """Model index and weight of the voxels of linear interpolation"""
+    axes = [_coordinate_weight(c, side) for c in (x, y, z)]
+    if any(out_of_range for *_, out_of_range in axes):
+        return []
+    neighbours = []
+    for index_x, weight_x in zip((axes[0][0], axes[0][0]+1), axes[0][1:3]):
+        for index_y, weight_y in zip((axes[1][0], axes[1][0]+1),
+                                     axes[1][1:3]):
+            for index_z, weight_z in zip((axes[2][0], axes[2][0]+1),
+                                         axes[2][1:3]):
+                if weight_x == 0. or weight_y == 0. or weight_z == 0.:
+                    continue
+                neighbours.append(((index_x, index_y, index_z),
+                                   weight_x*weight_y*weight_z))
+    return neighbours
+
+
+def _sinc_weight(distance):
+    if distance == 0:
+        return 1.
+    return math.sin(SINC_SCALING*3.1416*distance)/distance
+
+
+def _sinc_neighbours(side, x, y, z):
+    """Model index and weight of the voxels in the sinc window"""
+    def axis(coordinate):
+        return [(index, _sinc_weight(index - coordinate))
+                for index in range(int(coordinate - WINDOW_RADIUS + 0.5),
+                                   int(coordinate + WINDOW_RADIUS + 0.5) + 1)
+                if 0 <= index < side]
+    return [((index_x, index_y, index_z), weight_x*weight_y*weight_z)
+            for index_x, weight_x in axis(x)
+            for index_y, weight_y in axis(y)
+            for index_z, weight_z in axis(z)]
+
+
+def _nearest_neighbours(side, x, y, z):
+    indices = (int(x + 0.5), int(y + 0.5), int(z + 0.5))
+    if all(0 <= index < side for index in indices):
+        return [(indices, 1.)]
+    return []
+
+
+_NEIGHBOURS = {pyemc.Interpolation.NEAREST: _nearest_neighbours,
+               pyemc.Interpolation.LINEAR: _linear_neighbours,
+               pyemc.Interpolation.SINC: _sinc_neighbours}
+
+
+def _expand_model(model, rotations, coordinates, interpolation):
+    side = model.shape[0]
+    slices = numpy.zeros((len(rotations), coordinates[0].size))
+    for index_rotation, rotation in enumerate(rotations):
+        pixels = _model_coordinates(side, rotation, coordinates)
+        for index_pixel, (x, y, z) in enumerate(pixels):
+            neighbours = _NEIGHBOURS[interpolation](side, x, y, z)
+            if interpolation is pyemc.Interpolation.NEAREST:
+                # Masked voxels are returned as they are
+                slices[index_rotation, index_pixel] = (
+                    model[neighbours[0][0]] if neighbours else -1.)
+                continue
+            interp_sum = 0.
+            interp_weight = 0.
+            for index, weight in neighbours:
+                if model[index] >= 0.:
+                    interp_sum += weight*model[index]
+                    interp_weight += weight
+            if interp_weight > 0.:
+                slices[index_rotation, index_pixel] = (interp_sum /
+                                                       interp_weight)
+            else:
+                slices[index_rotation, index_pixel] = -1.
+    return slices.reshape((len(rotations), ) + coordinates.shape[1:])
+
+
+def _insert_slices(model, model_weights, slices, slice_weights, rotations,
+                   coordinates, interpolation):
+    side = model.shape[0]
+    model = numpy.float64(model)
+    model_weights = numpy.float64(model_weights)
+    for rotation, slice_, slice_weight in zip(rotations, slices,
+                                              slice_weights):
+        pixels = _model_coordinates(side, rotation, coordinates)
+        for value, (x, y, z) in zip(slice_.ravel(), pixels):
+            if value < 0.:
+                continue
+            for index, weight in _NEIGHBOURS[interpolation](side, x, y, z):
+                if interpolation is pyemc.Interpolation.SINC and not (
+                        model[index] >= 0. and weight > 0):
+                    continue
+                model[index] += weight*slice_weight*value
+                model_weights[index] += weight*slice_weight
+    return model, model_weights
+
+
+# Ports of calculate_responsabilities_cuda.cu, calculate_scaling_cuda.cu
+# and update_slices_cuda.cu. Scalings are per slice and pattern pair or
+# per pattern.
+
+def _scaling_value(scalings, index_slice, index_pattern):
+    if scalings is None:
+        return 1.
+    if scalings.ndim == 2:
+        return float(scalings[index_slice, index_pattern])
+    return float(scalings[index_pattern])
+
+
+def _pattern_entries(patterns, index_pattern):
+    """(pixel, photons) of the stored values of a sparse or sparser
+    pattern"""
+    start_indices = patterns["start_indices"]
+    entries = [
+        (patterns["indices"][index], patterns["values"][index])
+        for index in range(start_indices[index_pattern],
+                           start_indices[index_pattern+1])]
+    if "ones_start_indices" in patterns:
+        ones_start_indices = patterns["ones_start_indices"]
+        entries += [
+            (patterns["ones_indices"][index], 1)
+            for index in range(ones_start_indices[index_pattern],
+                               ones_start_indices[index_pattern+1])]
+    return entries
+
+
+def _responsabilities(patterns, slices, scalings=None):
+    """kernel_calculate_responsabilities_poisson* without the
+    rearrangement of the terms that keeps the float sums precise"""
+    slices_flat = numpy.float64(slices).reshape((len(slices), -1))
+    number_of_patterns = pyemc.number_of_patterns(patterns)
+    responsabilities = numpy.zeros((len(slices), number_of_patterns))
+    for index_slice, slice_ in enumerate(slices_flat):
+        for index_pattern in range(number_of_patterns):
+            scaling = _scaling_value(scalings, index_slice, index_pattern)
+            total = 0.
+            if isinstance(patterns, dict):
+                total -= slice_[slice_ > 0.].sum() / scaling
+                pixels = _pattern_entries(patterns, index_pattern)
+            else:
+                pattern = patterns[index_pattern].ravel()
+                pixels = [(index, k) for index, k in enumerate(pattern)
+                          if k >= 0]
+                total -= sum(slice_[index] for index, _ in pixels
+                             if slice_[index] > 0.) / scaling
+            for index, k in pixels:
+                if slice_[index] > 0.:
+                    total += (k*math.log(slice_[index]/scaling) -
+                              math.lgamma(k+1))
+            responsabilities[index_slice, index_pattern] = total
+    return responsabilities
+
+
+def _scaling(patterns, slices):
+    """kernel_calculate_scaling_poisson*. The sparse kernels count the
+    photons where the slice is nonzero."""
+    slices_flat = numpy.float64(slices).reshape((len(slices), -1))
+    number_of_patterns = pyemc.number_of_patterns(patterns)
+    scaling = numpy.ones((len(slices), number_of_patterns))
+    for index_slice, slice_ in enumerate(slices_flat):
+        for index_pattern in range(number_of_patterns):
+            if isinstance(patterns, dict):
+                sum_slice = slice_[slice_ >= 0.].sum()
+                sum_pattern = sum(
+                    k for index, k in _pattern_entries(patterns,
+                                                       index_pattern)
+                    if slice_[index] != 0.)
+            else:
+                pattern = patterns[index_pattern].ravel()
+                valid = (pattern >= 0) & (slice_ >= 0.)
+                sum_slice = slice_[valid].sum()
+                sum_pattern = pattern[valid].sum()
+            if sum_pattern > 0:
+                scaling[index_slice, index_pattern] = sum_slice / sum_pattern
+    return scaling
+
+
+def _scaling_per_pattern(patterns, slices, responsabilities):
+    """kernel_calculate_scaling_per_pattern_poisson"""
+    slices_flat = numpy.float64(slices).reshape((len(slices), -1))
+    scaling = numpy.ones(len(patterns))
+    for index_pattern, pattern in enumerate(patterns):
+        pattern = pattern.ravel()
+        nominator = 0.
+        denominator = 0.
+        for index_slice, slice_ in enumerate(slices_flat):
+            valid = (pattern >= 0) & (slice_ >= 0.)
+            resp = responsabilities[index_slice, index_pattern]
+            nominator += resp*slice_[valid].sum()
+            denominator += resp*pattern[valid].sum()
+        if denominator > 0:
+            scaling[index_pattern] = nominator / denominator
+    return scaling
+
+
+def _update_slices(patterns, responsabilities, shape, scalings=None):
+    """kernel_update_slices* and kernel_normalize_slices"""
+    number_of_pixels = int(numpy.prod(shape))
+    slices = numpy.zeros((len(responsabilities), number_of_pixels))
+    for index_slice, resp in enumerate(numpy.float64(responsabilities)):
+        if isinstance(patterns, dict):
+            for index_pattern, this_resp in enumerate(resp):
+                if this_resp <= 0.:
+                    continue
+                scaling = _scaling_value(scalings, index_slice,
+                                         index_pattern)
+                for index, k in _pattern_entries(patterns, index_pattern):
+                    slices[index_slice, index] += k*scaling*this_resp
+            slices[index_slice] /= resp.sum()
+            continue
+        for index_pixel in range(number_of_pixels):
+            pixel_sum = 0.
+            weight = 0.
+            for index_pattern, this_resp in enumerate(resp):
+                k = patterns[index_pattern].ravel()[index_pixel]
+                if k >= 0:
+                    scaling = _scaling_value(scalings, index_slice,
+                                             index_pattern)
+                    pixel_sum += k*scaling*this_resp
+                    weight += this_resp
+            slices[index_slice, index_pixel] = (pixel_sum / weight
+                                                if weight > 0. else -1.)
+    return slices.reshape((len(responsabilities), ) + shape)
+
+
+# Test data
+
+@pytest.fixture
+def rng():
+    return numpy.random.default_rng(0)
+
+
+@pytest.fixture
+def model(rng):
+    model = numpy.float32(rng.uniform(0.5, 2., (8, 8, 8)))
+    model[:2, :2, :2] = -1.
+    return model
+
+
+@pytest.fixture
+def rotations(rng):
+    rotations = numpy.float32(rng.normal(size=(3, 4)))
+    rotations[0] = (1., 0., 0., 0.)
+    return rotations / numpy.linalg.norm(rotations, axis=1)[:, numpy.newaxis]
+
+
+@pytest.fixture
+def coordinates(rng):
+    coordinates = numpy.float32(rng.uniform(-4.5, 4.5, (3, 5, 6)))
+    # Exactly on and just next to voxels for the identity rotation
+    coordinates[:, 0, :] = numpy.float32(rng.integers(-3, 4, (3, 6)) + 0.5)
+    coordinates[:, 1, :] = coordinates[:, 0, :] + numpy.float32(3e-4)
+    return coordinates
+
+
+@pytest.fixture
+def dense_patterns(rng):
+    return numpy.int32(rng.poisson(1.5, (5, 4, 6)))
+
+
+def _patterns(dense_patterns, pattern_format, masked=True):
+    if pattern_format == "dense":
+        patterns = dense_patterns.copy()
+        if masked:
+            patterns[:, 0, :2] = -1
+            patterns[1, 3, :] = -1
+        return patterns
+    if pattern_format == "sparse":
+        return pyemc.images_to_sparse(dense_patterns)
+    return pyemc.images_to_sparser(dense_patterns)
+
+
+@pytest.fixture
+def slices(rng):
+    slices = numpy.float32(rng.uniform(0.2, 3., (3, 4, 6)))
+    slices[0, 1, :3] = -1.
+    slices[2, 2, 1] = 0.
+    return slices
+
+
+# Tests
+
+@pytest.mark.parametrize("interpolation", INTERPOLATIONS)
+def test_expand_model(model, rotations, coordinates, interpolation):
+    slices = numpy.zeros((len(rotations), ) + coordinates.shape[1:],
+                         dtype="float32")
+    pyemc.expand_model(model, slices, rotations, coordinates,
+                       interpolation=interpolation)
+    expected = _expand_model(model, rotations, coordinates, interpolation)
+    numpy.testing.assert_allclose(slices, expected, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize("interpolation", INTERPOLATIONS)
+def test_insert_slices(rng, model, rotations, coordinates, interpolation):
+    slices = numpy.float32(rng.uniform(0., 3., (len(rotations), ) +
+                                       coordinates.shape[1:]))
+    slices[1, 2, :] = -1.
+    slice_weights = numpy.float32(rng.uniform(0.5, 1.5, len(rotations)))
+    model_sum = numpy.zeros_like(model)
+    model_weights = numpy.zeros_like(model)
+    pyemc.insert_slices(model_sum, model_weights, slices, slice_weights,
+                        rotations, coordinates, interpolation=interpolation)
+    expected_sum, expected_weights = _insert_slices(
+        numpy.zeros_like(model), numpy.zeros_like(model), slices,
+        slice_weights, rotations, coordinates, interpolation)
+    numpy.testing.assert_allclose(model_weights, expected_weights,
+                                  rtol=1e-4, atol=1e-4)
+    numpy.testing.assert_allclose(model_sum, expected_sum, rtol=1e-4,
+                                  atol=1e-4)
+
+
+def _scalings(rng, scaling_type, number_of_slices, number_of_patterns):
+    if scaling_type is None:
+        return None
+    if scaling_type == "pair":
+        return numpy.float32(rng.uniform(0.5, 2., (number_of_slices,
+                                                   number_of_patterns)))
+    return numpy.float32(rng.uniform(0.5, 2., number_of_patterns))
+
+
+@pytest.mark.parametrize("pattern_format, scaling_type", [
+    ("dense", None), ("dense", "pair"), ("dense", "pattern"),
+    ("sparse", None), ("sparse", "pair"), ("sparse", "pattern"),
+    ("sparser", None), ("sparser", "pair")])
+def test_calculate_responsabilities(rng, dense_patterns, slices,
+                                    pattern_format, scaling_type):
+    patterns = _patterns(dense_patterns, pattern_format)
+    scalings = _scalings(rng, scaling_type, len(slices),
+                         len(dense_patterns))
+    responsabilities = numpy.zeros((len(slices), len(dense_patterns)),
+                                   dtype="float32")
+    pyemc.calculate_responsabilities_poisson(patterns, slices,
+                                             responsabilities,
+                                             scalings=scalings)
+    expected = _responsabilities(patterns, slices, scalings)
+    numpy.testing.assert_allclose(responsabilities, expected, rtol=1e-5,
+                                  atol=1e-3)
+
+
+@pytest.mark.parametrize("pattern_format", ["dense", "sparse", "sparser"])
+def test_calculate_scaling(dense_patterns, slices, pattern_format):
+    patterns = _patterns(dense_patterns, pattern_format)
+    scaling = numpy.zeros((len(slices), len(dense_patterns)),
+                          dtype="float32")
+    pyemc.calculate_scaling_poisson(patterns, slices, scaling)
+    numpy.testing.assert_allclose(scaling, _scaling(patterns, slices),
+                                  rtol=1e-5)
+
+
+def test_calculate_scaling_per_pattern(rng, dense_patterns, slices):
+    patterns = _patterns(dense_patterns, "dense")
+    responsabilities = numpy.float32(rng.uniform(0., 1., (len(slices),
+                                                          len(patterns))))
+    scaling = numpy.zeros(len(patterns), dtype="float32")
+    pyemc.calculate_scaling_per_pattern_poisson(patterns, slices,
+                                                responsabilities, scaling)
+    numpy.testing.assert_allclose(
+        scaling, _scaling_per_pattern(patterns, slices, responsabilities),
+        rtol=1e-5)
+
+
+@pytest.mark.parametrize("pattern_format, scaling_type", [
+    ("dense", None), ("dense", "pair"), ("dense", "pattern"),
+    ("sparse", None), ("sparse", "pair"), ("sparse", "pattern"),
+    ("sparser", None), ("sparser", "pair")])
+def test_update_slices(rng, dense_patterns, pattern_format, scaling_type):
+    patterns = _patterns(dense_patterns, pattern_format)
+    number_of_slices = 4
+    responsabilities = numpy.float32(rng.uniform(
+        0., 1., (number_of_slices, len(dense_patterns))))
+    responsabilities[responsabilities < 0.3] = 0.
+    responsabilities[:, 0] = 0.5
+    scalings = _scalings(rng, scaling_type, number_of_slices,
+                         len(dense_patterns))
+    slices = numpy.zeros((number_of_slices, ) + dense_patterns.shape[1:],
+                         dtype="float32")
+    pyemc.update_slices(slices, patterns, responsabilities,
+                        scalings=scalings)
+    expected = _update_slices(patterns, responsabilities,
+                              dense_patterns.shape[1:], scalings)
+    numpy.testing.assert_allclose(slices, expected, rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize("pattern_format", ["dense", "sparse", "sparser"])
+@pytest.mark.parametrize("scaled", [False, True])
+def test_update_slices_csr(rng, dense_patterns, pattern_format, scaled):
+    patterns = _patterns(dense_patterns, pattern_format)
+    number_of_slices = 4
+    responsabilities = numpy.float32(rng.uniform(
+        0., 1., (number_of_slices, len(dense_patterns))))
+    responsabilities[responsabilities < 0.5] = 0.
+    responsabilities[:, 0] = 0.5
+    responsabilities[2] = 0.
+    scalings = _scalings(rng, "pair" if scaled else None, number_of_slices,
+                         len(dense_patterns))
+    rows, pattern_list = numpy.nonzero(responsabilities)
+    row_start = numpy.int32(numpy.concatenate(
+        ([0], numpy.cumsum(numpy.bincount(rows,
+                                          minlength=number_of_slices)))))
+    slices = numpy.zeros((number_of_slices, ) + dense_patterns.shape[1:],
+                         dtype="float32")
+    pyemc.update_slices_csr(
+        slices, patterns, row_start, numpy.int32(pattern_list),
+        responsabilities[rows, pattern_list],
+        scalings=None if scalings is None else scalings[rows, pattern_list])
+    expected = _update_slices(patterns, responsabilities[[0, 1, 3]],
+                              dense_patterns.shape[1:],
+                              None if scalings is None
+                              else scalings[[0, 1, 3]])
+    numpy.testing.assert_allclose(slices[[0, 1, 3]], expected, rtol=1e-5,
+                                  atol=1e-6)
+    # A slice without responsabilities
+    numpy.testing.assert_array_equal(
+        slices[2], -1. if pattern_format == "dense" else 0.)
@@ -0,0 +1,72 @@
+"""Iterations of the EMC class with the different ways of keeping the
+responsabilities between the two steps"""
+import numpy
+import pytest
+import pyemc
+
+
+rotsampling = pytest.importorskip("rotsampling")
+
+
+@pytest.fixture(autouse=True)
+def cpu_backend():
+    pyemc.set_backend("cpu")
+
+
+@pytest.fixture
+def data():
+    rng = numpy.random.default_rng(1)
+    side = 16
+    image_shape = (16, 16)
+    x = numpy.arange(side) - side/2 + 0.5
+    r = numpy.sqrt(x[:, numpy.newaxis, numpy.newaxis]**2 +
+                   x[numpy.newaxis, :, numpy.newaxis]**2 +
+                   x[numpy.newaxis, numpy.newaxis, :]**2)
+    model = numpy.float32(numpy.exp(-r/3) * 20 *
+                          (1 + 0.5*numpy.sin(x[:, numpy.newaxis,
+                                                 numpy.newaxis]/2)))
+    coordinates = pyemc.ewald_coordinates(image_shape, 1e-9, 0.1, 1e-3,
+                                          output_type="numpy")
+    rotations = numpy.float32(rng.normal(size=(40, 4)))
+    rotations /= numpy.linalg.norm(rotations, axis=1)[:, numpy.newaxis]
+    slices = numpy.zeros((len(rotations), ) + image_shape, dtype="float32")
+    pyemc.expand_model(model, slices, rotations, coordinates)
+    patterns = numpy.int32(rng.poisson(numpy.clip(slices, 0, None)))
+    mask = numpy.ones(image_shape, dtype=bool)
+    mask[0, 0] = False
+    start = numpy.float32(rng.uniform(1, 2, model.shape)) * model.mean()
+    return patterns, mask, start, coordinates
+
+
+def _run(data, resp_storage, rescale, tmp_path):
+    patterns, mask, start, coordinates = data
+    emc = pyemc.EMC(patterns, mask, [start, start*1.1], coordinates, 2,
+                    rescale=rescale)
+    # Several chunks per model
+    emc._chunk_size = 30
+    emc.set_resp_storage(resp_storage, directory=str(tmp_path))
+    for _ in range(3):
+        emc.iteration()
+    return emc
+
+
+@pytest.mark.parametrize("rescale", [False, True])
+@pytest.mark.parametrize("resp_storage", ["recompute", "memmap"])
+def test_resp_storage(data, tmp_path, resp_storage, rescale):
+    reference = _run(data, "dense", rescale, tmp_path)
+    emc = _run(data, resp_storage, rescale, tmp_path)
+    # Recompute calculates the responsabilities a second time, in a
+    # different order of float operations
+    for model, reference_model in zip(emc.get_model(),
+                                      reference.get_model()):
+        numpy.testing.assert_allclose(model, reference_model, rtol=1e-3,
+                                      atol=1e-4)
+    numpy.testing.assert_array_equal(emc.get_best_rotations(),
+                                     reference.get_best_rotations())
+    numpy.testing.assert_allclose(emc.get_average_best_resp(),
+                                  reference.get_average_best_resp(),
+                                  rtol=1e-4)
+    if rescale:
+        numpy.testing.assert_allclose(emc.get_best_scaling(),
+                                      reference.get_best_scaling(),
+                                      rtol=1e-4)